@@ -1,4 +1,6 @@
 # Copyright 2016 Morgan McDermott & Blake Allen
+import threading
+
 import botocore
 import botocore.session
 import boto3
@@ -14,6 +16,7 @@ class AWSManager(object):
         self._botocore_session = None
         self.create_session()
         self.clients = {}
+        self._clients_lock = threading.Lock()
 
     def create_session(self):
         if self._session is None:
@@ -59,8 +62,11 @@ class AWSManager(object):
 
     def get_client(self, service):
         """
-        Return a client configured with current credentials and region
+        Return a client configured with current credentials and region.
+        Clients are shared between threads, but boto3 sessions aren't safe
+        to create clients from concurrently, so creation is serialized.
         """
-        if service not in self.clients:
-            self.clients[service] = self._session.client(service)
-        return self.clients[service]
+        with self._clients_lock:
+            if service not in self.clients:
+                self.clients[service] = self._session.client(service)
+            return self.clients[service]
@@ -9,12 +9,14 @@ import os.path
 import re
 import json
 import time
-import boto3
 import shutil
 import datetime
+import base64
+import hashlib
 import importlib
-from zipfile import ZipFile
-from threading import Thread
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 
 import antenna.Sources as Sources
 import antenna.Transformers as Transformers
@@ -22,39 +24,103 @@ import antenna.Filters as Filters
 import antenna.Storage as Storage
 import antenna.AWSManager as AWSManager
 import antenna.ResourceManager as ResourceManager
+import antenna.Queues as Queues
+from antenna.StageRegistry import StageRegistry
+from antenna.MessageCodec import MessageCodec
+import antenna.util as util
 import botocore
 
-import redleader.util
-
+# Class maps hold import paths, resolved by resolve_class on first use,
+# so a job only imports the plugins (and their dependencies) it runs.
 sourceClassMap = {
-    'RSSFeedSource': Sources.RSSFeedSource,
-    "NewspaperLibSource": Sources.NewspaperLibSource
+    'RSSFeedSource': "antenna.Sources.RSSFeedSource",
+    "NewspaperLibSource": "antenna.Sources.NewspaperLibSource"
 }
 
 transformerClassMap = {
-    "IdentityTransformer": Transformers.IdentityTransformer,
-    "NewspaperLibScraper": Transformers.NewspaperLibScraper
+    "IdentityTransformer": "antenna.Transformers.IdentityTransformer",
+    "NewspaperLibScraper": "antenna.Transformers.NewspaperLibScraper"
 }
 
 storageClassMap = {
-    "DynamoDBStorage": Storage.DynamoDBStorage
+    "DynamoDBStorage": "antenna.Storage.DynamoDBStorage",
+    "SQLiteStorage": "antenna.Storage.SQLiteStorage",
+    "JSONLStorage": "antenna.Storage.JSONLStorage",
+    "ParquetStorage": "antenna.Storage.ParquetStorage",
+    "S3ArchiveStorage": "antenna.Storage.S3ArchiveStorage"
 }
 
 filterClassMap = {
-    "UniqueDynamoDBFilter": Filters.UniqueDynamoDBFilter
+    "UniqueDynamoDBFilter": "antenna.Filters.UniqueDynamoDBFilter"
 }
 
+def resolve_class(class_map, name):
+    """
+    Return the class registered under `name`, importing it if the map
+    holds an import path. Maps may also hold classes directly.
+    """
+    target = class_map[name]
+    if isinstance(target, str):
+        module_name, class_name = target.rsplit(".", 1)
+        target = getattr(importlib.import_module(module_name), class_name)
+        class_map[name] = target
+    return target
+
+# Timeout for deployed lambda functions, in seconds
+LAMBDA_TIMEOUT = 300
+
+# Seconds a dispatched batch's messages stay in flight. Queues default to a
+# 30s visibility timeout, far less than a transformer invocation may run, so
+# without extending it messages reappear and are dispatched again mid-batch.
+# This covers the invocation's full runtime plus time spent queued by lambda.
+TRANSFORMER_VISIBILITY_TIMEOUT = 2 * LAMBDA_TIMEOUT
+
+# Maximum event size for asynchronous lambda invocations
+LAMBDA_ASYNC_PAYLOAD_BYTES = 256 * 1024
+
+# Lambda packages are built in this directory under the project's source path
+LAMBDA_BUILD_DIR = ".antenna_build"
+
+# Fixed timestamp for zip entries, so identical inputs give identical packages
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
 class Controller(object):
-    def __init__(self, config, source_path=None, aws_profile=None):
+    """
+    With `runtime_only`, the RedLeader resource cluster (and with it every
+    CloudFormation resource and the lambda IAM role) is only modeled if a
+    deploy command needs it. Lambda handlers and local runs, which only
+    move items through existing queues and tables, use this mode.
+    """
+    def __init__(self, config, source_path=None, aws_profile=None, runtime_only=False):
         self._defaults = {
             'local_controller': False,
             'local_jobs': False,
             'local_queue': False,
             'controller_schedule': 5, # Run the controller every N minutes
             'aws_region': 'us-west-1',
-            'runtime': 60 # Maximum runtime defaults to 60s. This applies to transformer
-                          # queue jobs only (typically the longest running portion)
-
+            'runtime': 60, # Maximum runtime defaults to 60s. This applies to transformer
+                           # queue jobs only (typically the longest running portion)
+            'queue_wait_time': 20, # SQS long polling wait, in seconds (at most 20)
+            'queue_idle_timeout': 30, # Transformer queue jobs exit once their queue has
+                                      # been empty for this many seconds
+            'transformer_batch_size': 10, # Maximum items sent to one transformer invocation
+            'transformer_item_seconds': 5, # Expected time to transform one item. Batches are
+                                           # kept small enough to finish within the lambda timeout
+            'source_workers': 8, # Number of source jobs dispatched concurrently
+            'local_pipeline_workers': 4, # Worker threads per transformer in `antenna local`
+            'local_pipeline_queue_size': 100, # Items buffered ahead of each transformer
+                                              # in `antenna local` before producers block
+            'local_queue_memory_items': 1000, # Items held in memory per local queue before
+                                              # spilling to disk
+            'local_queue_max_items': 1000000, # Local queue producers block past this many items
+            'local_queue_dir': None, # Spill directory for local queues. Defaults to
+                                     # .antenna_queues under the source path
+            'local_queue_visibility_timeout': 300, # Seconds before an unacked local item
+                                                   # is delivered again
+            'queue_backend': None, # "sqs", "memory" or "file". Defaults to "file" if
+                                   # local_queue is set and "sqs" otherwise
+            'message_compression': None, # "zlib" or "zstd" to compress queue messages
+            'message_compress_min_bytes': 1024 # Smaller messages are sent uncompressed
         }
 
         self._source_path = source_path
@@ -65,7 +131,6 @@ class Controller(object):
 
         self.validate_config(config)
         self.config = config
-        self.local_queues = {}
 
         for key in config:
             setattr(self, key, config[key])
@@ -76,12 +141,23 @@ class Controller(object):
 
         self._aws_profile = aws_profile
         self._aws_manager = AWSManager.AWSManager(aws_profile=aws_profile, aws_region=self.aws_region)
-        self._sqs = self._aws_manager._session.resource('sqs')
+        self._sqs_resource = None
         self._sqs_queues = {}
+        self._sqs_queues_lock = Lock()
+        self._queues = {}
+        self._queues_by_name = {}
+        self._queues_lock = Lock()
+        self._queue_senders = {}
+        self._queue_senders_lock = Lock()
+        self._stages = StageRegistry()
+        self._codec = MessageCodec(compression=self.message_compression,
+                                   compress_min_bytes=self.message_compress_min_bytes)
 
-        # Deploy cluster on initialization
         self._resource_manager = ResourceManager.ResourceManager(self)
-        self._cluster = self._resource_manager.create_resource_cluster()
+        self._resource_cluster = None
+        if not runtime_only:
+            # Model the cluster up front, surfacing config errors early
+            self._cluster
 
         self._transformer_memory_size = 128
         self._source_memory_size = 128
@@ -89,6 +165,21 @@ class Controller(object):
 
         print("Controller setup complete")
 
+    @property
+    def _cluster(self):
+        """
+        The RedLeader cluster of all AWS resources, built on first use
+        """
+        if self._resource_cluster is None:
+            self._resource_cluster = self._resource_manager.create_resource_cluster()
+        return self._resource_cluster
+
+    @property
+    def _sqs(self):
+        if self._sqs_resource is None:
+            self._sqs_resource = self._aws_manager._session.resource('sqs')
+        return self._sqs_resource
+
     def validate_config(self, config):
         required_keys = ['sources', 'transformers', 'project_name']
         for key in required_keys:
@@ -128,17 +219,30 @@ class Controller(object):
         return "%sController" % (self.config['project_name'])
 
     def config_bucket_name(self):
+        import redleader.util
         return "%sconfigbucket" % redleader.util.sanitize((self.config['project_name']).lower())
 
+    def dependency_layer_name(self):
+        return "%sDependencies" % (self.config['project_name'])
+
     def create_lambda_functions(self):
+        # Third party dependencies are shared by every function as a layer,
+        # so function packages only hold antenna and the project's code
+        layers = []
+        layer = create_lambda_layer(self._source_path)
+        if layer is not None:
+            layers.append(publish_lambda_layer(self._aws_manager.get_client('lambda'),
+                                               self.dependency_layer_name(), *layer))
+        zipfilepath = create_lambda_package(self._source_path, include_dependencies=False)
+
         # Create controller lambda function
-        zipfilepath = create_lambda_package(self._source_path)
         create_lambda_function(self.controller_lambda_name(),
                                self.get_lambda_role_arn(),
                                self._aws_manager.get_client('lambda'),
                                zipfilepath,
                                "lambda_handlers.controller_handler",
-                               memory_size=self._controller_memory_size)
+                               memory_size=self._controller_memory_size,
+                               layers=layers)
 
         # Create lambda functions for each transformer type
         transformer_types = {}
@@ -151,7 +255,8 @@ class Controller(object):
                                    self._aws_manager.get_client('lambda'),
                                    zipfilepath,
                                    "lambda_handlers.transformer_handler",
-                                   memory_size=self._transformer_memory_size)
+                                   memory_size=self._transformer_memory_size,
+                                   layers=layers)
 
         # Create lambda functions for each source type
         source_types = {}
@@ -164,7 +269,8 @@ class Controller(object):
                                    self._aws_manager.get_client('lambda'),
                                    zipfilepath,
                                    "lambda_handlers.source_handler",
-                                   memory_size=self._source_memory_size)
+                                   memory_size=self._source_memory_size,
+                                   layers=layers)
 
     def schedule_controller_lambda(self):
         cloudwatch = self._aws_manager.get_client('events')
@@ -199,40 +305,126 @@ class Controller(object):
 
     def get_sqs_queue(self, item_type):
         queue_name = self._resource_manager.queue_name(item_type)
-        if item_type not in self._sqs_queues:
-            url = self._aws_manager.get_client('sqs').get_queue_url(QueueName=queue_name)['QueueUrl']
-            self._sqs_queues[item_type] = self._sqs.Queue(url)
-        return self._sqs_queues[item_type]
+        with self._sqs_queues_lock:
+            if item_type not in self._sqs_queues:
+                url = self._aws_manager.get_client('sqs').get_queue_url(QueueName=queue_name)['QueueUrl']
+                self._sqs_queues[item_type] = self._sqs.Queue(url)
+            return self._sqs_queues[item_type]
+
+    def queue_backend_type(self):
+        """
+        The configured queue backend: "sqs", "memory" or "file".
+        `local_queue` without a `queue_backend` selects "file".
+        """
+        if self.queue_backend is not None:
+            return self.queue_backend
+        return "file" if self.local_queue else "sqs"
+
+    def uses_local_queues(self):
+        return self.queue_backend_type() != "sqs"
+
+    def build_queue(self, item_type):
+        backend_type = self.queue_backend_type()
+        if backend_type == "sqs":
+            return Queues.SQSQueueBackend(self._aws_manager.get_client('sqs'),
+                                          self.get_sqs_queue(item_type).url)
+        if backend_type == "memory":
+            return Queues.MemoryQueueBackend(item_type,
+                                             max_items=self.local_queue_max_items,
+                                             visibility_timeout=self.local_queue_visibility_timeout,
+                                             put_timeout=self.runtime)
+        if backend_type == "file":
+            directory = self.local_queue_dir
+            if directory is None:
+                directory = os.path.join(self._source_path, ".antenna_queues")
+            return Queues.FileQueueBackend(item_type, directory,
+                                           memory_items=self.local_queue_memory_items,
+                                           max_items=self.local_queue_max_items,
+                                           visibility_timeout=self.local_queue_visibility_timeout,
+                                           put_timeout=self.runtime)
+        raise Exception("Unknown queue backend %s" % backend_type)
+
+    def get_queue(self, item_type):
+        """
+        Returns the queue backend for the given item type
+        """
+        with self._queues_lock:
+            if item_type not in self._queues:
+                backend = self.build_queue(item_type)
+                self._queues[item_type] = backend
+                self._queues_by_name[backend.name] = backend
+            return self._queues[item_type]
+
+    def get_queue_by_name(self, name):
+        """
+        Returns the queue backend with the given name. Unknown names are
+        taken to be SQS queue URLs, such as those in items received by a
+        transformer lambda function.
+        """
+        with self._queues_lock:
+            if name in self._queues_by_name:
+                return self._queues_by_name[name]
+        if self.uses_local_queues():
+            raise Exception("Unknown local queue %s" % name)
+        backend = Queues.SQSQueueBackend(self._aws_manager.get_client('sqs'), name)
+        with self._queues_lock:
+            return self._queues_by_name.setdefault(name, backend)
+
+    def get_queue_sender(self, item_type):
+        """
+        Returns the batching sender for the given item type's queue
+        """
+        with self._queue_senders_lock:
+            if item_type not in self._queue_senders:
+                self._queue_senders[item_type] = Queues.QueueBatcher(self.get_queue(item_type))
+            return self._queue_senders[item_type]
+
+    def enqueue_item(self, item):
+        """
+        Buffer an item for its queue. Buffered items are sent in batches,
+        and are only guaranteed to be on the queue after flush_queues()
+        """
+        body, attributes = self._codec.encode(item.payload)
+        self.get_queue_sender(item.item_type).add(body, attributes)
+
+    def flush_queues(self):
+        with self._queue_senders_lock:
+            senders = list(self._queue_senders.values())
+        for sender in senders:
+            sender.flush()
 
     def drain_queues(self):
-        queues = {}
         for item_type in self.item_types():
-            queue = self.get_sqs_queue(item_type)
-            for message in queue.receive_messages():
-                message.delete()
+            backend = self.get_queue(item_type)
+            messages = backend.receive()
+            while len(messages) > 0:
+                backend.ack([m.receipt_handle for m in messages])
+                messages = backend.receive()
 
     def dequeue_local_item(self, item_type):
         """
         Dequeue an item for local use and testing (replacement for SQS queue)
         """
-        if item_type not in self.local_queues:
-            return None
-        if len(self.local_queues[item_type]) == 0:
+        backend = self.get_queue(item_type)
+        messages = backend.receive(max_messages=1)
+        if len(messages) == 0:
             return None
-        return self.local_queues[item_type].pop()
+        backend.ack([messages[0].receipt_handle])
+        return Sources.Item(item_type=item_type,
+                            payload=self._codec.decode(messages[0].body,
+                                                       messages[0].message_attributes))
 
     def queue_local_item(self, item):
         """
         Queue an item for local use and testing (replacement for SQS queue)
         """
-        if item.item_type not in self.local_queues:
-            self.local_queues[item.item_type] = []
-        self.local_queues[item.item_type].append(item)
+        body, attributes = self._codec.encode(item.payload)
+        self.get_queue(item.item_type).send_batch([body], [attributes])
 
     def instantiate_source(self, config, skip_loading_state=False):
         if config['type'] not in sourceClassMap:
             raise Exception('Unknown source type %s ' % config['type'])
-        source = sourceClassMap[config['type']](self._aws_manager, config)
+        source = resolve_class(sourceClassMap, config['type'])(self._aws_manager, config)
         if not skip_loading_state:
             source.set_state(self.get_source_state(source))
         return source
@@ -254,6 +446,42 @@ class Controller(object):
             return Storage.DynamoDBStorage.from_dynamo_dict(res['Item'])
         return None
 
+    def get_source_states(self, sources, max_retries=8):
+        """
+        Retrieve the saved state of many sources with BatchGetItem.
+        Returns a dict of source config hash => state.
+        """
+        table_name = self._resource_manager.dynamo_table_name("source_state")
+        ddb = self._aws_manager.get_client('dynamodb')
+        hashes = sorted(set(source.config_hash() for source in sources))
+
+        states = {}
+        for chunk in util.chunks(hashes, Filters.DYNAMODB_MAX_BATCH_GET):
+            request_items = {
+                table_name: {'Keys': [{"source_config_hash": {'S': h}} for h in chunk]}
+            }
+            attempt = 0
+            while len(request_items) > 0:
+                try:
+                    res = ddb.batch_get_item(RequestItems=request_items)
+                except botocore.exceptions.ClientError as e:
+                    print("Failed to retrieve source states: %s" % str(e))
+                    break
+                for row in res.get('Responses', {}).get(table_name, []):
+                    state = Storage.DynamoDBStorage.from_dynamo_dict(row)
+                    states[state['source_config_hash']] = state
+                request_items = res.get('UnprocessedKeys', {})
+                if len(request_items) == 0:
+                    break
+                if attempt >= max_retries:
+                    print("Failed to retrieve %d source states" %
+                          len(request_items[table_name]['Keys']))
+                    break
+                util.backoff_sleep(attempt)
+                attempt += 1
+        print("Restored state for %d of %d sources" % (len(states), len(hashes)))
+        return states
+
     def update_source_state(self, source):
         source_config_hash = source.config_hash()
         source_state = source.get_state()
@@ -264,57 +492,101 @@ class Controller(object):
 
         return ddb.put_item(TableName=table_name, Item=dynamo_source_state)
 
-    def run_source_job(self, config):
+    def run_source_job(self, config, source=None, use_queues=True):
+        """
+        Run a source, returning the items which passed the source filters.
+        With `use_queues=False` items are only filtered and stored, leaving
+        the caller to hand them to transformers.
+        """
         items = []
-        source = self.instantiate_source(config)
+        if source is None:
+            source = self.instantiate_source(config)
 
         print("Source has new data? %s" % str(source.has_new_data()))
-        for item in source.yield_items():
-            if self.local_queue:
-                self.queue_local_item(item)
-            else:
-                if not self.filter_item(self.config.get("source_filters", []), item):
-                    print("Item filtered. Not storing nor queueing. (%s)" %
-                          json.dumps(item.payload)[:64])
-                else:
-                    output_queue = self.get_sqs_queue(item.item_type)
-                    output_queue.send_message(
-                        MessageBody=json.dumps(item.payload, indent=4))
-                    print("Created source item on queue %s (%s)" % (item.item_type, json.dumps(item.payload)[:64]))
-                    items.append(item)
-                    self.store_item(self.config.get("source_storage", []), item)
+        try:
+            produced = list(source.yield_items())
+            items = self.filter_items(self.config.get("source_filters", []), produced)
+            print("%d of %d source items passed filters" % (len(items), len(produced)))
+            for item in items:
+                if use_queues:
+                    self.enqueue_item(item)
+                    print("Buffered source item for queue %s (%s)" % (item.item_type, json.dumps(item.payload)[:64]))
+                self.store_item(self.config.get("source_storage", []), item)
+        finally:
+            # Send anything still buffered, even if the source failed partway
+            if use_queues:
+                self.flush_queues()
+            self.flush_stages()
         self.update_source_state(source)
         return items
 
-    def create_source_job(self, config):
+    def create_source_job(self, config, source=None):
         """
         Spawn a job for the given source config
         """
-        source = self.instantiate_source(config)
+        if source is None:
+            source = self.instantiate_source(config)
         if source.has_new_data():
-            print("Spawning job for source %s" % config['type'])
-            if True == self.local_jobs:
-                self.run_source_job(config)
-            else:
-                event = {
-                    'controller_config': json.dumps(self.config),
-                    'source_config': json.dumps(config)
-                }
-                response = self._aws_manager.get_client('lambda').invoke(
-                    FunctionName=self.source_lambda_name(config),
-                    InvocationType='Event',
-                    Payload=json.dumps(event)
-                )
+            self.dispatch_source_job(config, source)
         else:
             print("Source has no new data. Skipping.")
 
+    def dispatch_source_job(self, config, source):
+        print("Spawning job for source %s" % config['type'])
+        if True == self.local_jobs:
+            self.run_source_job(config, source=source)
+        else:
+            event = {
+                'controller_config': json.dumps(self.config),
+                'source_config': json.dumps(config)
+            }
+            response = self._aws_manager.get_client('lambda').invoke(
+                FunctionName=self.source_lambda_name(config),
+                InvocationType='Event',
+                Payload=json.dumps(event)
+            )
+
+    def create_source_jobs(self):
+        """
+        Spawn jobs for every source with new data. Source states are loaded
+        in bulk, and due sources are dispatched concurrently.
+        """
+        sources = [self.instantiate_source(config, skip_loading_state=True)
+                   for config in self.sources]
+        states = self.get_source_states(sources)
+        due = []
+        for config, source in zip(self.sources, sources):
+            source.set_state(states.get(source.config_hash()))
+            if source.has_new_data():
+                due.append((config, source))
+        print("%d of %d sources have new data" % (len(due), len(sources)))
+        if not self.local_jobs and len(due) > 0:
+            # Create the client before the workers share it
+            self._aws_manager.get_client('lambda')
+
+        with ThreadPoolExecutor(max_workers=max(1, self.source_workers)) as pool:
+            jobs = [(config, pool.submit(self.dispatch_source_job, config, source))
+                    for config, source in due]
+            for config, job in jobs:
+                try:
+                    job.result()
+                except Exception as e:
+                    print("Error: source job %s failed with exception %s" % (config['type'], e))
+
     def instantiate_transformer(self, config, source_path):
         if config['type'] not in transformerClassMap:
             if "." not in config['type']:
                 raise Exception('Unknown transformer type %s ' % config['type'])
             transformer = self.import_transformer(config['type'], source_path)
             return transformer(self._aws_manager, config)
-        return transformerClassMap[config['type']](self._aws_manager, config)
+        return resolve_class(transformerClassMap, config['type'])(self._aws_manager, config)
+
+    def get_transformer(self, config, source_path):
+        """
+        Returns the shared transformer instance for the given config
+        """
+        return self._stages.get("transformer:%s" % source_path, config,
+                                lambda conf: self.instantiate_transformer(conf, source_path))
 
     def import_transformer(self, classpath, source_path):
         """
@@ -332,11 +604,40 @@ class Controller(object):
     def instantiate_filter(self, filter_conf):
         if filter_conf["type"] not in filterClassMap:
             raise RuntimeError("Unknown filter type %s" % filter_conf["type"])
-        return filterClassMap[filter_conf["type"]](self._aws_manager, filter_conf)
+        if filter_conf.get("bloom_filter", False) and \
+           filter_conf.get("bloom_filter_path") is None and \
+           filter_conf.get("bloom_filter_s3_bucket") is None:
+            # Persist bloom filters to a local file when jobs run locally,
+            # and to the project's config bucket, shared by every lambda, otherwise
+            filter_conf = dict(filter_conf)
+            if self.local_jobs:
+                filter_conf["bloom_filter_path"] = os.path.join(
+                    self._source_path, ".%s.bloom" % filter_conf["dynamodb_table_name"])
+            else:
+                filter_conf["bloom_filter_s3_bucket"] = self.config_bucket_name()
+        return resolve_class(filterClassMap, filter_conf["type"])(self._aws_manager, filter_conf)
+
+    def get_filter(self, filter_conf):
+        """
+        Returns the shared filter instance for the given config
+        """
+        return self._stages.get("filter", filter_conf, self.instantiate_filter)
+
+    def filter_items(self, filter_configs, items):
+        """
+        Returns the items which pass every filter, checking each filter
+        against the whole batch at once
+        """
+        for filter_conf in filter_configs:
+            if len(items) == 0:
+                break
+            results = self.get_filter(filter_conf).filter_many(items)
+            items = [item for item, keep in zip(items, results) if keep]
+        return items
 
     def filter_item(self, filter_configs, item):
         for filter_conf in filter_configs:
-            filterObj = self.instantiate_filter(filter_conf)
+            filterObj = self.get_filter(filter_conf)
             if not filterObj.filter(item):
                 return False
         return True
@@ -350,66 +651,165 @@ class Controller(object):
 
         if storage_conf["type"] not in storageClassMap:
             raise RuntimeError("Unknown storage type %s" % storage_conf["type"])
-        return storageClassMap[storage_conf["type"]](self._aws_manager, storage_conf)
+        return resolve_class(storageClassMap, storage_conf["type"])(self._aws_manager, storage_conf)
 
     def store_item(self, storage_configs, item):
         """Store any produced items according to the a storage config found
            in a source/transformer config
+
+           Returns the number of storage backends the item was written to
         """
+        written = 0
         for storage_conf in storage_configs:
-            storageObj = self.instantiate_storage(storage_conf)
-            storageObj.store_item(item)
+            storageObj = self.get_storage(storage_conf)
+            if storageObj.store_item(item) is not False:
+                written += 1
+        return written
+
+    def get_storage(self, storage_conf):
+        """
+        Returns the shared storage instance for the given config
+        """
+        return self._stages.get("storage", storage_conf, self.instantiate_storage)
+
+    def flush_stages(self):
+        """
+        Flush every filter, storage and transformer stage built so far
+        """
+        self._stages.flush()
+
+    def close(self):
+        """
+        Send any buffered messages, then flush and close all stages
+        and queues
+        """
+        self.flush_queues()
+        self._stages.close()
+        with self._queues_lock:
+            backends = list(self._queues_by_name.values())
+        for backend in backends:
+            backend.close()
 
     def run_transformer_job(self, config, input_item, source_path, use_queues=True):
-        transformer = self.instantiate_transformer(
-            config, source_path)
-        new_item = transformer.transform(input_item)
-
-        print("INPUT ITEM", str(json.dumps(input_item.payload, indent=4))[0:100])
-        client = self._aws_manager.get_client('sqs')
-
-        print("Deleting message from queue")
-        if use_queues and hasattr(input_item.payload, 'sqs_receipt_handle'):
-            input_queue = self.get_sqs_queue(input_item.item_type)
-            resp = client.delete_message(
-                QueueUrl=input_queue.url,
-                ReceiptHandle=input_item.payload['sqs_receipt_handle']
-            )
-        print("Filtering item")
-        if not self.filter_item(config.get("filters", []), new_item):
+        new_items = self.run_transformer_batch(config, [input_item], source_path,
+                                               use_queues=use_queues)
+        if len(new_items) == 0:
             return None
-        print("Storing item")
-        self.store_item(config.get("storage", []), new_item)
-        print("Outputting new item on queue")
+        return new_items[0]
+
+    def run_transformer_batch(self, config, input_items, source_path, use_queues=True,
+                              flush=True, stats=None):
+        """
+        Transform a batch of items with Transformer.transform_items, then filter,
+        store and queue whatever it produces. Returns the items which passed filtering.
+
+        Once every output has been stored and queued, input messages are
+        deleted from their queues, unless the transformer reported them as
+        failed. Inputs it dropped, or whose outputs were filtered out, are
+        deleted too. If anything raises, the whole batch is left for redelivery.
+
+        With `flush=False` stages aren't flushed, so several batches can share
+        one flush; inputs must then not be queue messages. If a `stats` dict
+        is given, counts of inputs transformed and failed, of outputs filtered
+        out (including any the transformer dropped) and of storage writes are
+        added to it.
+        """
+        transformer = self.get_transformer(config, source_path)
+        new_items = []
+        failed = set()
+        dropped = 0
+        for result in transformer.transform_items(input_items):
+            if isinstance(result, Transformers.TransformFailure):
+                failed.add(id(result.item))
+            elif result is not None:
+                new_items.append(result)
+            else:
+                dropped += 1
+        print("Transformed %d items into %d items (%d failed)" %
+              (len(input_items), len(new_items), len(failed)))
+
+        output_items = []
+        stored = 0
+        for new_item in self.filter_items(config.get("filters", []), new_items):
+            stored += self.store_item(config.get("storage", []), new_item)
+            if use_queues:
+                try:
+                    self.enqueue_item(new_item)
+                except botocore.exceptions.ClientError as e:
+                    if "NonExistentQueue" not in str(e):
+                        raise e
+                    else:
+                        print("Output queue for %s non existent. Continuing." % new_item.item_type)
+            output_items.append(new_item)
+        if use_queues:
+            self.flush_queues()
+        if flush:
+            self.flush_stages()
+
         if use_queues:
+            self.delete_messages([item for item in input_items if id(item) not in failed])
+        if stats is not None:
+            stats["transformed"] = stats.get("transformed", 0) + len(input_items) - len(failed)
+            stats["failed"] = stats.get("failed", 0) + len(failed)
+            stats["filtered"] = stats.get("filtered", 0) + dropped + \
+                len(new_items) - len(output_items)
+            stats["stored"] = stats.get("stored", 0) + stored
+        print("Output %d new items" % len(output_items))
+        return output_items
+
+    def delete_messages(self, items):
+        """
+        Ack the queue messages the given items were received from
+        """
+        receipts = {}
+        for item in items:
+            if 'sqs_receipt_handle' not in item.payload:
+                continue
+            queue_url = item.payload['sqs_queue_url']
+            receipts.setdefault(queue_url, []).append(item.payload['sqs_receipt_handle'])
+
+        for queue_url in receipts:
+            self.get_queue_by_name(queue_url).ack(receipts[queue_url])
+
+    def extend_messages(self, items, seconds):
+        """
+        Keep the queue messages the given items were received from in flight
+        for `seconds` more seconds
+        """
+        receipts = {}
+        for item in items:
+            if 'sqs_receipt_handle' not in item.payload:
+                continue
+            queue_url = item.payload['sqs_queue_url']
+            receipts.setdefault(queue_url, []).append(item.payload['sqs_receipt_handle'])
+
+        for queue_url in receipts:
             try:
-                output_queue = self.get_sqs_queue(new_item.item_type)
-                output_queue.send_message(MessageBody=json.dumps(new_item.payload))
+                self.get_queue_by_name(queue_url).extend(receipts[queue_url], seconds)
             except botocore.exceptions.ClientError as e:
-                if "NonExistentQueue" not in str(e):
-                    raise e
-                else:
-                    print("Output queue non existent. Continuing.")
-        print("Created new item on queue %s " % new_item.item_type)
-        return new_item
+                # The batch is still worth running; at worst it's redelivered
+                print("Failed to extend visibility of %d messages: %s" %
+                      (len(receipts[queue_url]), str(e)))
 
     def item_from_message_payload(self, item_type, message, queue_url):
         """
-        Bundles SQS message origin information into an item's paylaod.
+        Bundles message origin information into an item's paylaod.
         This permits remote worker to delete message that we retrieved locally.
+        `queue_url` is the SQS queue URL, or the name of a local queue backend.
         """
-        payload = json.loads(message.body)
+        payload = self._codec.decode(message.body, message.message_attributes)
 
         payload['sqs_message_id'] = message.message_id
         payload['sqs_queue_url'] = queue_url
         payload['sqs_receipt_handle'] = message.receipt_handle
         return Sources.Item(item_type=item_type, payload=payload)
 
-    def invoke_transformer_lambda(self, config, item):
+    def invoke_transformer_lambda(self, config, items):
         event = {
             'controller_config': json.dumps(self.config),
             'transformer_config': json.dumps(config),
-            'item': json.dumps({"item_type": item.item_type, "payload": item.payload})
+            'items': json.dumps([{"item_type": item.item_type, "payload": item.payload}
+                                 for item in items])
         }
         response = self._aws_manager.get_client('lambda').invoke(
             FunctionName=self.transformer_lambda_name(config),
@@ -418,46 +818,67 @@ class Controller(object):
         )
         return response
 
+    def transformer_batch_limits(self, config):
+        """
+        Returns the (item count, payload bytes) limits for a single transformer
+        invocation, keeping batches within the lambda event size and timeout
+        """
+        max_items = min(self.transformer_batch_size,
+                        int(0.8 * LAMBDA_TIMEOUT / self.transformer_item_seconds))
+        # Leave room for the configs sent alongside the items, plus JSON escaping
+        overhead = 2 * (len(json.dumps(self.config)) + len(json.dumps(config))) + 1024
+        max_bytes = (LAMBDA_ASYNC_PAYLOAD_BYTES - overhead) // 2
+        return max(1, max_items), max_bytes
+
+    def dispatch_transformer_batch(self, config, items, source_path, run_locally=False):
+        if len(items) == 0:
+            return
+        self.extend_messages(items, TRANSFORMER_VISIBILITY_TIMEOUT)
+        if self.local_jobs or run_locally:
+            try:
+                self.run_transformer_batch(config, items, source_path)
+            except Exception as e:
+                print("Error: failed to transform batch with exception %s" % e)
+        else:
+            # Spin up one lambda job for the whole batch
+            self.invoke_transformer_lambda(config, items)
+        print("Dispatched batch of %d items with type %s" % (len(items), items[0].item_type))
+
     def create_transformer_job(self, config, item_type, source_path):
         """
         Spawn a job for the given transformer config
         """
         print("Running transformer stage for item type %s " % item_type)
-        if True == self.local_queue:
-            transformer = self.instantiate_transformer(config, self._source_path)
-            for item_type in transformer.input_item_types:
-                item = self.dequeue_local_item(item_type)
-                while item != None:
-                    new_item = transformer.transform(item)
-                    self.queue_local_item(new_item)
-                    item = self.dequeue_local_item(item_type)
-        else:
-            start = time.time()
-            jobs = 0
-            while time.time() - start < self.runtime:
-                input_queue = self.get_sqs_queue(item_type)
+        input_queue = self.get_queue(item_type)
+        # Only lambda functions can ack messages on shared queues, so batches
+        # from local queues are always transformed here
+        run_locally = not input_queue.shared
+        poller = Queues.QueuePoller(input_queue,
+                                    runtime=self.runtime,
+                                    wait_time=self.queue_wait_time,
+                                    idle_timeout=self.queue_idle_timeout)
+        max_items, max_bytes = self.transformer_batch_limits(config)
+        batch = []
+        batch_bytes = 0
+        for messages in poller.poll():
+            print("Acquired %d messages for item type %s" % (len(messages), item_type))
+            for message in messages:
+                item = self.item_from_message_payload(item_type, message, input_queue.name)
+                size = len(json.dumps(item.payload))
+                if len(batch) >= max_items or batch_bytes + size > max_bytes:
+                    self.dispatch_transformer_batch(config, batch, source_path, run_locally)
+                    batch = []
+                    batch_bytes = 0
+                batch.append(item)
+                batch_bytes += size
+
+            # A partial receive means the queue is drained for now, so don't
+            # hold on to a partial batch waiting for more messages
+            if len(messages) < Queues.SQS_MAX_BATCH_MESSAGES:
+                self.dispatch_transformer_batch(config, batch, source_path, run_locally)
                 batch = []
-                for message in input_queue.receive_messages():
-                    # TODO: Ensure we aren't processing the same message twice
-                    # for some long-running transformation
-                    print("Acquired SQS message for item type %s" % (item_type))
-                    item = self.item_from_message_payload(item_type, message, input_queue.url)
-                    if self.local_jobs:
-                        try:
-                            jobs += 1
-                            self.run_transformer_job(config, item, source_path)
-                            print("Executing job %s" % jobs)
-                        except Exception as e:
-                            print("Error: failed to transform item with exception %s" %e)
-                    else:
-                        #Spin up lambda job for transformer + item
-                        self.invoke_transformer_lambda(config, item)
-                    print("Finished processing item with type %s" % item_type)
-            # TODO:
-            # Listen on appropriate SQS queue for tasks,
-            # launching lambda jobs when either a time threshhold has been reached
-            # or we have a full batch of items to be processed
-            pass
+                batch_bytes = 0
+        self.dispatch_transformer_batch(config, batch, source_path, run_locally)
 
     def load_chalice_dir(self, source_dir):
         """
@@ -566,7 +987,7 @@ class Controller(object):
     def item_types(self):
         types = []
         for transformer_config in self.config['transformers']:
-            transformer = self.instantiate_transformer(transformer_config, self._source_path)
+            transformer = self.get_transformer(transformer_config, self._source_path)
             types += transformer.input_item_types
             types += transformer.output_item_types
         types = list(set(types)) # Filter to unique types
@@ -585,9 +1006,7 @@ class Controller(object):
         return self._lambda_role_arn
 
     def run(self):
-        for sourceConfig in self.sources:
-            print("Creating a source job")
-            self.create_source_job(sourceConfig)
+        self.create_source_jobs()
 
         # We create one transformer job for each transformer, with the same
         # maximum execution time as the Controller
@@ -602,7 +1021,7 @@ class Controller(object):
 
         threads = []
         for transformerConfig in self.transformers:
-            transformer = self.instantiate_transformer(transformerConfig, self._source_path)
+            transformer = self.get_transformer(transformerConfig, self._source_path)
             for item_type in transformer.input_item_types:
                 t = Thread(
                     target=self.create_transformer_job,
@@ -621,91 +1040,283 @@ class MyEncoder(json.JSONEncoder):
             return int(time.mktime(obj.timetuple()))
         return json.JSONEncoder.default(self, obj)
 
-def create_lambda_function(name, role, client, zipfilepath, handler, memory_size=128, runtime="python3.6", prefix="antenna."):
+def file_sha256(path, block_size=1024 * 1024):
+    """
+    Base64 encoded SHA-256 of the file at `path`, in the format Lambda
+    reports as CodeSha256. The file is hashed in blocks.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return base64.b64encode(h.digest()).decode('utf-8')
+
+def create_lambda_function(name, role, client, zipfilepath, handler, memory_size=128, runtime="python3.6", prefix="antenna.", layers=None):
     """
     Creates the lambda function if it doesn't exist.
-    If it does exist, update it with the new zipfile.
+    If it does exist, update its code only if the zipfile differs from the
+    deployed code, and its configuration only if that has changed.
     """
-    contents = ""
-    with open(zipfilepath, 'rb') as f:
-        contents = f.read()
+    configuration = {
+        "Runtime": runtime,
+        "Handler": "%s%s" % (prefix, handler),
+        "Timeout": LAMBDA_TIMEOUT,
+        "Role": role,
+        "MemorySize": memory_size
+    }
+    if layers is not None:
+        configuration["Layers"] = layers
 
     try:
-        res = client.create_function(
-            FunctionName=name,
-            Runtime=runtime,
-            Handler="%s%s" % (prefix, handler),
-            Timeout=300,
-            Code={
-                'ZipFile': contents
-            },
-            Role=role,
-            MemorySize=memory_size
-        )
+        deployed = client.get_function(FunctionName=name)['Configuration']
     except Exception as e:
-        if "already exist" in "%s" % e:
-            print("Updating lambda function %s" % name)
-            res = client.update_function_code(
-                FunctionName=name,
-                ZipFile=contents
-            )
-            res = client.update_function_configuration(
-                FunctionName=name,
-                Runtime=runtime,
-                Handler="%s%s" % (prefix, handler),
-                Timeout=300,
-                Role=role,
-                MemorySize=memory_size
-            )
-        else:
+        if "ResourceNotFoundException" not in "%s" % e:
             raise e
-
-def recursively_add_files_to_zip(source_path, zipfile, base=""):
+        deployed = None
+
+    if deployed is None:
+        print("Creating lambda function %s" % name)
+        with open(zipfilepath, 'rb') as f:
+            client.create_function(FunctionName=name, Code={'ZipFile': f.read()}, **configuration)
+        return
+
+    if deployed.get('CodeSha256') == file_sha256(zipfilepath):
+        print("Lambda function %s code unchanged" % name)
+    else:
+        print("Updating lambda function %s code" % name)
+        with open(zipfilepath, 'rb') as f:
+            client.update_function_code(FunctionName=name, ZipFile=f.read())
+
+    deployed = dict(deployed)
+    deployed["Layers"] = [layer['Arn'] for layer in deployed.get('Layers', [])]
+    if any(deployed.get(key) != value for key, value in configuration.items()):
+        print("Updating lambda function %s configuration" % name)
+        client.update_function_configuration(FunctionName=name, **configuration)
+
+def package_excluded(filename):
     exclude = ["__pycache__", "lambda_package.zip", ".*pyc", ".*rst",
-               ".*txt", ".*pyo", ".*zip", ".*~", ".*exe", "^[.#]+"]
+               ".*txt", ".*pyo", ".*zip", ".*~", ".*exe", "^[.#]+.*"]
     whitelist = ["stopwords-en.txt"]
-    for filename in os.listdir(source_path):
-        skip = False
-        for pat in exclude:
-            match = re.match(pat, filename)
-            if match is not None and len(match.group(0)) == len(filename):
-                skip = True
-        if skip and filename not in whitelist:
+    if filename in whitelist:
+        return False
+    for pat in exclude:
+        match = re.match(pat, filename)
+        if match is not None and len(match.group(0)) == len(filename):
+            return True
+    return False
+
+def recursively_list_package_files(source_path, base=""):
+    """
+    Returns sorted (archive name, path) pairs for the files under `source_path`
+    """
+    files = []
+    for filename in sorted(os.listdir(source_path)):
+        if package_excluded(filename):
             continue
-        if os.path.isdir(os.path.join(source_path, filename)) and \
-           not os.path.islink(os.path.join(source_path, filename)):
-            recursively_add_files_to_zip(os.path.join(source_path, filename), zipfile, os.path.join(base, filename))
+        path = os.path.join(source_path, filename)
+        if os.path.isdir(path) and not os.path.islink(path):
+            files += recursively_list_package_files(path, os.path.join(base, filename))
+        else:
+            files.append((os.path.join(base, filename), path))
+    return files
+
+def lambda_env_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda_env")
+
+def lambda_requirements_path():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "lambda_template", "requirements.txt")
+
+def lambda_package_files(source_path, include_dependencies=True, env_path=None):
+    """
+    Returns the (archive name, path) pairs making up the lambda package:
+    antenna itself, the handler template, the dependencies in lambda_env
+    (unless they're shipped as a layer) and the project's own files,
+    in a stable order.
+    """
+    antenna_dir = os.path.dirname(os.path.abspath(__file__))
+    template_dir = os.path.join(antenna_dir, "lambda_template")
+    env_path = env_path or lambda_env_path()
+    source_file = lambda x: "py" in x and "pyc" not in x and "~" not in x and ".#" not in x
+
+    files = []
+    for filename in sorted(os.listdir(antenna_dir)):
+        if source_file(filename) and os.path.isfile(os.path.join(antenna_dir, filename)):
+            files.append(("antenna/%s" % filename, os.path.join(antenna_dir, filename)))
+    for filename in sorted(os.listdir(template_dir)):
+        if source_file(filename) and os.path.isfile(os.path.join(template_dir, filename)):
+            files.append((filename, os.path.join(template_dir, filename)))
+    if include_dependencies and os.path.isdir(env_path):
+        files += recursively_list_package_files(env_path)
+    if source_path is not None:
+        files += recursively_list_package_files(source_path)
+    if not include_dependencies:
+        env_prefix = os.path.join(os.path.abspath(env_path), "")
+        files = [(arcname, path) for arcname, path in files
+                 if not os.path.abspath(path).startswith(env_prefix)]
+
+    # Later entries win, as they did when files were appended to the zip
+    deduplicated = dict(files)
+    return sorted(deduplicated.items())
+
+def package_manifest(files, previous=None):
+    """
+    Maps each archive name to the size, mtime and SHA-256 of its file.
+    Hashes from `previous` are reused for files whose size and mtime match.
+    """
+    previous = previous or {}
+    manifest = {}
+    for arcname, path in files:
+        st = os.stat(path)
+        entry = previous.get(arcname)
+        if entry is not None and entry["path"] == path and \
+           entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+            manifest[arcname] = entry
         else:
-            zipfile.write(os.path.join(source_path, filename), os.path.join(base, filename))
+            manifest[arcname] = {"path": path, "size": st.st_size,
+                                 "mtime": st.st_mtime_ns, "sha256": file_sha256(path)}
+    return manifest
+
+def manifest_digest(manifest):
+    h = hashlib.sha256()
+    for arcname in sorted(manifest.keys()):
+        mode = 0o755 if os.access(manifest[arcname]["path"], os.X_OK) else 0o644
+        h.update(("%s %o %s\n" % (arcname, mode, manifest[arcname]["sha256"])).encode('utf-8'))
+    return h.hexdigest()
+
+def write_package_zip(zipfilepath, files, block_size=1024 * 1024):
+    """
+    Writes `files` to a zip with fixed timestamps and permissions,
+    so the same inputs always give a byte-identical zip
+    """
+    with ZipFile(zipfilepath, 'w', ZIP_DEFLATED) as zipfile:
+        for arcname, path in files:
+            info = ZipInfo(arcname, date_time=ZIP_EPOCH)
+            info.compress_type = ZIP_DEFLATED
+            mode = 0o755 if os.access(path, os.X_OK) else 0o644
+            info.external_attr = (0o100000 | mode) << 16
+            with open(path, 'rb') as src, zipfile.open(info, 'w') as dst:
+                for block in iter(lambda: src.read(block_size), b""):
+                    dst.write(block)
+
+def build_zip(zipfilepath, files):
+    """
+    Builds a reproducible zip of `files` at `zipfilepath`.
+
+    A manifest of the packaged files is kept alongside the zip. Files whose
+    size and mtime haven't changed aren't rehashed, and if no file has
+    changed the existing zip is reused rather than rebuilt.
+    """
+    manifest_path = "%s.manifest.json" % zipfilepath
+    previous = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            previous = json.load(f)
+
+    manifest = package_manifest(files, previous.get("files"))
+    digest = manifest_digest(manifest)
+    if previous.get("digest") == digest and os.path.isfile(zipfilepath):
+        print("%s unchanged, reusing it" % zipfilepath)
+        return zipfilepath
+
+    print("Building %s from %d files" % (zipfilepath, len(files)))
+    tmp_path = "%s.tmp" % zipfilepath
+    write_package_zip(tmp_path, files)
+    os.replace(tmp_path, zipfilepath)
+    with open(manifest_path, 'w') as f:
+        json.dump({"digest": digest, "files": manifest}, f)
+    return zipfilepath
+
+def lambda_build_dir(source_path):
+    build_dir = os.path.join(source_path, LAMBDA_BUILD_DIR)
+    if not os.path.isdir(build_dir):
+        os.makedirs(build_dir)
+    return build_dir
 
 def cleanup_lambda_package(source_path=None):
     if source_path is None:
         source_path = os.path.dirname(os.path.abspath(__file__))
-    os.remove(os.path.join(source_path, "lambda_package.zip"))
+    shutil.rmtree(os.path.join(source_path, LAMBDA_BUILD_DIR), ignore_errors=True)
 
-def create_lambda_package(source_path=None):
+def create_lambda_package(source_path=None, include_dependencies=True, env_path=None):
+    """
+    Builds the lambda package in LAMBDA_BUILD_DIR under `source_path`,
+    returning its path. With `include_dependencies=False` the package holds
+    only antenna and the project's code, for use with the dependency layer.
+    """
     if source_path is None:
         source_path = os.path.dirname(os.path.abspath(__file__))
+    name = "lambda_package.zip" if include_dependencies else "lambda_function.zip"
+    return build_zip(os.path.join(lambda_build_dir(source_path), name),
+                     lambda_package_files(source_path, include_dependencies, env_path))
 
-    zipfilepath = os.path.join(source_path, "lambda_package.zip")
-    if os.path.isfile(zipfilepath):
-        os.remove(zipfilepath)
+def create_lambda_layer(source_path=None, env_path=None, requirements_path=None):
+    """
+    Builds the third party dependencies in lambda_env into a layer zip,
+    with every file under python/ as Lambda expects.
 
-    files = os.listdir(source_path)
-    antenna_dir = os.path.dirname(os.path.abspath(__file__))
-    antenna_files = os.listdir(antenna_dir)
-    antenna_files = filter(lambda x: "py" in x and "pyc" not in x and "~" not in x and ".#" not in x
-                           , antenna_files)
-    template_files = os.listdir(os.path.join(antenna_dir, "lambda_template/"))
-    template_files = filter(lambda x: "py" in x and "pyc" not in x and "~" not in x and ".#" not in x
-                            , template_files)
-
-    with ZipFile(zipfilepath, 'w') as zipfile:
-        for filename in antenna_files:
-            zipfile.write(os.path.join(antenna_dir, filename), "antenna/%s" % filename)
-        for filename in template_files:
-            zipfile.write(os.path.join(antenna_dir, "lambda_template", filename), filename)
-        recursively_add_files_to_zip(os.path.join(antenna_dir, "lambda_env/"), zipfile)
-        if source_path is not None:
-            recursively_add_files_to_zip(source_path, zipfile)
-    return zipfilepath
+    Returns (path, key), where key is a hash of the requirements and the
+    installed files. The zip is named after its key, so it's only rebuilt
+    when the dependencies change. Returns None if there is no lambda_env.
+    """
+    if source_path is None:
+        source_path = os.path.dirname(os.path.abspath(__file__))
+    env_path = env_path or lambda_env_path()
+    requirements_path = requirements_path or lambda_requirements_path()
+    if not os.path.isdir(env_path):
+        return None
+
+    files = [(os.path.join("python", arcname), path)
+             for arcname, path in recursively_list_package_files(env_path)]
+    h = hashlib.sha256()
+    if os.path.isfile(requirements_path):
+        with open(requirements_path, 'rb') as f:
+            h.update(f.read())
+    manifest_path = os.path.join(lambda_build_dir(source_path), "layer.manifest.json")
+    previous = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            previous = json.load(f)
+    manifest = package_manifest(files, previous.get("files"))
+    with open(manifest_path, 'w') as f:
+        json.dump({"files": manifest}, f)
+    h.update(manifest_digest(manifest).encode('utf-8'))
+    key = h.hexdigest()[0:32]
+
+    zipfilepath = os.path.join(lambda_build_dir(source_path), "layer-%s.zip" % key)
+    if not os.path.isfile(zipfilepath):
+        print("Building dependency layer %s" % key)
+        tmp_path = "%s.tmp" % zipfilepath
+        write_package_zip(tmp_path, files)
+        os.replace(tmp_path, zipfilepath)
+    return zipfilepath, key
+
+def publish_lambda_layer(client, layer_name, zipfilepath, key, runtime="python3.6"):
+    """
+    Publishes the layer zip unless a version with the same key has already
+    been published, returning the layer version ARN
+    """
+    description = "antenna dependencies %s" % key
+    args = {"LayerName": layer_name}
+    while True:
+        try:
+            res = client.list_layer_versions(**args)
+        except Exception as e:
+            if "ResourceNotFoundException" not in "%s" % e:
+                raise e
+            break
+        for version in res.get('LayerVersions', []):
+            if version.get('Description') == description:
+                print("Dependency layer %s unchanged" % layer_name)
+                return version['LayerVersionArn']
+        if 'NextMarker' not in res:
+            break
+        args['Marker'] = res['NextMarker']
+
+    print("Publishing dependency layer %s" % layer_name)
+    with open(zipfilepath, 'rb') as f:
+        res = client.publish_layer_version(LayerName=layer_name,
+                                           Description=description,
+                                           Content={'ZipFile': f.read()},
+                                           CompatibleRuntimes=[runtime])
+    return res['LayerVersionArn']
@@ -1,35 +1,107 @@
 import os
 import json
+import time
+import hashlib
+import threading
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from antenna.Transformers import Item
 from antenna.Storage import DynamoDBStorage
+import antenna.util as util
 
 class DataMapper():
     def __init__(self, controller):
         self.controller = controller
         self.resource_manager = controller._resource_manager
 
+    @staticmethod
+    def checkpoint_id(dynamodb_table_name, transformer_type, required_null_field, segments):
+        """
+        Checkpoints are only resumed by a backfill over the same table,
+        transformer, filter and number of segments
+        """
+        h = hashlib.md5()
+        h.update(json.dumps([dynamodb_table_name, transformer_type,
+                             required_null_field or None, segments]).encode('utf-8'))
+        return "Backfill" + h.hexdigest()
+
+    def load_checkpoint(self, checkpoint_id, checkpoint_path=None):
+        """
+        Load a backfill checkpoint from `checkpoint_path` if given, or from
+        the source state table otherwise. Returns None if there is none.
+        """
+        if checkpoint_path is not None:
+            if not os.path.isfile(checkpoint_path):
+                return None
+            with open(checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+            if checkpoint.get('checkpoint_id') != checkpoint_id:
+                raise RuntimeError("Checkpoint file %s belongs to a different backfill" %
+                                   checkpoint_path)
+            return checkpoint
+
+        ddb = self.controller._aws_manager.get_client('dynamodb')
+        res = ddb.get_item(TableName=self.resource_manager.dynamo_table_name("source_state"),
+                           Key={"source_config_hash": {'S': checkpoint_id}})
+        if 'Item' not in res:
+            return None
+        return json.loads(res['Item']['checkpoint']['S'])
+
+    def save_checkpoint(self, checkpoint, checkpoint_path=None):
+        body = json.dumps(checkpoint)
+        if checkpoint_path is not None:
+            tmp_path = "%s.tmp" % checkpoint_path
+            with open(tmp_path, 'w') as f:
+                f.write(body)
+            os.replace(tmp_path, checkpoint_path)
+            return
+
+        ddb = self.controller._aws_manager.get_client('dynamodb')
+        ddb.put_item(TableName=self.resource_manager.dynamo_table_name("source_state"),
+                     Item={"source_config_hash": {'S': checkpoint['checkpoint_id']},
+                           "checkpoint": {'S': body}})
+
     def local_backfill(self,
                        dynamodb_table_name,
                        output_item_type,
                        transformer_type,
                        required_null_field="",
                        limit=False,
-                       verbose=True
+                       verbose=True,
+                       segments=1,
+                       workers=4,
+                       max_in_flight_per_worker=4,
+                       resume=False,
+                       checkpoint_path=None,
+                       checkpoint_interval=30
     ):
-        client = self.controller._aws_manager.get_client('dynamodb')
-
-        resp = None
+        """
+        Run a transformer over every row of a DynamoDB table.
 
-        if(required_null_field == None):
-            resp = client.scan(TableName=dynamodb_table_name)
-        else:
-            resp = client.scan(
-                TableName=dynamodb_table_name,
-                FilterExpression="attribute_not_exists(" +
-                required_null_field + ")")
+        The table is read with a parallel scan split into `segments` segments.
+        Each page of rows is split into batches of the controller's
+        `transformer_batch_size`, which are transformed with
+        run_transformer_batch by a pool of `workers` threads. Segments stop
+        reading once `workers * max_in_flight_per_worker` batches are waiting
+        to be transformed, so memory use stays bounded on large tables.
+        At most `limit` rows are transformed, if given.
 
-        last_evaluated_key = resp['LastEvaluatedKey']
+        Stages are flushed once per page, after all of its batches finish.
+        Every `checkpoint_interval` seconds, the position of each segment and
+        the counters are saved to `checkpoint_path`, or to the source state
+        table if no path is given. A segment's position only advances once
+        every row of the page before it has been processed and flushed, so
+        with `resume` an interrupted backfill picks up where it left off,
+        redoing at most one page per segment.
 
+        Returns counts of rows scanned, transformed, filtered, failed and of
+        storage writes, plus throughput for this run. Counts are only added
+        to the checkpoint along with the page they belong to, so a page
+        redone after resuming isn't counted twice. Rows processed in pages
+        which weren't checkpointed, such as the last page read before
+        reaching `limit`, are reported as `uncommitted_rows`; they're
+        included in the counts, but will be processed again on resume.
+        """
         # Note that this selection mechanism will be incorrect
         # if multiple transformers of the same type are present
         transformer_config = {}
@@ -37,28 +109,142 @@ class DataMapper():
             if conf['type'] == transformer_type:
                 transformer_config = conf
 
-        i = 0
-        while last_evaluated_key is not None:
-            print("Continuing scan...")
-
-            for item in resp['Items']:
-                d = DynamoDBStorage.from_dynamo_dict(item)
-                transformed = self.controller.run_transformer_job(transformer_config,
-                                                    Item(payload=d),
-                                                    os.getcwd())
-                print(json.dumps(transformed.payload, indent=4)[0:100])
-                i += 1
-                print("Transformed " + str(i) + " items")
-
-            if(required_null_field == None):
-                resp = client.scan(
-                    ExclusiveStartKey=last_evaluated_key,
-                    TableName=dynamodb_table_name)
-            else:
-                resp = client.scan(
-                    TableName=dynamodb_table_name,
-                    ExclusiveStartKey=last_evaluated_key,
-                    FilterExpression="attribute_not_exists(" +
-                    required_null_field + ")")
-
-            last_evaluated_key = resp['LastEvaluatedKey']
+        scan_args = {"TableName": dynamodb_table_name,
+                     "TotalSegments": segments}
+        if required_null_field:
+            scan_args["FilterExpression"] = "attribute_not_exists(#NULLFIELD)"
+            scan_args["ExpressionAttributeNames"] = {"#NULLFIELD": required_null_field}
+
+        counters = ["rows_scanned", "transformed", "filtered", "stored", "failed"]
+        checkpoint = None
+        if resume:
+            checkpoint = self.load_checkpoint(
+                DataMapper.checkpoint_id(dynamodb_table_name, transformer_type,
+                                         required_null_field, segments),
+                checkpoint_path)
+        if checkpoint is None:
+            checkpoint = {
+                "checkpoint_id": DataMapper.checkpoint_id(dynamodb_table_name, transformer_type,
+                                                          required_null_field, segments),
+                "segments": {str(segment): {"last_evaluated_key": None, "done": False}
+                             for segment in range(segments)},
+                "stats": {counter: 0 for counter in counters}
+            }
+        else:
+            print("Resuming backfill from checkpoint: %s" % json.dumps(checkpoint["stats"]))
+
+        stats = checkpoint["stats"]
+        uncommitted = {counter: 0 for counter in counters}
+        rows_claimed = [0]
+        lock = threading.Lock()
+        checkpoint_lock = threading.Lock()
+        last_checkpoint = [time.time()]
+        in_flight = threading.BoundedSemaphore(workers * max_in_flight_per_worker)
+        batch_size = max(1, self.controller.transformer_batch_size)
+        source_path = os.getcwd()
+        # Clients are created up front rather than by each scanning thread
+        client = self.controller._aws_manager.get_client('dynamodb')
+        start = time.time()
+
+        def add_counts(total, counts):
+            for counter in counts:
+                total[counter] += counts[counter]
+
+        def write_checkpoint(force=False):
+            with checkpoint_lock:
+                if not force and time.time() - last_checkpoint[0] < checkpoint_interval:
+                    return
+                with lock:
+                    snapshot = json.loads(json.dumps(checkpoint))
+                self.save_checkpoint(snapshot, checkpoint_path)
+                last_checkpoint[0] = time.time()
+
+        def transform_batch(rows, page_counts):
+            counts = {}
+            try:
+                outputs = self.controller.run_transformer_batch(transformer_config,
+                                                                [Item(payload=d) for d in rows],
+                                                                source_path,
+                                                                flush=False,
+                                                                stats=counts)
+                if verbose:
+                    for transformed in outputs:
+                        print(json.dumps(transformed.payload, indent=4)[0:100])
+            except Exception as e:
+                print("Error: failed to transform %d rows with exception %s" % (len(rows), e))
+                counts = {"failed": len(rows)}
+            with lock:
+                add_counts(page_counts, counts)
+            if verbose:
+                print("Transformed %d rows" % len(rows))
+
+        def claim_rows(n):
+            """
+            Count up to `n` rows against the limit, returning how many may be processed
+            """
+            with lock:
+                if limit:
+                    n = max(0, min(n, limit - rows_claimed[0]))
+                rows_claimed[0] += n
+                return n
+
+        def scan_segment(segment, pool):
+            progress = checkpoint["segments"][str(segment)]
+            if progress["done"]:
+                return
+            args = dict(scan_args, Segment=segment)
+            if progress["last_evaluated_key"] is not None:
+                args["ExclusiveStartKey"] = progress["last_evaluated_key"]
+            while True:
+                resp = client.scan(**args)
+                claimed = claim_rows(len(resp['Items']))
+                rows = [DynamoDBStorage.from_dynamo_dict(row) for row in resp['Items'][:claimed]]
+                page_counts = {counter: 0 for counter in counters}
+                page_counts["rows_scanned"] = claimed
+                page = []
+                for batch in util.chunks(rows, batch_size):
+                    in_flight.acquire()
+                    job = pool.submit(transform_batch, batch, page_counts)
+                    job.add_done_callback(lambda job: in_flight.release())
+                    page.append(job)
+
+                # Only move the checkpoint past this page once it's fully processed
+                # and everything it stored has been written
+                concurrent.futures.wait(page)
+                self.controller.flush_stages()
+                if claimed < len(resp['Items']):
+                    with lock:
+                        add_counts(uncommitted, page_counts)
+                    return
+                with lock:
+                    add_counts(stats, page_counts)
+                    if 'LastEvaluatedKey' in resp:
+                        progress["last_evaluated_key"] = resp['LastEvaluatedKey']
+                    else:
+                        progress["done"] = True
+                write_checkpoint()
+                if progress["done"]:
+                    return
+                if verbose:
+                    print("Continuing scan of segment %d..." % segment)
+                args["ExclusiveStartKey"] = resp['LastEvaluatedKey']
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            with ThreadPoolExecutor(max_workers=segments) as scanners:
+                scans = [scanners.submit(scan_segment, segment, pool)
+                         for segment in range(segments)]
+                try:
+                    for scan in scans:
+                        scan.result()
+                finally:
+                    write_checkpoint(force=True)
+
+        elapsed = time.time() - start
+        result = dict(stats)
+        add_counts(result, uncommitted)
+        result["uncommitted_rows"] = uncommitted["rows_scanned"]
+        result["number_items_backfilled"] = result["transformed"]
+        result["complete"] = all(p["done"] for p in checkpoint["segments"].values())
+        result["elapsed_seconds"] = elapsed
+        result["rows_per_second"] = rows_claimed[0] / elapsed if elapsed > 0 else 0
+        return result
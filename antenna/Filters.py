@@ -5,10 +5,27 @@ Filters perform post-processing for any source or transformer.
 Filters simply remove items from the pipeline, and are executed
 immediately after item production.
 """
+import os
+import json
+import math
+import time
+import struct
+import decimal
+import hashlib
+import threading
+
+import botocore
 from antenna.Transformers import Transformer
-import redleader.resources as r
 from antenna.ResourceManager import ResourceManager
-from boto3.dynamodb.conditions import Key, Attr
+import antenna.util as util
+
+# BatchGetItem accepts at most 100 keys per call
+DYNAMODB_MAX_BATCH_GET = 100
+
+# Bloom filters are loaded once per process (i.e. per warm lambda container),
+# keyed by where they're persisted
+_bloom_filters = {}
+_bloom_filters_lock = threading.Lock()
 
 
 class Filter(Transformer):
@@ -39,12 +56,130 @@ class Filter(Transformer):
                 raise Exception("Unknown parameter `%s` for filter %s" %
                                 (param, self.__class__.__name__))
 
+    def open(self):
+        """
+        Called once, when the Controller first builds this filter
+        """
+        pass
+
+    def flush(self):
+        """
+        Persist any buffered state. Called by the Controller at the end of
+        each source or transformer job
+        """
+        pass
+
+    def close(self):
+        """
+        Called when the Controller shuts down, after a final flush()
+        """
+        pass
+
     def filter(self):
         raise NotImplementedError
 
+    def filter_many(self, items):
+        """
+        Returns a list of booleans, one per item, indicating which items
+        pass the filter. Filters which can check many items in a single
+        request override this.
+        """
+        return [self.filter(item) for item in items]
+
     def external_resources(self):
         return []
 
+class BloomFilter(object):
+    """
+    A fixed size Bloom filter over string keys, serializable to a compact
+    binary blob.
+
+    `seeded` is set once every key already in the backing table has been
+    added (see UniqueDynamoDBFilter.seed_bloom_filter), and is persisted
+    with the filter. Only seeded filters may be used to skip lookups: an
+    unseeded filter knows nothing about keys written before it existed.
+    """
+    # magic, version, flags, num_hashes, num_bits, count
+    HEADER = struct.Struct(">4sBBBQQ")
+    LEGACY_HEADER = struct.Struct(">4sBBQQ")
+    MAGIC = b"ANBF"
+    VERSION = 2
+    FLAG_SEEDED = 1
+
+    def __init__(self, capacity=100000, error_rate=0.01, num_bits=None, num_hashes=None):
+        if num_bits is None:
+            num_bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        if num_hashes is None:
+            num_hashes = max(1, int(round(float(num_bits) / capacity * math.log(2))))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = 0
+        self.seeded = False
+        self.dirty = False
+        self.persisted_at = time.time()
+        self._bits = bytearray((num_bits + 7) // 8)
+        self._lock = threading.Lock()
+        self.persist_lock = threading.Lock()
+
+    def _indexes(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[0:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        return all(self._bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(key))
+
+    def add(self, key):
+        with self._lock:
+            if key in self:
+                return
+            for i in self._indexes(key):
+                self._bits[i >> 3] |= 1 << (i & 7)
+            self.count += 1
+            self.dirty = True
+
+    def union(self, other):
+        """
+        Add every key in `other`, a filter with identical parameters
+        """
+        if other.num_bits != self.num_bits or other.num_hashes != self.num_hashes:
+            raise RuntimeError("Cannot merge bloom filters with different parameters")
+        with self._lock:
+            for i in range(len(self._bits)):
+                self._bits[i] |= other._bits[i]
+            self.count = max(self.count, other.count)
+            self.seeded = self.seeded or other.seeded
+
+    def to_bytes(self):
+        with self._lock:
+            flags = BloomFilter.FLAG_SEEDED if self.seeded else 0
+            return BloomFilter.HEADER.pack(BloomFilter.MAGIC, BloomFilter.VERSION, flags,
+                                           self.num_hashes, self.num_bits,
+                                           self.count) + bytes(self._bits)
+
+    @staticmethod
+    def from_bytes(blob):
+        magic, version = struct.unpack_from(">4sB", blob)
+        if magic != BloomFilter.MAGIC or version > BloomFilter.VERSION:
+            raise RuntimeError("Unrecognized bloom filter format")
+        if version == 1:
+            # Version 1 filters were never seeded
+            header = BloomFilter.LEGACY_HEADER
+            _, _, num_hashes, num_bits, count = header.unpack_from(blob)
+            flags = 0
+        else:
+            header = BloomFilter.HEADER
+            _, _, flags, num_hashes, num_bits, count = header.unpack_from(blob)
+        bloom = BloomFilter(num_bits=num_bits, num_hashes=num_hashes)
+        bloom._bits = bytearray(blob[header.size:])
+        if len(bloom._bits) != (num_bits + 7) // 8:
+            raise RuntimeError("Truncated bloom filter")
+        bloom.count = count
+        bloom.seeded = bool(flags & BloomFilter.FLAG_SEEDED)
+        return bloom
+
+
 class UniqueDynamoDBFilter(Filter):
     """Filters out any items that are already referenced in DynamoDB
 
@@ -52,7 +187,26 @@ class UniqueDynamoDBFilter(Filter):
     `partition_key_format_string` specifies how to construct the primary DynamoDB key
                                 from a given ArticleReference item
 
-    Currently only supports string keys.
+    Currently only supports string partition keys.
+
+    filter_many() checks up to 100 items per BatchGetItem call. This needs
+    the full primary key, so tables with a `range_key` also need a
+    `range_key_format_string`; otherwise each item is queried separately.
+
+    With `bloom_filter` enabled, every key seen is also recorded in a Bloom
+    filter persisted to `bloom_filter_path` (a local file) or to
+    `bloom_filter_s3_bucket`/`bloom_filter_s3_key`; the Controller picks a
+    local file for local runs and the project's config bucket otherwise.
+    Keys the filter has never seen pass without a DynamoDB read, while
+    possible matches are still checked against the table.
+
+    A filter is only used to skip reads once it has been seeded with a full
+    scan of the table's keys, which the first process to load it performs.
+    Each flush merges in keys persisted by other processes, using a
+    conditional write so concurrent writers don't drop each other's keys,
+    at most once every `bloom_filter_flush_seconds`. Rows written to the
+    table since a process last merged, by other processes or by anything
+    other than this filter's pipeline, are invisible to it.
     """
     def __init__(self, aws_manager, params):
         self._required_keywords = [
@@ -63,17 +217,34 @@ class UniqueDynamoDBFilter(Filter):
         self._optional_keywords = [
             "range_key",
             "range_key_type",
-            "range_key_format_string"
+            "range_key_format_string",
+            "bloom_filter",
+            "bloom_filter_capacity",
+            "bloom_filter_error_rate",
+            "bloom_filter_path",
+            "bloom_filter_s3_bucket",
+            "bloom_filter_s3_key",
+            "bloom_filter_flush_seconds"
         ]
         self._defaults = {
-            "range_key_type": "N"
+            "range_key_type": "N",
+            "bloom_filter": False,
+            "bloom_filter_capacity": 200000,
+            "bloom_filter_error_rate": 0.01,
+            "bloom_filter_path": None,
+            "bloom_filter_s3_bucket": None,
+            "bloom_filter_s3_key": None,
+            "bloom_filter_flush_seconds": 30
         }
         super(UniqueDynamoDBFilter, self).__init__(aws_manager, params)
+        if self.bloom_filter_s3_key is None:
+            self.bloom_filter_s3_key = "bloom_filters/%s.bloom" % self.dynamodb_table_name
 
     def external_resources(self):
+        import redleader.resources as r
         table_config = ResourceManager.dynamo_key_schema(
             self.partition_key,
-            range_key_name=self.range_key,
+            range_key_name=getattr(self, "range_key", None),
             range_key_type=self.range_key_type
         )
         table_resource = r.DynamoDBTableResource(
@@ -97,6 +268,287 @@ class UniqueDynamoDBFilter(Filter):
             base = base.replace("{%s}" % k, str(item.payload[k]))
         return base
 
+    def format_range_key(self, item):
+        base = self.range_key_format_string
+        for k in item.payload:
+            base = base.replace("{%s}" % k, str(item.payload[k]))
+        return base
+
+    def can_batch_get(self):
+        return getattr(self, "range_key", None) is None or \
+            getattr(self, "range_key_format_string", None) is not None
+
+    def ddb_key(self, item):
+        """
+        The full DynamoDB primary key for the given item
+        """
+        key = {self.partition_key: {'S': self.format_key(item)}}
+        if getattr(self, "range_key", None) is not None:
+            key[self.range_key] = {self.range_key_type: self.format_range_key(item)}
+        return key
+
+    @staticmethod
+    def key_id(key):
+        """
+        A hashable representation of a DynamoDB key, with numbers normalized
+        so keys we build compare equal to keys returned by DynamoDB
+        """
+        normalized = {}
+        for attr in key:
+            ty = list(key[attr].keys())[0]
+            value = key[attr][ty]
+            if ty == 'N':
+                value = str(decimal.Decimal(value).normalize())
+            normalized[attr] = [ty, value]
+        return json.dumps(normalized, sort_keys=True)
+
+    def bloom_filter_location(self):
+        if self.bloom_filter_path is not None:
+            return self.bloom_filter_path
+        if self.bloom_filter_s3_bucket is None:
+            raise RuntimeError("bloom_filter requires bloom_filter_path or bloom_filter_s3_bucket")
+        return "s3://%s/%s" % (self.bloom_filter_s3_bucket, self.bloom_filter_s3_key)
+
+    def read_bloom_filter(self):
+        """
+        Read the persisted bloom filter, returning None if there isn't one
+        """
+        if self.bloom_filter_path is not None:
+            if not os.path.isfile(self.bloom_filter_path):
+                return None
+            with open(self.bloom_filter_path, 'rb') as f:
+                return BloomFilter.from_bytes(f.read())
+        return self.read_s3_bloom_filter()[0]
+
+    def read_s3_bloom_filter(self):
+        """
+        Returns the bloom filter persisted to S3 and its ETag, or (None, None)
+        """
+        client = self._aws_manager.get_client('s3')
+        try:
+            res = client.get_object(Bucket=self.bloom_filter_s3_bucket,
+                                    Key=self.bloom_filter_s3_key)
+        except botocore.exceptions.ClientError as e:
+            if "NoSuchKey" not in str(e):
+                raise e
+            return None, None
+        return BloomFilter.from_bytes(res['Body'].read()), res['ETag']
+
+    def merge_bloom_filter_file(self, bloom):
+        """
+        Merge the bloom filter file into `bloom` and write the result back,
+        holding a lock on the file so concurrent local runs don't drop keys.
+        File locking needs a POSIX platform.
+        """
+        import fcntl
+        with open(self.bloom_filter_path + ".lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                persisted = self.read_bloom_filter()
+                if persisted is not None:
+                    bloom.union(persisted)
+                tmp_path = "%s.tmp%d" % (self.bloom_filter_path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    f.write(bloom.to_bytes())
+                os.replace(tmp_path, self.bloom_filter_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def merge_bloom_filter_s3(self, bloom, max_retries=8):
+        """
+        Merge the bloom filter persisted to S3 into `bloom` and write the
+        result back, only if no other process has written it in between
+        """
+        client = self._aws_manager.get_client('s3')
+        for attempt in range(max_retries + 1):
+            persisted, etag = self.read_s3_bloom_filter()
+            if persisted is not None:
+                bloom.union(persisted)
+            if etag is not None:
+                condition = {'IfMatch': etag}
+            else:
+                condition = {'IfNoneMatch': '*'}
+            try:
+                client.put_object(Bucket=self.bloom_filter_s3_bucket,
+                                  Key=self.bloom_filter_s3_key,
+                                  Body=bloom.to_bytes(),
+                                  **condition)
+                return
+            except botocore.exceptions.ClientError as e:
+                if "PreconditionFailed" not in str(e) and \
+                   "ConditionalRequestConflict" not in str(e):
+                    raise e
+                print("Bloom filter at %s changed while persisting. Retrying." %
+                      self.bloom_filter_location())
+            util.backoff_sleep(attempt)
+        raise RuntimeError("Failed to persist bloom filter to %s after %d retries" %
+                           (self.bloom_filter_location(), max_retries))
+
+    def persist_bloom_filter(self, bloom):
+        """
+        Write `bloom` back to where it's persisted, merging in keys
+        persisted concurrently by other processes
+        """
+        with bloom.persist_lock:
+            bloom.dirty = False
+            bloom.persisted_at = time.time()
+            try:
+                if self.bloom_filter_path is not None:
+                    self.merge_bloom_filter_file(bloom)
+                else:
+                    self.merge_bloom_filter_s3(bloom)
+            except Exception as e:
+                bloom.dirty = True
+                raise e
+        print("Persisted bloom filter to %s (%d keys)" % (self.bloom_filter_location(), bloom.count))
+
+    def row_key_id(self, row):
+        """
+        The id filter_many() uses for the item stored in `row`
+        """
+        if self.can_batch_get():
+            return UniqueDynamoDBFilter.key_id(row)
+        return row[self.partition_key]['S']
+
+    def seed_bloom_filter(self, bloom):
+        """
+        Add the key of every row in the table to `bloom` with a full table
+        scan, after which it can be used to skip lookups
+        """
+        ddb = self._aws_manager.get_client('dynamodb')
+        key_attributes = [self.partition_key]
+        if getattr(self, "range_key", None) is not None:
+            key_attributes.append(self.range_key)
+        names = {"#K%d" % i: attr for i, attr in enumerate(key_attributes)}
+        args = {
+            'TableName': self.dynamodb_table_name,
+            'ProjectionExpression': ", ".join(sorted(names.keys())),
+            'ExpressionAttributeNames': names
+        }
+        rows = 0
+        while True:
+            res = ddb.scan(**args)
+            for row in res.get('Items', []):
+                bloom.add(self.row_key_id(row))
+            rows += len(res.get('Items', []))
+            if 'LastEvaluatedKey' not in res:
+                break
+            args['ExclusiveStartKey'] = res['LastEvaluatedKey']
+        bloom.seeded = True
+        print("Seeded bloom filter with %d keys from table %s" % (rows, self.dynamodb_table_name))
+
+    def get_bloom_filter(self):
+        """
+        Returns this filter's bloom filter, loading it at most once per process.
+        Filters which haven't been seeded yet are seeded and persisted first.
+        """
+        if not self.bloom_filter:
+            return None
+        location = self.bloom_filter_location()
+        with _bloom_filters_lock:
+            if location not in _bloom_filters:
+                bloom = self.read_bloom_filter()
+                if bloom is None:
+                    print("Creating new bloom filter at %s" % location)
+                    bloom = BloomFilter(capacity=self.bloom_filter_capacity,
+                                        error_rate=self.bloom_filter_error_rate)
+                else:
+                    print("Loaded bloom filter from %s (%d keys)" % (location, bloom.count))
+                if not bloom.seeded:
+                    self.seed_bloom_filter(bloom)
+                    self.persist_bloom_filter(bloom)
+                _bloom_filters[location] = bloom
+            return _bloom_filters[location]
+
+    def flush(self, force=False):
+        """
+        Persist the bloom filter if keys were added since it was last
+        persisted, at most once every `bloom_filter_flush_seconds` unless
+        `force` is set
+        """
+        bloom = self.get_bloom_filter()
+        if bloom is None or not bloom.dirty:
+            return
+        if not force and time.time() - bloom.persisted_at < self.bloom_filter_flush_seconds:
+            return
+        self.persist_bloom_filter(bloom)
+
+    def close(self):
+        self.flush(force=True)
+
+    def existing_keys(self, keys, max_retries=8):
+        """
+        Returns the ids (see key_id) of the given keys which exist in the table
+        """
+        ddb = self._aws_manager.get_client('dynamodb')
+        key_attributes = list(keys[0].keys()) if len(keys) > 0 else []
+        names = {"#K%d" % i: attr for i, attr in enumerate(key_attributes)}
+        existing = set()
+        for chunk in util.chunks(keys, DYNAMODB_MAX_BATCH_GET):
+            request_items = {
+                self.dynamodb_table_name: {
+                    'Keys': chunk,
+                    'ProjectionExpression': ", ".join(sorted(names.keys())),
+                    'ExpressionAttributeNames': names
+                }
+            }
+            attempt = 0
+            while len(request_items) > 0:
+                res = ddb.batch_get_item(RequestItems=request_items)
+                for row in res.get('Responses', {}).get(self.dynamodb_table_name, []):
+                    existing.add(UniqueDynamoDBFilter.key_id(row))
+                request_items = res.get('UnprocessedKeys', {})
+                if len(request_items) == 0:
+                    break
+                if attempt >= max_retries:
+                    raise RuntimeError("Failed to check %d keys in table %s after %d retries" %
+                                       (len(request_items[self.dynamodb_table_name]['Keys']),
+                                        self.dynamodb_table_name, attempt))
+                util.backoff_sleep(attempt)
+                attempt += 1
+        return existing
+
+    def filter_many(self, items):
+        """
+        Filters a batch of items with as few DynamoDB requests as possible.
+        Only the first of several items sharing a key can pass, just as if the
+        items had been filtered and stored one at a time.
+        """
+        if self.can_batch_get():
+            ids = [UniqueDynamoDBFilter.key_id(self.ddb_key(item)) for item in items]
+        else:
+            ids = [self.format_key(item) for item in items]
+        items_by_id = dict(zip(ids, items))
+
+        # Keys a seeded bloom filter has never seen can't be in the table
+        bloom = self.get_bloom_filter()
+        to_check = items_by_id
+        if bloom is not None and bloom.seeded:
+            to_check = {key_id: item for key_id, item in items_by_id.items() if key_id in bloom}
+            print("Bloom filter skipped %d of %d lookups" %
+                  (len(items_by_id) - len(to_check), len(items_by_id)))
+
+        existing = set()
+        if len(to_check) == 0:
+            pass
+        elif self.can_batch_get():
+            existing = self.existing_keys([self.ddb_key(item) for item in to_check.values()])
+        else:
+            for key_id, item in to_check.items():
+                if self.ddb_row_exists(item):
+                    existing.add(key_id)
+
+        results = []
+        seen = set()
+        for key_id in ids:
+            results.append(key_id not in existing and key_id not in seen)
+            seen.add(key_id)
+
+        if bloom is not None:
+            for key_id in items_by_id:
+                bloom.add(key_id)
+        return results
+
     def ddb_row_exists(self, item):
         ddb = self._aws_manager.get_client('dynamodb')
         res = ddb.query(
@@ -116,4 +568,4 @@ class UniqueDynamoDBFilter(Filter):
         return 'Items' in res and len(res['Items']) > 0
 
     def filter(self, item):
-        return not self.ddb_row_exists(item)
+        return self.filter_many([item])[0]
@@ -0,0 +1,202 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+"""
+Runs a project's sources and transformers in a single process, for
+`antenna local` and integration tests.
+
+Transformers are wired together by item type: every item produced is
+handed to each transformer whose input_item_types include its type.
+Each transformer has a bounded queue feeding a pool of worker threads,
+so a fast producer blocks rather than buffering without limit, and all
+stages run concurrently.
+"""
+import copy
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from antenna.Sources import Item
+
+# Sentinel telling a stage's workers to exit
+_STOP = object()
+
+class PipelineStage(object):
+    def __init__(self, config, transformer, queue_size):
+        self.config = config
+        self.transformer = transformer
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        self.processed = 0
+        self.produced = 0
+        self.failed = 0
+
+class LocalPipeline(object):
+    def __init__(self, controller, source_path, workers=None, queue_size=None,
+                 batch_size=None, verbose=True):
+        self.controller = controller
+        self.source_path = source_path
+        self.workers = workers or controller.local_pipeline_workers
+        self.queue_size = queue_size or controller.local_pipeline_queue_size
+        self.batch_size = batch_size or controller.transformer_batch_size
+        self.verbose = verbose
+
+        self.stages = []
+        self.subscribers = {}
+        for config in controller.config['transformers']:
+            transformer = controller.get_transformer(config, source_path)
+            stage = PipelineStage(config, transformer, self.queue_size)
+            self.stages.append(stage)
+            for item_type in transformer.input_item_types:
+                self.subscribers.setdefault(item_type, []).append(stage)
+        self.check_acyclic()
+
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self.source_items = 0
+        self.dropped = 0
+
+    def check_acyclic(self):
+        """
+        Bounded queues can deadlock if a transformer's output can flow back
+        to it, so reject transformer graphs with cycles
+        """
+        def downstream(stage):
+            return [s for t in stage.transformer.output_item_types
+                    for s in self.subscribers.get(t, [])]
+
+        visiting = set()
+        done = set()
+        def visit(stage):
+            if id(stage) in done:
+                return
+            if id(stage) in visiting:
+                raise Exception("Transformer %s is part of a cycle of item types" %
+                                stage.config['type'])
+            visiting.add(id(stage))
+            for s in downstream(stage):
+                visit(s)
+            visiting.remove(id(stage))
+            done.add(id(stage))
+        for stage in self.stages:
+            visit(stage)
+
+    def _begin(self, n=1):
+        with self._cond:
+            self._in_flight += n
+
+    def _end(self, n=1):
+        with self._cond:
+            self._in_flight -= n
+            if self._in_flight == 0:
+                self._cond.notify_all()
+
+    def publish(self, item):
+        """
+        Hand `item` to every transformer subscribed to its type, blocking
+        while their queues are full
+        """
+        stages = self.subscribers.get(item.item_type, [])
+        if len(stages) == 0:
+            with self._cond:
+                self.dropped += 1
+            return
+        # Count the item before queueing it, so the pipeline can't appear
+        # idle between an item being queued and picked up
+        self._begin(len(stages))
+        # Stages run concurrently and may modify payloads in place, so each
+        # gets its own copy, taken before any stage can see the item
+        items = [item] + [Item(item_type=item.item_type, payload=copy.deepcopy(item.payload))
+                          for _ in stages[1:]]
+        for stage, stage_item in zip(stages, items):
+            stage.queue.put(stage_item)
+
+    def take_batch(self, stage):
+        """
+        Block for one item, then take whatever else is already queued,
+        up to the batch size
+        """
+        batch = [stage.queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            try:
+                batch.append(stage.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def work(self, stage):
+        while True:
+            batch = self.take_batch(stage)
+            stop = batch[-1] is _STOP
+            items = [item for item in batch if item is not _STOP]
+            if len(items) > 0:
+                try:
+                    outputs = self.controller.run_transformer_batch(stage.config, items,
+                                                                    self.source_path,
+                                                                    use_queues=False)
+                    with self._cond:
+                        stage.processed += len(items)
+                        stage.produced += len(outputs)
+                    for output in outputs:
+                        if self.verbose:
+                            print("%s produced %s: %s" % (stage.config['type'], output.item_type,
+                                                          json.dumps(output.payload)[:100]))
+                        self.publish(output)
+                except Exception as e:
+                    print("Error: transformer %s failed on a batch of %d items with exception %s" %
+                          (stage.config['type'], len(items), e))
+                    with self._cond:
+                        stage.failed += len(items)
+                finally:
+                    self._end(len(items))
+            if stop:
+                return
+
+    def run_source(self, config):
+        try:
+            items = self.controller.run_source_job(config, use_queues=False)
+            with self._cond:
+                self.source_items += len(items)
+            for item in items:
+                self.publish(item)
+        except Exception as e:
+            print("Error: source %s failed with exception %s" % (config['type'], e))
+        finally:
+            self._end()
+
+    def run(self):
+        """
+        Run every source once and transform everything they produce,
+        returning counts for each stage once the pipeline has drained
+        """
+        for stage in self.stages:
+            for i in range(self.workers):
+                t = threading.Thread(target=self.work, args=[stage])
+                t.daemon = True
+                stage.threads.append(t)
+                t.start()
+
+        sources = self.controller.config['sources']
+        self._begin(len(sources))
+        with ThreadPoolExecutor(max_workers=max(1, self.controller.source_workers)) as pool:
+            for config in sources:
+                pool.submit(self.run_source, config)
+
+            with self._cond:
+                while self._in_flight > 0:
+                    self._cond.wait()
+
+        for stage in self.stages:
+            for t in stage.threads:
+                stage.queue.put(_STOP)
+        for stage in self.stages:
+            for t in stage.threads:
+                t.join()
+        self.controller.flush_stages()
+
+        return {
+            "source_items": self.source_items,
+            "unsubscribed_items": self.dropped,
+            "stages": [{"type": stage.config['type'],
+                        "processed": stage.processed,
+                        "produced": stage.produced,
+                        "failed": stage.failed} for stage in self.stages]
+        }
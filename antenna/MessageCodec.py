@@ -0,0 +1,99 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+"""
+Encodes item payloads as queue message bodies, and decodes them again.
+
+Bodies are compact JSON. With compression enabled, payloads of at least
+`compress_min_bytes` are compressed with zlib (or zstd, if the zstandard
+package is installed) and base64 encoded, and the message carries an
+`antenna-encoding` attribute naming the compression used. Every encoded
+message also carries `antenna-codec-version`.
+
+Messages without these attributes are decoded as plain JSON, so bodies
+sent by earlier versions (including indented JSON) still decode.
+"""
+import json
+import zlib
+import base64
+
+CODEC_VERSION = 1
+VERSION_ATTRIBUTE = "antenna-codec-version"
+ENCODING_ATTRIBUTE = "antenna-encoding"
+COMPRESSIONS = [None, "zlib", "zstd"]
+
+def zstd_available():
+    try:
+        import zstandard
+        return True
+    except ImportError:
+        return False
+
+def attribute_values(attributes):
+    """
+    Normalises message attributes to a {name: string} dict. Accepts SQS
+    style {name: {"StringValue": ..., "DataType": ...}} dicts too.
+    """
+    values = {}
+    for name, value in (attributes or {}).items():
+        if isinstance(value, dict):
+            value = value.get('StringValue')
+        values[name] = value
+    return values
+
+class MessageCodec(object):
+    def __init__(self, compression=None, compress_min_bytes=1024, compress_level=6):
+        if compression not in COMPRESSIONS:
+            raise Exception("Unknown message compression %s. Options are %s" %
+                            (compression, COMPRESSIONS[1:]))
+        if compression == "zstd" and not zstd_available():
+            print("zstandard is not installed. Compressing messages with zlib instead.")
+            compression = "zlib"
+        self.compression = compression
+        self.compress_min_bytes = compress_min_bytes
+        self.compress_level = compress_level
+
+    def compress(self, data):
+        if self.compression == "zstd":
+            import zstandard
+            return zstandard.ZstdCompressor(level=self.compress_level).compress(data)
+        return zlib.compress(data, self.compress_level)
+
+    @staticmethod
+    def decompress(data, encoding):
+        if encoding == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("Received a zstd compressed message, but zstandard is not installed")
+            return zstandard.ZstdDecompressor().decompress(data)
+        if encoding == "zlib":
+            return zlib.decompress(data)
+        raise Exception("Unknown message encoding %s" % encoding)
+
+    def encode(self, payload):
+        """
+        Returns (body, attributes) for a payload
+        """
+        body = json.dumps(payload, separators=(',', ':'))
+        attributes = {VERSION_ATTRIBUTE: str(CODEC_VERSION)}
+        if self.compression is not None and len(body) >= self.compress_min_bytes:
+            compressed = base64.b64encode(self.compress(body.encode('utf-8'))).decode('ascii')
+            # Short or incompressible payloads can grow once base64 encoded
+            if len(compressed) < len(body):
+                attributes[ENCODING_ATTRIBUTE] = self.compression
+                body = compressed
+        return body, attributes
+
+    @staticmethod
+    def decode(body, attributes=None):
+        """
+        Returns the payload of a message body, given its message attributes
+        """
+        attributes = attribute_values(attributes)
+        version = attributes.get(VERSION_ATTRIBUTE)
+        if version is not None and int(version) > CODEC_VERSION:
+            raise Exception("Message codec version %s is newer than supported version %d" %
+                            (version, CODEC_VERSION))
+        encoding = attributes.get(ENCODING_ATTRIBUTE)
+        if encoding is not None:
+            body = MessageCodec.decompress(base64.b64decode(body), encoding).decode('utf-8')
+        return json.loads(body)
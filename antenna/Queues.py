@@ -0,0 +1,575 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+"""
+Helpers for moving items through SQS efficiently.
+
+SQS bills (and costs a network round trip) per request rather than per
+message, so the Controller groups outgoing messages into SendMessageBatch
+calls instead of sending them one at a time, and long-polls for incoming
+messages ten at a time.
+
+The Controller talks to queues through the QueueBackend interface, with
+implementations for SQS, for memory and for local files, so batching and
+polling are written once for every backend.
+"""
+import os
+import json
+import time
+import queue
+import sqlite3
+import threading
+import collections
+
+import antenna.util as util
+
+SQS_MAX_BATCH_MESSAGES = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+SQS_MAX_WAIT_SECONDS = 20
+
+def message_size(body, attributes=None):
+    """
+    Bytes a message counts for against SQS size limits, including
+    its attribute names, types and values
+    """
+    size = len(body.encode('utf-8'))
+    for name, value in (attributes or {}).items():
+        size += len(name.encode('utf-8')) + len("String") + len(value.encode('utf-8'))
+    return size
+
+def sqs_attributes(attributes):
+    return {name: {'DataType': 'String', 'StringValue': value}
+            for name, value in attributes.items()}
+
+class SQSBatchSender(object):
+    """
+    Buffers message bodies destined for a single queue and sends them with
+    SendMessageBatch, respecting the 10 message / 256KB per request limits.
+
+    Entries SQS reports as failed are retried with jittered backoff; entries
+    which were accepted are never resent.
+    """
+    def __init__(self, client, queue_url, max_retries=5):
+        self._client = client
+        self.queue_url = queue_url
+        self.max_retries = max_retries
+        self.sent = 0
+        self._entries = []
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, body, attributes=None):
+        """
+        Buffer a message body, with optional string message attributes,
+        sending the current batch first if this message would push it past
+        either SQS batch limit
+        """
+        size = message_size(body, attributes)
+        if size > SQS_MAX_BATCH_BYTES:
+            raise RuntimeError("Message of %d bytes exceeds the SQS limit of %d bytes" %
+                               (size, SQS_MAX_BATCH_BYTES))
+        with self._lock:
+            if len(self._entries) >= SQS_MAX_BATCH_MESSAGES or \
+               self._bytes + size > SQS_MAX_BATCH_BYTES:
+                self._send(self._take())
+            entry = {'Id': str(len(self._entries)), 'MessageBody': body}
+            if attributes:
+                entry['MessageAttributes'] = sqs_attributes(attributes)
+            self._entries.append(entry)
+            self._bytes += size
+
+    def flush(self):
+        with self._lock:
+            entries = self._take()
+            if len(entries) > 0:
+                self._send(entries)
+
+    def _take(self):
+        entries = self._entries
+        self._entries = []
+        self._bytes = 0
+        return entries
+
+    def _send(self, entries):
+        attempt = 0
+        while True:
+            res = self._client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            self.sent += len(res.get('Successful', []))
+            failed = res.get('Failed', [])
+            if len(failed) == 0:
+                return
+
+            sender_faults = [f for f in failed if f.get('SenderFault', False)]
+            if len(sender_faults) > 0:
+                raise RuntimeError("SQS rejected %d messages for queue %s: %s" %
+                                   (len(sender_faults), self.queue_url,
+                                    sender_faults[0].get('Message', sender_faults[0]['Code'])))
+            if attempt >= self.max_retries:
+                raise RuntimeError("Failed to send %d messages to queue %s after %d retries" %
+                                   (len(failed), self.queue_url, attempt))
+
+            failed_ids = set(f['Id'] for f in failed)
+            entries = [e for e in entries if e['Id'] in failed_ids]
+            print("Retrying %d failed SQS messages for queue %s" % (len(entries), self.queue_url))
+            util.backoff_sleep(attempt)
+            attempt += 1
+
+
+class QueuePoller(object):
+    """
+    Long-polls a queue backend for at most `runtime` seconds, yielding lists
+    of up to ten messages at a time.
+
+    While the queue is empty the pause between polls doubles, up to
+    `max_idle_sleep` seconds, and polling stops early once no message has
+    arrived for `idle_timeout` seconds.
+    """
+    def __init__(self, queue, runtime, wait_time=SQS_MAX_WAIT_SECONDS,
+                 idle_timeout=30, max_idle_sleep=5):
+        self.queue = queue
+        self.runtime = runtime
+        self.wait_time = min(wait_time, SQS_MAX_WAIT_SECONDS)
+        self.idle_timeout = idle_timeout
+        self.max_idle_sleep = max_idle_sleep
+
+    def receive(self, wait):
+        return self.queue.receive(max_messages=SQS_MAX_BATCH_MESSAGES, wait_time=wait)
+
+    def poll(self):
+        start = time.time()
+        last_message = start
+        empty_polls = 0
+        while True:
+            now = time.time()
+            remaining = self.runtime - (now - start)
+            idle_remaining = self.idle_timeout - (now - last_message)
+            if remaining < 1:
+                return
+            if idle_remaining <= 0:
+                print("Queue %s idle for %ds. Stopping." % (self.queue.name, self.idle_timeout))
+                return
+
+            wait = int(max(0, min(self.wait_time, remaining - 1, idle_remaining)))
+            messages = list(self.receive(wait))
+            if len(messages) > 0:
+                empty_polls = 0
+                yield messages
+                # Time spent processing messages doesn't count as idle time
+                last_message = time.time()
+                continue
+
+            idle_sleep = min(self.max_idle_sleep, 0.5 * (2 ** empty_polls),
+                             max(0, self.idle_timeout - (time.time() - last_message)))
+            empty_polls += 1
+            time.sleep(idle_sleep)
+
+
+class LocalQueue(object):
+    """
+    A FIFO queue of message bodies for local and single host runs,
+    standing in for SQS. Each body can carry a dict of string attributes.
+
+    Up to `memory_items` bodies are held in memory. Past that, new bodies
+    are appended to a SQLite file in `spill_dir`, and read back in order as
+    the in-memory head drains, so backlogs can outgrow RAM. Bodies still in
+    the SQLite file when the process exits are picked up by the next queue
+    opened with the same name and directory.
+
+    Like SQS, received messages stay in flight until acked, and become
+    visible again (at the head of the queue) if not acked within their
+    visibility timeout. put() blocks while `max_items` messages, counting
+    those in flight, are queued.
+    """
+    def __init__(self, name, memory_items=1000, max_items=None, spill_dir=None,
+                 visibility_timeout=30):
+        self.name = name
+        self.memory_items = memory_items
+        self.max_items = max_items
+        self.spill_dir = spill_dir
+        self.visibility_timeout = visibility_timeout
+
+        self._memory = collections.deque()
+        self._in_flight = {}
+        self._next_receipt = 0
+        self._db = None
+        self._spilled = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+        if spill_dir is not None and os.path.isfile(self.spill_path()):
+            self._open_db()
+            self._spilled = self._db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def spill_path(self):
+        return os.path.join(self.spill_dir, "%s.sqlite" % self.name)
+
+    def _open_db(self):
+        if self._db is not None:
+            return
+        if self.spill_dir is None:
+            raise RuntimeError("Local queue %s is over %d items but has no spill directory" %
+                               (self.name, self.memory_items))
+        if not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        self._db = sqlite3.connect(self.spill_path(), check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS messages "
+                         "(id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT, attributes TEXT)")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(messages)")]
+        if "attributes" not in columns:
+            # Spill files written before attributes were stored
+            self._db.execute("ALTER TABLE messages ADD COLUMN attributes TEXT")
+        self._db.commit()
+
+    def _size(self):
+        return len(self._memory) + self._spilled + len(self._in_flight)
+
+    def __len__(self):
+        with self._lock:
+            return self._size()
+
+    def put(self, body, block=True, timeout=None, attributes=None):
+        """
+        Append a body to the queue. Raises queue.Full if the queue stays
+        full for `timeout` seconds, or immediately if `block` is False.
+        """
+        self.put_many([body], block=block, timeout=timeout,
+                      attributes=None if attributes is None else [attributes])
+
+    def put_many(self, bodies, block=True, timeout=None, attributes=None):
+        """
+        Append bodies to the queue in order, spilling them to disk in a
+        single transaction where possible. `attributes`, if given, holds
+        an attribute dict (or None) for each body.
+        """
+        if attributes is None:
+            attributes = [None] * len(bodies)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._not_full:
+            spill = []
+            for message in zip(bodies, attributes):
+                if self.max_items is not None and self._size() + len(spill) >= self.max_items:
+                    self._spill(spill)
+                    spill = []
+                    while self._size() >= self.max_items:
+                        self._requeue_expired()
+                        remaining = None if deadline is None else deadline - time.time()
+                        if not block or (remaining is not None and remaining <= 0):
+                            raise queue.Full("Local queue %s is full" % self.name)
+                        self._not_full.wait(remaining if remaining is not None else 1)
+
+                # Once anything has spilled, later bodies must spill too to stay FIFO
+                if self._spilled == 0 and len(spill) == 0 and \
+                   len(self._memory) < self.memory_items:
+                    self._memory.append(message)
+                    self._not_empty.notify()
+                else:
+                    spill.append(message)
+            self._spill(spill)
+
+    def _spill(self, messages):
+        if len(messages) == 0:
+            return
+        self._open_db()
+        self._db.executemany("INSERT INTO messages (body, attributes) VALUES (?, ?)",
+                             [(body, None if attributes is None else json.dumps(attributes))
+                              for body, attributes in messages])
+        self._db.commit()
+        self._spilled += len(messages)
+        self._not_empty.notify_all()
+
+    def _refill(self):
+        """
+        Move the oldest spilled bodies back into memory
+        """
+        if self._spilled == 0 or len(self._memory) > 0:
+            return
+        rows = self._db.execute("SELECT id, body, attributes FROM messages ORDER BY id LIMIT ?",
+                                (self.memory_items,)).fetchall()
+        self._db.execute("DELETE FROM messages WHERE id <= ?", (rows[-1][0],))
+        self._db.commit()
+        self._spilled -= len(rows)
+        self._memory.extend((body, None if attributes is None else json.loads(attributes))
+                            for _, body, attributes in rows)
+
+    def _requeue_expired(self):
+        now = time.time()
+        expired = [(receipt, message) for receipt, (deadline, message) in self._in_flight.items()
+                   if deadline <= now]
+        # Put them back at the head, oldest receipt first
+        for receipt, message in sorted(expired, key=lambda e: e[0], reverse=True):
+            del self._in_flight[receipt]
+            self._memory.appendleft(message)
+        if len(expired) > 0:
+            self._not_empty.notify_all()
+
+    def receive(self, max_messages=1, wait_time=0, visibility_timeout=None):
+        """
+        Returns up to `max_messages` (receipt, body, attributes) tuples,
+        waiting up to `wait_time` seconds for the first one. Messages must be
+        acked with their receipt before `visibility_timeout` expires.
+        """
+        if visibility_timeout is None:
+            visibility_timeout = self.visibility_timeout
+        deadline = time.time() + wait_time
+        with self._not_empty:
+            while True:
+                self._requeue_expired()
+                self._refill()
+                if len(self._memory) > 0:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                self._not_empty.wait(min(remaining, 1))
+
+            messages = []
+            while len(messages) < max_messages:
+                self._refill()
+                if len(self._memory) == 0:
+                    break
+                body, attributes = self._memory.popleft()
+                self._next_receipt += 1
+                self._in_flight[self._next_receipt] = (time.time() + visibility_timeout,
+                                                       (body, attributes))
+                messages.append((self._next_receipt, body, attributes))
+            return messages
+
+    def ack(self, receipt):
+        """
+        Remove a received message for good. Returns False if its visibility
+        timeout had already expired.
+        """
+        with self._not_full:
+            self._requeue_expired()
+            if receipt not in self._in_flight:
+                return False
+            del self._in_flight[receipt]
+            self._not_full.notify()
+            return True
+
+    def extend(self, receipt, seconds):
+        """
+        Keep a received message in flight for `seconds` more seconds from now.
+        Returns False if its visibility timeout had already expired.
+        """
+        with self._lock:
+            self._requeue_expired()
+            if receipt not in self._in_flight:
+                return False
+            deadline, message = self._in_flight[receipt]
+            self._in_flight[receipt] = (time.time() + seconds, message)
+            return True
+
+    def close(self):
+        """
+        Close the spill file. Bodies still in memory or in flight are lost;
+        spilled bodies are kept for the next run.
+        """
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class QueueMessage(object):
+    """
+    A message received from a QueueBackend. Attribute names follow boto3's
+    SQS Message, so either can be turned into an item. `message_attributes`
+    maps attribute names to string values.
+    """
+    def __init__(self, body, receipt_handle, message_id=None, message_attributes=None):
+        self.body = body
+        self.receipt_handle = receipt_handle
+        self.message_id = message_id if message_id is not None else receipt_handle
+        self.message_attributes = message_attributes or {}
+
+
+class QueueBackend(object):
+    """
+    Interface to a message queue.
+
+    send_batch() sends at most `max_batch_messages` bodies totalling at most
+    `max_batch_bytes` (None for backends without a size limit), each with
+    an optional dict of string message attributes; QueueBatcher groups
+    bodies to fit. Received messages
+    stay in flight until acked by receipt handle, and extend() keeps them
+    in flight for longer. `shared` backends can be acked by other processes,
+    such as transformer lambda functions.
+    """
+    max_batch_messages = SQS_MAX_BATCH_MESSAGES
+    max_batch_bytes = SQS_MAX_BATCH_BYTES
+    shared = False
+
+    def send_batch(self, bodies, attributes=None):
+        raise NotImplementedError()
+
+    def receive(self, max_messages=SQS_MAX_BATCH_MESSAGES, wait_time=0):
+        raise NotImplementedError()
+
+    def ack(self, receipt_handles):
+        raise NotImplementedError()
+
+    def extend(self, receipt_handles, seconds):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class SQSQueueBackend(QueueBackend):
+    shared = True
+
+    def __init__(self, client, queue_url, max_retries=5):
+        self._client = client
+        self.name = queue_url
+        self.queue_url = queue_url
+        self.max_retries = max_retries
+
+    def send_batch(self, bodies, attributes=None):
+        attributes = attributes or [None] * len(bodies)
+        sender = SQSBatchSender(self._client, self.queue_url, max_retries=self.max_retries)
+        for body, message_attributes in zip(bodies, attributes):
+            sender.add(body, message_attributes)
+        sender.flush()
+        return sender.sent
+
+    def receive(self, max_messages=SQS_MAX_BATCH_MESSAGES, wait_time=0):
+        res = self._client.receive_message(QueueUrl=self.queue_url,
+                                           MaxNumberOfMessages=min(max_messages,
+                                                                   SQS_MAX_BATCH_MESSAGES),
+                                           WaitTimeSeconds=int(min(wait_time,
+                                                                   SQS_MAX_WAIT_SECONDS)),
+                                           MessageAttributeNames=['All'])
+        return [QueueMessage(m['Body'], m['ReceiptHandle'], m['MessageId'],
+                             {name: value.get('StringValue')
+                              for name, value in m.get('MessageAttributes', {}).items()})
+                for m in res.get('Messages', [])]
+
+    def ack(self, receipt_handles):
+        for chunk in util.chunks(receipt_handles, SQS_MAX_BATCH_MESSAGES):
+            res = self._client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(i), 'ReceiptHandle': handle}
+                         for i, handle in enumerate(chunk)])
+            if len(res.get('Failed', [])) > 0:
+                print("Failed to delete %d messages from queue %s" %
+                      (len(res['Failed']), self.queue_url))
+
+    def extend(self, receipt_handles, seconds):
+        for chunk in util.chunks(receipt_handles, SQS_MAX_BATCH_MESSAGES):
+            self._client.change_message_visibility_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(i), 'ReceiptHandle': handle,
+                          'VisibilityTimeout': int(seconds)}
+                         for i, handle in enumerate(chunk)])
+
+
+class MemoryQueueBackend(QueueBackend):
+    """
+    In-process queue backend, holding every message in memory.
+    Messages aren't limited in size as they are on SQS.
+    """
+    max_batch_bytes = None
+
+    def __init__(self, name, max_items=None, visibility_timeout=30, put_timeout=None):
+        self.name = name
+        self.put_timeout = put_timeout
+        self._queue = self.build_queue(name, max_items, visibility_timeout)
+
+    def build_queue(self, name, max_items, visibility_timeout):
+        return LocalQueue(name, memory_items=float("inf"), max_items=max_items,
+                          visibility_timeout=visibility_timeout)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def send_batch(self, bodies, attributes=None):
+        """
+        Queue `bodies`, blocking while the queue is full. Raises queue.Full
+        if it stays full for `put_timeout` seconds.
+        """
+        self._queue.put_many(bodies, timeout=self.put_timeout, attributes=attributes)
+        return len(bodies)
+
+    def receive(self, max_messages=SQS_MAX_BATCH_MESSAGES, wait_time=0):
+        return [QueueMessage(body, "%s:%d" % (self.name, receipt),
+                             message_attributes=attributes)
+                for receipt, body, attributes in self._queue.receive(max_messages=max_messages,
+                                                                     wait_time=wait_time)]
+
+    @staticmethod
+    def receipt(handle):
+        return int(handle.rsplit(":", 1)[1])
+
+    def ack(self, receipt_handles):
+        for handle in receipt_handles:
+            self._queue.ack(self.receipt(handle))
+
+    def extend(self, receipt_handles, seconds):
+        for handle in receipt_handles:
+            self._queue.extend(self.receipt(handle), seconds)
+
+    def close(self):
+        self._queue.close()
+
+
+class FileQueueBackend(MemoryQueueBackend):
+    """
+    Local queue backend which keeps at most `memory_items` messages in
+    memory, spilling the rest to a SQLite file in `directory`
+    """
+    def __init__(self, name, directory, memory_items=1000, max_items=None,
+                 visibility_timeout=30, put_timeout=None):
+        self.directory = directory
+        self.memory_items = memory_items
+        MemoryQueueBackend.__init__(self, name, max_items=max_items,
+                                    visibility_timeout=visibility_timeout,
+                                    put_timeout=put_timeout)
+
+    def build_queue(self, name, max_items, visibility_timeout):
+        return LocalQueue(name, memory_items=self.memory_items, max_items=max_items,
+                          spill_dir=self.directory, visibility_timeout=visibility_timeout)
+
+
+class QueueBatcher(object):
+    """
+    Buffers message bodies for a QueueBackend, sending them with
+    send_batch() whenever a batch is full
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.sent = 0
+        self._bodies = []
+        self._attributes = []
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, body, attributes=None):
+        max_bytes = self.backend.max_batch_bytes
+        size = message_size(body, attributes) if max_bytes is not None else 0
+        if max_bytes is not None and size > max_bytes:
+            raise RuntimeError("Message of %d bytes exceeds the limit of %d bytes for queue %s" %
+                               (size, max_bytes, self.backend.name))
+        with self._lock:
+            if len(self._bodies) >= self.backend.max_batch_messages or \
+               (max_bytes is not None and self._bytes + size > max_bytes):
+                self._send()
+            self._bodies.append(body)
+            self._attributes.append(attributes)
+            self._bytes += size
+
+    def flush(self):
+        with self._lock:
+            self._send()
+
+    def _send(self):
+        bodies = self._bodies
+        attributes = self._attributes
+        self._bodies = []
+        self._attributes = []
+        self._bytes = 0
+        if len(bodies) > 0:
+            if any(attributes):
+                self.backend.send_batch(bodies, attributes)
+            else:
+                self.backend.send_batch(bodies)
+            self.sent += len(bodies)
@@ -2,13 +2,14 @@ import json
 from collections import OrderedDict
 from functools import reduce
 import antenna.AWSManager
-from redleader.cluster import Cluster, AWSContext
-import redleader.resources as r
 
 class ResourceManager(object):
     """
     esourceManager coordinates AWS resources for
     an Antenna controller
+
+    RedLeader is only imported when resources are actually modeled,
+    so runtime-only controllers never pay for it.
     """
     def __init__(self, controller):
         self._controller = controller
@@ -88,6 +89,7 @@ class ResourceManager(object):
         """
         Create default DynamoDB tables
         """
+        import redleader.resources as r
         source_state_config = ResourceManager.dynamo_key_schema("source_config_hash")
         source_state_table = r.DynamoDBTableResource(
             context, self.dynamo_table_name("source_state"),
@@ -102,6 +104,8 @@ class ResourceManager(object):
         """
         Create a RedLeader cluster for AWS resource creation
         """
+        from redleader.cluster import Cluster, AWSContext
+        import redleader.resources as r
         context = AWSContext(self._controller._aws_profile)
         cluster = Cluster(self._cluster_name(), context)
 
@@ -17,14 +17,13 @@ fault tolerant, and also allows us to execute long-running scrapes
 on large archives.
 
 Source state persistence to DynamoDB is managed by the Controller
+
+Heavy scraping libraries are imported by the sources which use them,
+so importing this module stays cheap.
 """
-import requests
-import boto3
-import feedparser
 import hashlib
 import json
 import time
-import newspaper
 import calendar
 
 from urllib.parse import urlparse
@@ -54,6 +53,11 @@ class Source(object):
 
         if not hasattr(self, "state"):
             self.state = {}
+        self._recent_entry_ids = None
+        self._new_entry_ids = None
+        self._high_water_mark = None
+        self._new_high_water_mark = None
+        self._seen_entry_ids = None
 
     def external_resources(self):
         """
@@ -94,10 +98,57 @@ class Source(object):
         print("Setting state", state)
         for k in state:
             self.state[k] = state[k]
+        self._recent_entry_ids = None
 
     def get_state(self):
+        if self._recent_entry_ids is not None:
+            # Every id emitted by this run is kept, evicting older ones first
+            keep = max(0, self.max_recent_entries - len(self._new_entry_ids))
+            recent = self._recent_entry_ids[-keep:] if keep > 0 else []
+            self.state['recent_entry_ids'] = " ".join(recent + self._new_entry_ids)
+            if self._new_high_water_mark is not None and \
+               (self._high_water_mark is None or self._new_high_water_mark > self._high_water_mark):
+                self.state['high_water_mark'] = self._new_high_water_mark
         return self.state
 
+    def is_new_entry(self, key, time_published=None):
+        """
+        Returns whether an entry wasn't emitted by a previous run, and records
+        it as emitted. Used by sources with `incremental` enabled.
+
+        An entry is new unless its id was emitted earlier in this run or is
+        among the `max_recent_entries` most recently emitted ids, or it was
+        published more than `high_water_mark_slack` seconds before the newest
+        entry of a previous run (the high water mark). Entries are compared
+        against the mark loaded at the start of the run, since feeds list
+        newest first; the mark is only raised in get_state(). Both are kept
+        compactly in the source state; every id emitted by a run is saved,
+        even past `max_recent_entries`, so a feed can't re-emit its own entries.
+        """
+        if not getattr(self, "incremental", False):
+            return True
+        if self._recent_entry_ids is None:
+            self._recent_entry_ids = self.state.get('recent_entry_ids', "").split()
+            self._new_entry_ids = []
+            self._seen_entry_ids = set(self._recent_entry_ids)
+            high_water_mark = self.state.get('high_water_mark')
+            self._high_water_mark = float(high_water_mark) if high_water_mark is not None else None
+            self._new_high_water_mark = None
+
+        entry_id = hashlib.md5(key.encode('utf-8')).hexdigest()[:12]
+        if entry_id in self._seen_entry_ids:
+            return False
+        if time_published is not None and self._high_water_mark is not None and \
+           time_published < self._high_water_mark - self.high_water_mark_slack:
+            return False
+
+        self._new_entry_ids.append(entry_id)
+        self._seen_entry_ids.add(entry_id)
+        if time_published is not None and \
+           (self._new_high_water_mark is None or time_published > self._new_high_water_mark):
+            self._new_high_water_mark = time_published
+        return True
+
     def yield_items(self):
         """
         Implemented by each source individually
@@ -130,6 +181,7 @@ class StaticFileSource(Source):
         return 'Contents' not in objects or len(objects['Contents']) == 0
 
     def yield_items(self):
+        import requests
         s3_client = self._aws_manager.get_client('s3')
         local_filename = self.s3_bucket_name + "_" + self.destination_key
         r = requests.get(self.source_url, stream=True)
@@ -147,6 +199,11 @@ class RSSFeedSource(Source):
     Side Effects: None
     Produces: ArticleReference Items
 
+    The feed's ETag and Last-Modified validators are kept in the source
+    state and sent with the next request, so an unchanged feed costs a
+    304 response and produces no items. With `incremental` (the default),
+    only entries not emitted by a previous run are produced.
+
     TODO: Store last retrieved article date in state, so we can
           easily decide whether or not to run.
     """
@@ -160,6 +217,9 @@ class RSSFeedSource(Source):
         self._defaults = {
             'item_type': 'ArticleReference',
             'minutes_between_scrapes': 10,
+            'incremental': True,
+            'max_recent_entries': 1000,
+            'high_water_mark_slack': 60 * 60 * 24,
         }
         self.state = {
             "time_last_updated": 0
@@ -173,12 +233,26 @@ class RSSFeedSource(Source):
         return time.time() - float(self.state['time_last_updated']) > 60 * self.minutes_between_scrapes
 
     def yield_items(self):
-        self.state = {
-            'time_last_updated': time.time()
-        }
-        feed = feedparser.parse(self.rss_feed_url)
+        import feedparser
+        self.state['time_last_updated'] = time.time()
+        feed = feedparser.parse(self.rss_feed_url,
+                                etag=self.state.get('etag'),
+                                modified=self.state.get('modified'))
+        if feed.get('status') == 304:
+            print("RSS feed %s not modified since last scrape" % self.rss_feed_url)
+            return
+
+        # Remember validators for a conditional request next time
+        for validator in ['etag', 'modified']:
+            if feed.get(validator):
+                self.state[validator] = feed[validator]
+            else:
+                self.state.pop(validator, None)
+
         for entry in feed['entries']:
             timestamp = calendar.timegm(entry['published_parsed'])
+            if not self.is_new_entry(entry.get('id', entry['link']), timestamp):
+                continue
             content = entry['summary']
             try:
                 content = entry['content'][0]['value']
@@ -203,6 +277,9 @@ class NewspaperLibSource(Source):
     Consumes ArticleReference Items
     Side Effects: Stores article bodies on S3
     Produces: ScrapedArticle Items
+
+    With `incremental` (the default), only articles not emitted by a
+    previous run are produced.
     """
     def __init__(self, aws_manager, params):
         self._required_keywords = [
@@ -212,6 +289,9 @@ class NewspaperLibSource(Source):
         self._defaults = {
             'item_type': 'ArticleReference',
             'minutes_between_scrapes': 10,
+            'incremental': True,
+            'max_recent_entries': 1000,
+            'high_water_mark_slack': 60 * 60 * 24,
         }
         self._optional_keywords = [
             "minutes_between_scrapes"
@@ -228,13 +308,14 @@ class NewspaperLibSource(Source):
         return time.time() - float(self.state['time_last_updated']) > 60 * self.minutes_between_scrapes
 
     def yield_items(self):
-        self.state = {
-            'time_last_updated': time.time()
-        }
+        import newspaper
+        self.state['time_last_updated'] = time.time()
         print("Building newspaper lib source for URL %s" % self.url)
         source = newspaper.build(self.url, memoize_articles=False)
         print("Finished building newspaper lib source. Found %d articles" % source.size())
         for a in source.articles:
+            if not self.is_new_entry(a.url):
+                continue
             payload = {
                 'url': a.url,
                 'source_type': 'NewspaperLib',
@@ -0,0 +1,49 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+import json
+import threading
+
+class StageRegistry(object):
+    """
+    Holds a single instance of each configured filter and storage stage,
+    keyed by its configuration, so stages are built once per Controller and
+    can keep state (e.g. write buffers) across items.
+
+    Stages are opened when first built. flush() and close() are forwarded
+    to every stage built so far.
+    """
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stage_key(kind, conf):
+        return "%s:%s" % (kind, json.dumps(conf, sort_keys=True))
+
+    def get(self, kind, conf, factory):
+        """
+        Return the stage of the given kind for `conf`, building it
+        with `factory(conf)` if it hasn't been built yet
+        """
+        key = StageRegistry.stage_key(kind, conf)
+        with self._lock:
+            if key not in self._stages:
+                stage = factory(conf)
+                stage.open()
+                self._stages[key] = stage
+            return self._stages[key]
+
+    def stages(self):
+        with self._lock:
+            return list(self._stages.values())
+
+    def flush(self):
+        for stage in self.stages():
+            stage.flush()
+
+    def close(self):
+        with self._lock:
+            stages = list(self._stages.values())
+            self._stages = {}
+        for stage in stages:
+            stage.flush()
+            stage.close()
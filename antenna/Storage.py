@@ -6,11 +6,29 @@ Transformers/Sources produce items, they're filtered, and then finally persisted
 
   Transformer/Source ----> Filters -----> Storage
 
+Besides DynamoDB, items can be stored locally in SQLite or in rotating
+JSONL (optionally gzipped) or Parquet files, for local runs and exports,
+or archived to S3 as large gzipped JSONL objects.
 """
+import os
+import gzip
 import json
+import time
+import uuid
+import zlib
+import sqlite3
+import threading
+from collections import OrderedDict
 
-import redleader.resources as r
+import botocore
 from antenna.ResourceManager import ResourceManager
+import antenna.util as util
+
+# BatchWriteItem accepts at most 25 put requests per call
+DYNAMODB_MAX_BATCH_WRITE = 25
+
+# Every part of an S3 multipart upload but the last must be at least 5MB
+S3_MIN_PART_BYTES = 5 * 1024 * 1024
 
 class Storage(object):
     def __init__(self, aws_manager, params):
@@ -43,11 +61,73 @@ class Storage(object):
                 raise Exception("Unknown parameter %s for storage %s" %
                                 (param, self.__class__.__name__))
 
+    def external_resources(self):
+        """
+        Returns a list of RedLeader.resources this storage requires
+        """
+        return []
+
+    def format_key(self, item, format_string=None):
+        """
+        Produce the primary key by replacing item properties with their values.
+
+        I.e) given item = {"name": "car", "desc": "..."},
+                   partition_key_format_string = "{name}-primary-key"
+                   => format_key(item, partition_key_format_string) = "car-primary-key"
+        """
+        base = format_string if format_string is not None else self.partition_key_format_string
+        for k in item.payload:
+            base = base.replace("{%s}" % k, str(item.payload[k]))
+        return base
+
+    def item_properties(self, item):
+        """
+        The item's payload, without queue bookkeeping properties
+        """
+        return {k: v for k, v in item.payload.items() if k not in self._excluded_item_properties}
+
+    def open(self):
+        """
+        Called once, when the Controller first builds this stage
+        """
+        pass
+
+    def flush(self):
+        """
+        Persist any buffered items. Called by the Controller at the end of
+        each source or transformer job
+        """
+        pass
+
+    def close(self):
+        """
+        Called when the Controller shuts down, after a final flush()
+        """
+        pass
+
     def store_item(self, item):
+        """
+        Store (or buffer) an item. Returns False if the item was deliberately
+        not written, e.g. because it already exists.
+        """
         raise NotImplementedError
 
 
 class DynamoDBStorage(Storage):
+    """
+    Stores items as rows in a DynamoDB table.
+
+    Items are upserted with a single UpdateItem call, so attributes written
+    by other stages survive. With `update_if_exists` set to False, items are
+    only written if no row with the same key exists yet.
+
+    With `buffer_writes` enabled, items are collected in memory and written
+    with BatchWriteItem, 25 at a time, once `buffer_max_items` are buffered,
+    once the oldest buffered item is `buffer_max_seconds` old, or on flush().
+    Buffered writes replace whole rows rather than updating them.
+    BatchWriteItem can't make writes conditional, so with `update_if_exists`
+    set to False items are always written one at a time.
+    """
     def __init__(self, aws_manager, params):
         self._required_keywords = [
             "dynamodb_table_name",
@@ -60,15 +140,25 @@ class DynamoDBStorage(Storage):
             "range_key",
             "range_key_format_string",
             "range_key_type",
-            "update_if_exists"
+            "update_if_exists",
+            "buffer_writes",
+            "buffer_max_items",
+            "buffer_max_seconds"
         ]
         self._defaults = {
             "update_if_exists": True,
             "range_key_type": "N",
+            "buffer_writes": False,
+            "buffer_max_items": 100,
+            "buffer_max_seconds": 10,
         }
         super(DynamoDBStorage, self).__init__(aws_manager, params)
+        self._buffer = OrderedDict()
+        self._buffer_started = None
+        self._buffer_lock = threading.Lock()
 
     def external_resources(self):
+        import redleader.resources as r
         table_config = ResourceManager.dynamo_key_schema(
             self.partition_key,
             range_key_name=getattr(self, "range_key", None),
@@ -82,18 +172,8 @@ class DynamoDBStorage(Storage):
         )
         return [table_resource]
 
-    def format_key(self, item):
-        """
-        Produce the primary key by replacing item properties with their values.
-
-        I.e) given item = {"name": "car", "desc": "..."},
-                   partition_key_format_string = "{name}-primary-key"
-                   => format_key(item, partition_key_format_string) = "car-primary-key"
-        """
-        base = self.partition_key_format_string
-        for k in item.payload:
-            base = base.replace("{%s}" % k, str(item.payload[k]))
-        return base
+    def format_range_key(self, item):
+        return self.format_key(item, self.range_key_format_string)
 
     @staticmethod
     def from_dynamo_dict(dynamo_dict):
@@ -143,54 +223,637 @@ class DynamoDBStorage(Storage):
         """
         Transform a consumed item into a dynamodb entry
         """
-        filtered = {k: v for k,v in item.payload.items() if k not in self._excluded_item_properties}
-        ditem = DynamoDBStorage.dynamo_dict(filtered)
+        ditem = DynamoDBStorage.dynamo_dict(self.item_properties(item))
 
         # Set the primary key if applicable
         if hasattr(self, "partition_key"):
             ditem[self.partition_key] = {'S': self.format_key(item)}
+        if hasattr(self, "range_key") and hasattr(self, "range_key_format_string"):
+            ditem[self.range_key] = {self.range_key_type: self.format_range_key(item)}
 
         return ditem
 
+    def key_attributes(self):
+        return [getattr(self, k) for k in ["partition_key", "range_key"]
+                if getattr(self, k, None) is not None]
+
+    def update_item_args(self, item):
+        """
+        Arguments for an UpdateItem call which sets every attribute of the
+        item, leaving attributes the item doesn't have untouched. Attribute
+        names go through placeholders since many are dynamo reserved words.
+        """
+        ditem = self.dynamo_item(item)
+        key_attributes = self.key_attributes()
+        args = {"Key": {k: ditem[k] for k in key_attributes}}
+        names = {}
+        values = {}
+        assignments = []
+        for i, k in enumerate(sorted(k for k in ditem if k not in key_attributes)):
+            names["#A%d" % i] = k
+            values[":v%d" % i] = ditem[k]
+            assignments.append("#A%d = :v%d" % (i, i))
+        if len(assignments) > 0:
+            args["UpdateExpression"] = "SET " + ", ".join(assignments)
+            args["ExpressionAttributeNames"] = names
+            args["ExpressionAttributeValues"] = values
+        return args
+
     def store_item(self, item):
         if self.update_if_exists == False:
             return self.insert_fresh_item(item)
+        if self.buffer_writes:
+            return self.buffer_item(item)
+        return self.insert_or_update_item(item)
+
+    def buffer_item(self, item):
+        """
+        Add an item to the write buffer, flushing if a threshold was reached
+        """
+        ditem = self.dynamo_item(item)
+        key_attributes = [getattr(self, k) for k in ["partition_key", "range_key"]
+                          if getattr(self, k, None) is not None]
+        if len(key_attributes) > 0:
+            key = json.dumps([ditem.get(k) for k in key_attributes], sort_keys=True)
         else:
-            return self.insert_or_update_item(item)
+            key = json.dumps(ditem, sort_keys=True)
 
-    def insert_fresh_item(self, item):
-        raise NotImplementedError("No support for update_if_exists=False yet")
+        with self._buffer_lock:
+            # BatchWriteItem rejects duplicate keys, so the latest write wins
+            self._buffer.pop(key, None)
+            self._buffer[key] = ditem
+            if self._buffer_started is None:
+                self._buffer_started = time.time()
+            full = len(self._buffer) >= self.buffer_max_items or \
+                   time.time() - self._buffer_started >= self.buffer_max_seconds
+        if full:
+            self.flush()
 
-    def insert_or_update_item(self, item):
+    def flush(self):
+        with self._buffer_lock:
+            ditems = list(self._buffer.values())
+            self._buffer = OrderedDict()
+            self._buffer_started = None
+        for chunk in util.chunks(ditems, DYNAMODB_MAX_BATCH_WRITE):
+            self.batch_write(chunk)
+
+    def batch_write(self, ditems, max_retries=8):
+        """
+        Write up to 25 dynamo items with BatchWriteItem,
+        retrying any unprocessed items with jittered backoff
+        """
         ddb = self._aws_manager.get_client('dynamodb')
+        request_items = {
+            self.dynamodb_table_name: [{'PutRequest': {'Item': ditem}} for ditem in ditems]
+        }
+        attempt = 0
+        while True:
+            res = ddb.batch_write_item(RequestItems=request_items)
+            request_items = res.get('UnprocessedItems', {})
+            if len(request_items) == 0:
+                return
+            if attempt >= max_retries:
+                raise RuntimeError("Failed to write %d items to table %s after %d retries" %
+                                   (len(request_items.get(self.dynamodb_table_name, [])),
+                                    self.dynamodb_table_name, attempt))
+            util.backoff_sleep(attempt)
+            attempt += 1
 
-        # Attempt to retrieve old item.
+    def insert_fresh_item(self, item):
+        """
+        Insert the item only if no row with its key exists yet.
+        Returns False if the row already existed.
+        """
         ddb = self._aws_manager.get_client('dynamodb')
-        res = ddb.query(
+        if len(self.key_attributes()) == 0:
+            raise RuntimeError("update_if_exists=False requires a partition_key")
+        args = self.update_item_args(item)
+        args.setdefault("ExpressionAttributeNames", {})["#K0"] = self.key_attributes()[0]
+        try:
+            return ddb.update_item(
+                TableName=self.dynamodb_table_name,
+                ConditionExpression="attribute_not_exists(#K0)",
+                **args
+            )
+        except botocore.exceptions.ClientError as e:
+            if "ConditionalCheckFailed" not in str(e):
+                raise e
+            return False
+
+    def insert_or_update_item(self, item):
+        """
+        Upsert the item with a single UpdateItem call. Attributes written
+        by other stages are preserved.
+        """
+        ddb = self._aws_manager.get_client('dynamodb')
+        if len(self.key_attributes()) == 0:
+            # Without a configured key we can't address the row, so write it whole
+            return ddb.put_item(
+                TableName=self.dynamodb_table_name,
+                Item=self.dynamo_item(item)
+            )
+        return ddb.update_item(
             TableName=self.dynamodb_table_name,
-            KeyConditionExpression='#PLACEHOLDER = :val',
-            # We'll use a placeholder name in case our key is a dynamo
-            # reserved keyword (very common)
-            ExpressionAttributeNames = {
-                "#PLACEHOLDER": self.partition_key
-            },
-            ExpressionAttributeValues={
-                ':val': {
-                    'S': self.format_key(item)
-                }
-            }
+            **self.update_item_args(item)
         )
-        base_item = {}
-        if 'Items' in res and len(res['Items']) > 0:
-            base_item = res['Items'][0]
 
-        # Merge the old and new items together
-        new_item = self.dynamo_item(item)
-        for k in new_item:
-            base_item[k] = new_item[k]
 
-        # Update the item in dynamo
-        return ddb.put_item(
-            TableName=self.dynamodb_table_name,
-            Item=new_item
-        )
+class SQLiteStorage(Storage):
+    """
+    Stores items as rows in a SQLite table, with the item's properties as
+    JSON in a `payload` column.
+
+    The row key is made of `key_columns`, a list of item properties, and/or
+    `partition_key`, a column filled from `partition_key_format_string` as
+    in DynamoDBStorage. Rows with the same key are replaced. Without a key,
+    every item is appended.
+
+    Writes are buffered and committed in one transaction once
+    `commit_max_items` are buffered, once the oldest is `commit_max_seconds`
+    old, or on flush().
+    """
+    def __init__(self, aws_manager, params):
+        self._required_keywords = [
+            "sqlite_path",
+        ]
+        self._optional_keywords = [
+            "table_name",
+            "key_columns",
+            "partition_key",
+            "partition_key_format_string",
+            "commit_max_items",
+            "commit_max_seconds"
+        ]
+        self._defaults = {
+            "table_name": "items",
+            "key_columns": [],
+            "commit_max_items": 1000,
+            "commit_max_seconds": 5,
+        }
+        super(SQLiteStorage, self).__init__(aws_manager, params)
+        if hasattr(self, "partition_key") != hasattr(self, "partition_key_format_string"):
+            raise Exception("partition_key and partition_key_format_string must be given together")
+        self._db = None
+        self._buffer = []
+        self._buffer_started = None
+        self._lock = threading.Lock()
+
+    def columns(self):
+        """
+        The key columns, in order
+        """
+        columns = list(self.key_columns)
+        if hasattr(self, "partition_key"):
+            columns = [self.partition_key] + columns
+        return columns
+
+    @staticmethod
+    def quote(name):
+        return '"%s"' % name.replace('"', '""')
+
+    def open(self):
+        with self._lock:
+            if self._db is not None:
+                return
+            directory = os.path.dirname(os.path.abspath(self.sqlite_path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._db = sqlite3.connect(self.sqlite_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            columns = ["%s TEXT" % SQLiteStorage.quote(c) for c in self.columns()]
+            columns += ["payload TEXT", "time_stored REAL"]
+            if len(self.columns()) > 0:
+                columns.append("PRIMARY KEY (%s)" % ", ".join(SQLiteStorage.quote(c)
+                                                              for c in self.columns()))
+            self._db.execute("CREATE TABLE IF NOT EXISTS %s (%s)" %
+                             (SQLiteStorage.quote(self.table_name), ", ".join(columns)))
+            self._db.commit()
+
+    def row(self, item):
+        properties = self.item_properties(item)
+        row = []
+        if hasattr(self, "partition_key"):
+            row.append(self.format_key(item))
+        for column in self.key_columns:
+            if column not in properties:
+                raise Exception("Item is missing key column %s for table %s" %
+                                (column, self.table_name))
+            value = properties[column]
+            row.append(value if isinstance(value, str) else json.dumps(value))
+        row += [json.dumps(properties, sort_keys=True), time.time()]
+        return tuple(row)
+
+    def store_item(self, item):
+        row = self.row(item)
+        with self._lock:
+            self._buffer.append(row)
+            if self._buffer_started is None:
+                self._buffer_started = time.time()
+            full = len(self._buffer) >= self.commit_max_items or \
+                   time.time() - self._buffer_started >= self.commit_max_seconds
+        if full:
+            self.flush()
+
+    def flush(self):
+        self.open()
+        with self._lock:
+            rows = self._buffer
+            self._buffer = []
+            self._buffer_started = None
+            if len(rows) == 0:
+                return
+            names = [SQLiteStorage.quote(c) for c in self.columns()] + ["payload", "time_stored"]
+            self._db.executemany("INSERT OR REPLACE INTO %s (%s) VALUES (%s)" %
+                                 (SQLiteStorage.quote(self.table_name), ", ".join(names),
+                                  ", ".join("?" for _ in names)),
+                                 rows)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class JSONLStorage(Storage):
+    """
+    Appends items as JSON lines to files in `directory`, gzipped unless
+    `compress` is False.
+
+    Each file holds at most `rotate_max_items` items and is kept open for
+    at most `rotate_max_seconds`, after which the next item starts a new
+    file. Items are buffered in memory and written `buffer_max_items` at a
+    time, or on flush(). If `partition_key` and `partition_key_format_string`
+    are given, the formatted key is added to each record.
+    """
+    extension = "jsonl"
+
+    def __init__(self, aws_manager, params):
+        self._required_keywords = [
+            "directory",
+        ]
+        self._optional_keywords = [
+            "file_prefix",
+            "compress",
+            "partition_key",
+            "partition_key_format_string",
+            "buffer_max_items",
+            "rotate_max_items",
+            "rotate_max_seconds"
+        ]
+        self._defaults = {
+            "file_prefix": "items",
+            "compress": True,
+            "buffer_max_items": 1000,
+            "rotate_max_items": 100000,
+            "rotate_max_seconds": 3600,
+        }
+        super(JSONLStorage, self).__init__(aws_manager, params)
+        if hasattr(self, "partition_key") != hasattr(self, "partition_key_format_string"):
+            raise Exception("partition_key and partition_key_format_string must be given together")
+        self._buffer = []
+        self._file = None
+        self._file_items = 0
+        self._file_opened = None
+        self._files_written = 0
+        self._lock = threading.Lock()
+
+    def record(self, item):
+        record = self.item_properties(item)
+        if hasattr(self, "partition_key"):
+            record[self.partition_key] = self.format_key(item)
+        return record
+
+    def file_path(self):
+        """
+        A new file name. The random suffix keeps processes sharing the
+        directory from writing to each other's files.
+        """
+        self._files_written += 1
+        name = "%s-%s-%05d-%s.%s" % (self.file_prefix, time.strftime("%Y%m%dT%H%M%S"),
+                                     self._files_written, uuid.uuid4().hex, self.extension)
+        if self.compress and self.extension == "jsonl":
+            name += ".gz"
+        return os.path.join(self.directory, name)
+
+    def store_item(self, item):
+        record = self.record(item)
+        with self._lock:
+            self._buffer.append(record)
+            full = len(self._buffer) >= self.buffer_max_items
+        if full:
+            self.flush()
+
+    def rotate_due(self):
+        return self._file is not None and \
+            (self._file_items >= self.rotate_max_items or
+             time.time() - self._file_opened >= self.rotate_max_seconds)
+
+    def open_file(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.file_path()
+        if self.compress:
+            self._file = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            self._file = open(path, 'w', encoding='utf-8')
+        self._file_items = 0
+        self._file_opened = time.time()
+
+    def close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def write_records(self, records):
+        for record in records:
+            if self.rotate_due():
+                self.close_file()
+            if self._file is None:
+                self.open_file()
+            self._file.write(json.dumps(record, sort_keys=True))
+            self._file.write("\n")
+            self._file_items += 1
+        if self._file is not None:
+            # Written lines are readable (and gzip members recoverable) after each flush
+            self._file.flush()
+
+    def flush(self):
+        with self._lock:
+            records = self._buffer
+            self._buffer = []
+            if len(records) > 0:
+                self.write_records(records)
+            if self.rotate_due():
+                self.close_file()
+
+    def close(self):
+        with self._lock:
+            self.close_file()
+
+
+class ParquetStorage(JSONLStorage):
+    """
+    Like JSONLStorage, but writes each flushed batch to its own Parquet file,
+    so `rotate_max_seconds` doesn't apply. Each file's columns are the union
+    of its records' properties, missing values are null, and nested values or
+    columns holding mixed types are stored as JSON strings. Requires pyarrow.
+    """
+    extension = "parquet"
+
+    def __init__(self, aws_manager, params):
+        if "rotate_max_seconds" in params:
+            raise Exception("Unknown parameter rotate_max_seconds for storage %s" %
+                            self.__class__.__name__)
+        super(ParquetStorage, self).__init__(aws_manager, params)
+        try:
+            import pyarrow
+        except ImportError:
+            raise Exception("ParquetStorage requires pyarrow. Install it with `pip install pyarrow`")
+
+    @staticmethod
+    def column(values):
+        """
+        Returns (pyarrow type, values) for a column, falling back to JSON
+        strings for nested or mixed values
+        """
+        import pyarrow
+        present = [v for v in values if v is not None]
+        if len(present) == 0:
+            return pyarrow.string(), values
+        if all(isinstance(v, bool) for v in present):
+            return pyarrow.bool_(), values
+        if all(isinstance(v, int) and not isinstance(v, bool) and -2 ** 63 <= v < 2 ** 63
+               for v in present):
+            return pyarrow.int64(), values
+        if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+            return pyarrow.float64(), [float(v) if v is not None else None for v in values]
+        if all(isinstance(v, str) for v in present):
+            return pyarrow.string(), values
+        return pyarrow.string(), [v if v is None or isinstance(v, str) else json.dumps(v)
+                                  for v in values]
+
+    def table(self, records):
+        import pyarrow
+        names = sorted(set(k for record in records for k in record))
+        fields = []
+        columns = []
+        for name in names:
+            ty, values = ParquetStorage.column([record.get(name) for record in records])
+            fields.append(pyarrow.field(name, ty))
+            columns.append(pyarrow.array(values, type=ty))
+        return pyarrow.Table.from_arrays(columns, schema=pyarrow.schema(fields))
+
+    def write_records(self, records):
+        import pyarrow.parquet
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for chunk in util.chunks(records, self.rotate_max_items):
+            pyarrow.parquet.write_table(self.table(chunk), self.file_path(),
+                                        compression='snappy' if self.compress else 'none')
+
+
+class S3ArchiveObject(object):
+    """
+    A gzipped JSONL object being streamed to S3.
+
+    Lines are compressed as they're written. Once `part_size` compressed
+    bytes are pending they're sent as a part of a multipart upload, so
+    nothing is staged on disk and at most about one part is held in memory.
+    Objects which never fill a part are written with a single PutObject.
+    """
+    def __init__(self, client, bucket, key, part_size, compress_level=6):
+        self._client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.items = 0
+        self.opened = time.time()
+        self._compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 31)
+        self._pending = bytearray()
+        self._uploaded = 0
+        self._upload_id = None
+        self._parts = []
+
+    def size(self):
+        """
+        Compressed bytes written so far
+        """
+        return self._uploaded + len(self._pending)
+
+    def write(self, line):
+        self._pending += self._compressor.compress(line.encode('utf-8'))
+        self.items += 1
+        if len(self._pending) >= self.part_size:
+            try:
+                self._upload_part()
+            except Exception as e:
+                self.abort()
+                raise e
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            res = self._client.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                       ContentType="application/x-ndjson",
+                                                       ContentEncoding="gzip")
+            self._upload_id = res['UploadId']
+        part_number = len(self._parts) + 1
+        res = self._client.upload_part(Bucket=self.bucket, Key=self.key,
+                                       UploadId=self._upload_id, PartNumber=part_number,
+                                       Body=bytes(self._pending))
+        self._parts.append({'PartNumber': part_number, 'ETag': res['ETag']})
+        self._uploaded += len(self._pending)
+        self._pending = bytearray()
+
+    def complete(self):
+        """
+        Write the remaining data and make the object visible
+        """
+        self._pending += self._compressor.flush()
+        try:
+            if self._upload_id is None:
+                self._client.put_object(Bucket=self.bucket, Key=self.key,
+                                        Body=bytes(self._pending),
+                                        ContentType="application/x-ndjson",
+                                        ContentEncoding="gzip")
+                return
+            self._upload_part()
+            self._client.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                   UploadId=self._upload_id,
+                                                   MultipartUpload={'Parts': self._parts})
+        except Exception as e:
+            self.abort()
+            raise e
+
+    def abort(self):
+        """
+        Abort the multipart upload, if one was started, so the parts
+        uploaded so far aren't left billed but invisible
+        """
+        if self._upload_id is None:
+            return
+        upload_id = self._upload_id
+        self._upload_id = None
+        try:
+            self._client.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                UploadId=upload_id)
+        except Exception as e:
+            print("Failed to abort multipart upload %s of s3://%s/%s: %s" %
+                  (upload_id, self.bucket, self.key, e))
+
+
+class S3ArchiveStorage(Storage):
+    """
+    Archives items to S3 as gzipped JSONL objects holding many items each.
+
+    Objects are keyed by item type and the values of the `partition_by`
+    item properties, i.e)
+        {key_prefix}/ScrapedArticle/week_published=2017_3/{time}-{n}-{uuid}.jsonl.gz
+
+    An object is completed once it holds `object_max_bytes` compressed
+    bytes or is `object_max_seconds` old, and the next item in its
+    partition starts a new one.
+
+    By default (`complete_on_flush` True) flush() completes every open
+    object, so items are durable before the job that stored them acks its
+    messages. The Controller flushes at the end of every source and
+    transformer job, so on lambda each batch produces its own, often small,
+    object per partition. Long running local processes should set
+    `complete_on_flush` to False: flush() then only completes objects which
+    are due and close() completes the rest, giving fewer, larger objects at
+    the risk of losing the open objects if the process dies.
+
+    If a part fails to upload, the multipart upload is aborted and the
+    object's items are dropped along with it.
+    """
+    def __init__(self, aws_manager, params):
+        self._required_keywords = [
+            "s3_bucket",
+        ]
+        self._optional_keywords = [
+            "key_prefix",
+            "partition_by",
+            "object_max_bytes",
+            "object_max_seconds",
+            "part_size",
+            "compress_level",
+            "complete_on_flush"
+        ]
+        self._defaults = {
+            "key_prefix": "archive",
+            "partition_by": ["week_published"],
+            "object_max_bytes": 128 * 1024 * 1024,
+            "object_max_seconds": 900,
+            "part_size": 8 * 1024 * 1024,
+            "compress_level": 6,
+            "complete_on_flush": True,
+        }
+        super(S3ArchiveStorage, self).__init__(aws_manager, params)
+        if self.part_size < S3_MIN_PART_BYTES:
+            raise Exception("part_size must be at least %d bytes" % S3_MIN_PART_BYTES)
+        self._objects = {}
+        self._objects_created = 0
+        self._lock = threading.Lock()
+
+    def external_resources(self):
+        import redleader.resources as r
+        return [r.S3BucketResource(self._aws_manager, self.s3_bucket)]
+
+    def partition(self, item):
+        parts = [item.item_type]
+        for field in self.partition_by:
+            value = item.payload.get(field, "unknown")
+            parts.append("%s=%s" % (field, str(value).replace("/", "_")))
+        return "/".join(parts)
+
+    def new_object(self, partition):
+        self._objects_created += 1
+        # PIDs and counters repeat across lambda containers, so keys carry a
+        # random suffix to keep concurrent invocations from overwriting each other
+        key = "%s/%s/%s-%05d-%s.jsonl.gz" % (self.key_prefix.rstrip("/"), partition,
+                                             time.strftime("%Y%m%dT%H%M%S", time.gmtime()),
+                                             self._objects_created, uuid.uuid4().hex)
+        return S3ArchiveObject(self._aws_manager.get_client('s3'), self.s3_bucket, key,
+                               self.part_size, self.compress_level)
+
+    def due(self, archive_object):
+        return archive_object.size() >= self.object_max_bytes or \
+            time.time() - archive_object.opened >= self.object_max_seconds
+
+    def store_item(self, item):
+        line = json.dumps(self.item_properties(item), sort_keys=True) + "\n"
+        partition = self.partition(item)
+        with self._lock:
+            archive_object = self._objects.get(partition)
+            if archive_object is not None and self.due(archive_object):
+                del self._objects[partition]
+                archive_object.complete()
+                archive_object = None
+            if archive_object is None:
+                archive_object = self.new_object(partition)
+                self._objects[partition] = archive_object
+            try:
+                archive_object.write(line)
+            except Exception as e:
+                # The upload was aborted, so the next item starts a new object
+                del self._objects[partition]
+                raise e
+
+    def complete_objects(self, only_due=False):
+        with self._lock:
+            for partition in list(self._objects.keys()):
+                archive_object = self._objects[partition]
+                if only_due and not self.due(archive_object):
+                    continue
+                del self._objects[partition]
+                archive_object.complete()
+                print("Archived %d items to s3://%s/%s" %
+                      (archive_object.items, self.s3_bucket, archive_object.key))
+
+    def flush(self):
+        self.complete_objects(only_due=not self.complete_on_flush)
+
+    def close(self):
+        self.complete_objects()
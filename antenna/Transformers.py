@@ -5,17 +5,18 @@ in turn producing new Items themselves.
 
 Transformers are not designed to be interruptible - they are expected
 to finish within the 5 minute execution time limit imposed by AWS Lambda.
+
+Heavy scraping libraries are imported by the transformers which use them,
+so importing this module stays cheap.
 """
 from functools import reduce
-from newspaper import Article
+from concurrent.futures import ThreadPoolExecutor
 #from readability import Document
 import time
+import threading
 import calendar
 import collections
-import datefinder
 import datetime
-import dateutil.parser as dparser
-import requests
 import hashlib
 
 class Item(object):
@@ -23,6 +24,16 @@ class Item(object):
         self.item_type = item_type
         self.payload = payload
 
+class TransformFailure(object):
+    """
+    Yielded by Transformer.transform_items in place of output for an input
+    item which failed to transform. Its queue message is left unacked, so
+    it's delivered again (and eventually dead lettered).
+    """
+    def __init__(self, item, error):
+        self.item = item
+        self.error = error
+
 class Transformer(object):
     def __init__(self, aws_manager, params):
         # Validate given parameters
@@ -60,13 +71,38 @@ class Transformer(object):
         """
         return []
 
+    def open(self):
+        """
+        Called once, when the Controller first builds this transformer
+        """
+        pass
+
+    def flush(self):
+        """
+        Called by the Controller at the end of each job
+        """
+        pass
+
+    def close(self):
+        """
+        Called when the Controller shuts down, after a final flush()
+        """
+        pass
+
     def transform_items(self, items):
         """
         By default, transformers map over consumed items. However, a transformer
         can produce more or less items than it consumes by overriding this method
+
+        Yielding None for an item drops it deliberately, while yielding a
+        TransformFailure marks it as failed so it's retried.
         """
         for item in items:
-            yield self.transform(item)
+            try:
+                yield self.transform(item)
+            except Exception as e:
+                print("%s failed to transform item: %s" % (self.__class__.__name__, e))
+                yield TransformFailure(item, e)
 
     def transform(self, item):
         """
@@ -92,6 +128,7 @@ def date_extraction_helper(content):
     """
     Searches `content` for the most common mentioned date within 10 years of now
     """
+    import datefinder
     matches = list(datefinder.find_dates(content))
 
     now = calendar.timegm(datetime.datetime.now().timetuple())
@@ -107,30 +144,74 @@ def date_extraction_helper(content):
             most_common = timestamp
             hwm = counts[timestamp]
 
-    print("Most referenced date: %s" % datetime.datetime.utcfromtimestamp(most_common))
+    if most_common is not None:
+        print("Most referenced date: %s" % datetime.datetime.utcfromtimestamp(most_common))
     return most_common
 
+# Connection pools are shared by every scraper in the process,
+# so warm lambda containers keep their keep-alive connections
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def http_session(pool_size=16):
+    import requests
+    import newspaper
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                    pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = newspaper.Config().browser_user_agent
+            _http_session = session
+        return _http_session
+
 class NewspaperLibScraper(Transformer):
     """
     Input item payloads should have shape {'url': 'http://...', ...}
     Output items will be augmented with title, fulltext, images, authors, etc
+
+    transform_items() downloads a batch of articles concurrently over pooled
+    keep-alive connections (`download_workers` at a time), then parses them
+    on a pool of `parse_workers` threads. Articles which fail to download
+    or parse are reported as TransformFailures, without affecting the rest
+    of the batch.
     """
     def __init__(self, aws_manager, params):
         self._required_keywords = [
             "input_item_types",
             "output_item_type"
         ]
+        self._optional_keywords = [
+            "download_workers",
+            "parse_workers",
+            "request_timeout"
+        ]
         super(NewspaperLibScraper, self).__init__(aws_manager, params)
         self.output_item_types = [self.output_item_type]
+        self.download_workers = params.get("download_workers", 16)
+        self.parse_workers = params.get("parse_workers", 4)
+        self.request_timeout = params.get("request_timeout", 10)
 
-    def transform(self, item):
-        url = item.payload['url']
-        print("NewspaperLibScraper scraping URL %s" % url)
-        a = Article(url, language='en')
-        a.download()
-        a.parse()
-
+    def download_html(self, url):
+        """
+        Returns the HTML at `url`, or the exception raised retrieving it
+        """
+        import requests
+        try:
+            res = http_session(self.download_workers).get(url, timeout=self.request_timeout)
+            res.raise_for_status()
+            return res.text
+        except requests.exceptions.RequestException as e:
+            print("NewspaperLibScraper failed to download URL %s: %s" % (url, e))
+            return e
 
+    def article_item(self, item, a):
+        """
+        Augment the item's payload with a parsed article
+        """
         # Extract date using readability, since
         # newspaper's date extraction is unreliable
         #doc = Document(a.html)
@@ -144,18 +225,55 @@ class NewspaperLibScraper(Transformer):
         item.payload['scrape_time'] = time.time()
         if a.publish_date is not None:
             item.payload['time_published'] = calendar.timegm(a.publish_date.timetuple())
-            week = datetime.date.fromtimestamp(item.payload['time_published']).isocalendar()
-            item.payload['week_published'] = "%s_%s" % (week[0], week[1])
             print("Date from newspaperlib: %s" % item.payload['time_published'])
         else:
             item.payload['time_published'] = date_extraction_helper(a.html)
-            item.payload['week_published'] = "%s_%s" % (week[0], week[1])
             item.payload['time_published_inferred'] = True
             print("Date from helper: %s" % item.payload['time_published'])
+        if item.payload['time_published'] is not None:
+            week = datetime.date.fromtimestamp(item.payload['time_published']).isocalendar()
+            item.payload['week_published'] = "%s_%s" % (week[0], week[1])
         return Item(
             item_type=self.output_item_type,
             payload=item.payload)
 
+    def parse_item(self, item, html):
+        """
+        Parse downloaded HTML into an output item, or a TransformFailure
+        """
+        from newspaper import Article
+        if isinstance(html, Exception):
+            return TransformFailure(item, html)
+        try:
+            a = Article(item.payload['url'], language='en')
+            a.download(input_html=html)
+            a.parse()
+            return self.article_item(item, a)
+        except Exception as e:
+            print("NewspaperLibScraper failed to parse URL %s: %s" % (item.payload['url'], e))
+            return TransformFailure(item, e)
+
+    def transform_items(self, items):
+        items = list(items)
+        if len(items) == 0:
+            return
+        print("NewspaperLibScraper scraping %d URLs" % len(items))
+        with ThreadPoolExecutor(max_workers=min(self.download_workers, len(items))) as pool:
+            htmls = list(pool.map(self.download_html,
+                                  [item.payload['url'] for item in items]))
+        with ThreadPoolExecutor(max_workers=min(self.parse_workers, len(items))) as pool:
+            for new_item in pool.map(self.parse_item, items, htmls):
+                yield new_item
+
+    def transform(self, item):
+        from newspaper import Article
+        url = item.payload['url']
+        print("NewspaperLibScraper scraping URL %s" % url)
+        a = Article(url, language='en')
+        a.download()
+        a.parse()
+        return self.article_item(item, a)
+
 class IdentityTransformer(Transformer):
     """
     Consumes Items of given type
@@ -5,6 +5,7 @@ import click
 import antenna
 import antenna.Controller as Controller
 from antenna.DataMapper import DataMapper
+from antenna.LocalPipeline import LocalPipeline
 import time
 import shutil
 
@@ -47,37 +48,18 @@ def local(ctx, aws_profile):
         config = json.load(config_file)
 
     try:
-        controller = Controller.Controller(config, os.getcwd(), aws_profile = aws_profile)
+        config['local_jobs'] = True
+        controller = Controller.Controller(config, os.getcwd(), aws_profile = aws_profile,
+                                           runtime_only=True)
         #controller.create_resources()
     except Exception as e:
         click.echo('Error with config: %s' % e)
         raise click.Abort()
 
-    items = []
-    for source in controller.config['sources']:
-        items += controller.run_source_job(source)
-
-    transformers = []
-    for transformer_conf in controller.config['transformers']:
-        transformers.append(controller.instantiate_transformer(transformer_conf, os.getcwd()))
-
-    produced = True
-    while produced:
-        produced = False
-        produced_items = []
-        for item in items:
-            if item is not None:
-                print(item.payload)
-            for transformer in transformers:
-                if item is not None and item.item_type in transformer.input_item_types:
-                    print("Running transformer on item")
-                    new_item = controller.run_transformer_job(transformer.params, item,
-                                                              os.getcwd(), use_queues=False)
-                    produced_items.append(new_item)
-                    break
-        if len(produced_items) > 0:
-            produced = True
-        items = produced_items
+    pipeline = LocalPipeline(controller, os.getcwd())
+    stats = pipeline.run()
+    click.echo(json.dumps(stats, indent=4))
+    controller.close()
 
 @cli.command(name='deploy-monitoring')
 @click.option('--aws-profile', default=None,
@@ -120,7 +102,8 @@ def run_source(ctx, search_key, aws_profile):
         config = json.load(config_file)
 
     try:
-        controller = Controller.Controller(config, os.getcwd(), aws_profile = aws_profile)
+        controller = Controller.Controller(config, os.getcwd(), aws_profile = aws_profile,
+                                           runtime_only=True)
         #controller.create_resources()
     except Exception as e:
         click.echo('Error with config: %s' % e)
@@ -137,6 +120,7 @@ def run_source(ctx, search_key, aws_profile):
             print("Found source: ")
             print(json.dumps(source, indent=4))
             items += controller.run_source_job(source)
+    controller.close()
 
     print(json.dumps(list(map(lambda x: x.payload, items)), indent=4))
 
@@ -160,6 +144,7 @@ def run_controller(ctx, aws_profile):
         click.echo('Error with config: %s' % e)
         raise click.Abort()
     controller.run()
+    controller.close()
 
 @cli.command(name='backfill',
              help='Run a transformer across data stored in dynamodb'
@@ -172,8 +157,17 @@ def run_controller(ctx, aws_profile):
               help='Only backfill over rows where this field is null')
 @click.option('--limit', default=None,
               help='Maximum number of rows to backfill')
+@click.option('--segments', default=1,
+              help='Number of parallel scan segments')
+@click.option('--workers', default=4,
+              help='Number of threads transforming rows')
+@click.option('--resume/--no-resume', default=False,
+              help='Resume from the last checkpoint of an identical backfill')
+@click.option('--checkpoint-file', default=None,
+              help='Save checkpoints to this file instead of the source state table')
 @click.pass_context
-def backfill(ctx, aws_profile, dynamodb_table_name, transformer_type, required_null_field, limit):
+def backfill(ctx, aws_profile, dynamodb_table_name, transformer_type, required_null_field, limit,
+             segments, workers, resume, checkpoint_file):
     if ctx.obj['config_file'] not in os.listdir(ctx.obj['project_dir']):
         click.echo('No antenna_config.json file found in directory')
         raise click.Abort()
@@ -183,7 +177,8 @@ def backfill(ctx, aws_profile, dynamodb_table_name, transformer_type, required_n
         config = json.load(config_file)
 
     try:
-        controller = Controller.Controller(config, os.getcwd(), aws_profile=aws_profile)
+        controller = Controller.Controller(config, os.getcwd(), aws_profile=aws_profile,
+                                           runtime_only=True)
         #controller.create_resources()
     except Exception as e:
         click.echo('Error with config: %s' % e)
@@ -199,8 +194,13 @@ def backfill(ctx, aws_profile, dynamodb_table_name, transformer_type, required_n
                                   "backfill_item_" + dynamodb_table_name,
                                   transformer_type,
                                   required_null_field=required_null_field,
-                                  limit=limit
+                                  limit=limit,
+                                  segments=segments,
+                                  workers=workers,
+                                  resume=resume,
+                                  checkpoint_path=checkpoint_file
     )
+    controller.close()
     print("Backfill operation complete.")
     print(json.dumps(stats, indent=4))
 
@@ -221,7 +221,8 @@ def run_transformer(ctx, aws_profile, transformer_type, item_type):
 
     try:
         config['local_jobs'] = True
-        controller = Controller.Controller(config, os.getcwd(), aws_profile=aws_profile)
+        controller = Controller.Controller(config, os.getcwd(), aws_profile=aws_profile,
+                                           runtime_only=True)
         #controller.create_resources()
     except Exception as e:
         click.echo('Error with config: %s' % e)
@@ -234,6 +235,7 @@ def run_transformer(ctx, aws_profile, transformer_type, item_type):
         if conf['type'] == transformer_type:
             transformer_config = conf
     controller.create_transformer_job(transformer_config, item_type, os.getcwd())
+    controller.close()
 
 @cli.command()
 @click.option('--aws-profile', default=None,
@@ -1,24 +1,48 @@
 import os
 import os.path
 import json
+import hashlib
 
 from antenna.Controller import Controller
 from antenna.Sources import Item
 
+# Building a Controller sets up AWS sessions, clients and every pipeline
+# stage, so warm lambda containers reuse the Controllers they've built.
+_controllers = {}
+
+def get_controller(controller_config, source_path=None):
+    """
+    Returns a cached Controller for the given config, building it on first use
+    """
+    if source_path is None:
+        source_path = os.getcwd()
+    key = hashlib.sha256(json.dumps([controller_config, source_path],
+                                    sort_keys=True).encode('utf-8')).hexdigest()
+    if key not in _controllers:
+        _controllers[key] = Controller(controller_config, source_path, runtime_only=True)
+    else:
+        print("Reusing warm controller %s" % key[:12])
+    return _controllers[key]
+
 def transformer_handler(event, context):
     print("Transformer handler initialized")
     controller_config = json.loads(event['controller_config'])
     transformer_config = json.loads(event['transformer_config'])
-    item_dict = json.loads(event['item'])
-    item = Item(item_type=item_dict['item_type'], payload=item_dict['payload'])
-    controller = Controller(controller_config, os.getcwd())
+
+    # Events carry either a batch of items or, for older callers, a single item
+    if 'items' in event:
+        item_dicts = json.loads(event['items'])
+    else:
+        item_dicts = [json.loads(event['item'])]
+    items = [Item(item_type=d['item_type'], payload=d['payload']) for d in item_dicts]
+    controller = get_controller(controller_config)
 
     #try:
     if True:
-        print("Running transformer job")
-        controller.run_transformer_job(
+        print("Running transformer job on %d items" % len(items))
+        controller.run_transformer_batch(
             transformer_config,
-            item,
+            items,
             os.getcwd())
         return {
             'status' : 'OK'
@@ -36,7 +60,7 @@ def transformer_handler(event, context):
 def source_handler(event, context):
     controller_config = json.loads(event['controller_config'])
     source_config = json.loads(event['source_config'])
-    controller = Controller(controller_config, os.getcwd())
+    controller = get_controller(controller_config)
 
     try:
         controller.run_source_job(source_config)
@@ -54,5 +78,5 @@ def source_handler(event, context):
 def controller_handler(event, context):
     with open("./antenna.json", 'r') as f:
         controller_config = json.load(f)
-    controller = Controller(controller_config, os.getcwd())
+    controller = get_controller(controller_config)
     controller.run()
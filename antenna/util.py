@@ -0,0 +1,23 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+"""
+Small helpers shared by the queue and storage layers.
+"""
+import random
+import time
+
+def chunks(seq, size):
+    """
+    Split `seq` into lists of at most `size` elements
+    """
+    seq = list(seq)
+    return [seq[i:i + size] for i in range(0, len(seq), size)]
+
+def backoff_delay(attempt, base=0.05, cap=5.0):
+    """
+    Exponential backoff with full jitter, as recommended for AWS batch retries.
+    `attempt` starts at 0.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def backoff_sleep(attempt, base=0.05, cap=5.0):
+    time.sleep(backoff_delay(attempt, base=base, cap=cap))
@@ -0,0 +1,74 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+"""
+Measures the cold import cost each Lambda handler pays for the plugins
+its job uses. Every sample runs in a fresh interpreter so nothing is
+cached between runs.
+
+    python tests/benchmarks/import_time.py [repeats]
+"""
+import os
+import sys
+import json
+import subprocess
+
+SCENARIOS = [
+    ("lambda_handlers only", None, []),
+    ("transformer_handler: IdentityTransformer", "transformerClassMap", ["IdentityTransformer"]),
+    ("transformer_handler: NewspaperLibScraper", "transformerClassMap", ["NewspaperLibScraper"]),
+    ("source_handler: RSSFeedSource", "sourceClassMap", ["RSSFeedSource"]),
+    ("source_handler: NewspaperLibSource", "sourceClassMap", ["NewspaperLibSource"]),
+    ("controller_handler: all plugins", None, "all"),
+]
+
+# Libraries each plugin imports on first use, which a cold job also pays for
+PLUGIN_DEPENDENCIES = {
+    "NewspaperLibScraper": ["requests", "newspaper", "datefinder"],
+    "RSSFeedSource": ["feedparser"],
+    "NewspaperLibSource": ["newspaper"],
+}
+
+SAMPLE = """
+import time
+start = time.time()
+import antenna.lambda_handlers
+import importlib
+import antenna.Controller as C
+maps = %(maps)s
+for class_map, names in maps:
+    for name in names:
+        C.resolve_class(getattr(C, class_map), name)
+        for dependency in %(dependencies)s.get(name, []):
+            importlib.import_module(dependency)
+print(time.time() - start)
+"""
+
+def scenario_maps(class_map, names):
+    if names == "all":
+        return [(m, list(getattr(Controller, m).keys()))
+                for m in ["sourceClassMap", "transformerClassMap",
+                          "filterClassMap", "storageClassMap"]]
+    if class_map is None:
+        return []
+    return [(class_map, names)]
+
+def sample(maps, repo_root):
+    out = subprocess.check_output([sys.executable, "-c", SAMPLE % {"maps": json.dumps(maps),
+                                                                     "dependencies": json.dumps(PLUGIN_DEPENDENCIES)}],
+                                  cwd=repo_root)
+    return float(out.decode('utf-8').strip().splitlines()[-1])
+
+def median(xs):
+    xs = sorted(xs)
+    mid = len(xs) // 2
+    return xs[mid] if len(xs) % 2 == 1 else (xs[mid - 1] + xs[mid]) / 2.0
+
+if __name__ == "__main__":
+    repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+    sys.path.insert(0, repo_root)
+    import antenna.Controller as Controller
+
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for label, class_map, names in SCENARIOS:
+        maps = scenario_maps(class_map, names)
+        times = [sample(maps, repo_root) for _ in range(repeats)]
+        print("%-45s %8.1f ms" % (label, median(times) * 1000))
@@ -0,0 +1,103 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+"""
+Offline throughput benchmark for the queue backends.
+
+Messages are encoded with a MessageCodec, sent through a QueueBatcher,
+received with a QueuePoller and acked in batches, as the Controller does. The SQS backend runs
+against a fake client which sleeps for a simulated round trip per
+request, so the effect of batching can be measured without AWS.
+
+    python tests/benchmarks/queue_throughput.py [messages] [sqs latency ms]
+"""
+import os
+import sys
+import time
+import uuid
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+from antenna.Queues import QueueBatcher, QueuePoller, SQSQueueBackend
+from antenna.Queues import MemoryQueueBackend, FileQueueBackend
+from antenna.MessageCodec import MessageCodec
+
+class FakeSQSClient(object):
+    """
+    In-memory stand-in for the SQS API calls SQSQueueBackend makes
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self.messages = []
+        self.in_flight = {}
+
+    def request(self):
+        self.requests += 1
+        time.sleep(self.latency)
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.request()
+        self.messages += [(e['MessageBody'], e.get('MessageAttributes', {})) for e in Entries]
+        return {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds,
+                        MessageAttributeNames=None):
+        self.request()
+        messages = self.messages[:MaxNumberOfMessages]
+        self.messages = self.messages[MaxNumberOfMessages:]
+        res = []
+        for body, attributes in messages:
+            handle = str(uuid.uuid4())
+            self.in_flight[handle] = body
+            message = {'Body': body, 'ReceiptHandle': handle, 'MessageId': handle}
+            if MessageAttributeNames and len(attributes) > 0:
+                message['MessageAttributes'] = attributes
+            res.append(message)
+        return {'Messages': res}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.request()
+        for e in Entries:
+            self.in_flight.pop(e['ReceiptHandle'], None)
+        return {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []}
+
+def run(backend, n):
+    body, attributes = MessageCodec().encode({"url": "http://example.com/article",
+                                              "title": "x" * 200})
+    start = time.time()
+    batcher = QueueBatcher(backend)
+    for i in range(n):
+        batcher.add(body, attributes)
+    batcher.flush()
+    sent = time.time()
+
+    received = 0
+    for messages in QueuePoller(backend, runtime=600, wait_time=0, idle_timeout=0.2).poll():
+        for m in messages:
+            MessageCodec.decode(m.body, m.message_attributes)
+        backend.ack([m.receipt_handle for m in messages])
+        received += len(messages)
+        if received >= n:
+            break
+    done = time.time()
+    return n / (sent - start), n / (done - sent)
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 5) / 1000.0
+    spill_dir = tempfile.mkdtemp()
+    try:
+        sqs_client = FakeSQSClient(latency)
+        backends = [
+            ("memory", MemoryQueueBackend("bench")),
+            ("file (1000 in memory)", FileQueueBackend("bench", spill_dir, memory_items=1000)),
+            ("sqs (%dms round trip)" % (latency * 1000), SQSQueueBackend(sqs_client, "bench")),
+        ]
+        print("%-28s %14s %14s" % ("backend", "send msg/s", "recv+ack msg/s"))
+        for name, backend in backends:
+            send_rate, receive_rate = run(backend, n)
+            backend.close()
+            print("%-28s %14.0f %14.0f" % (name, send_rate, receive_rate))
+        print("sqs requests: %d for %d messages" % (sqs_client.requests, n))
+    finally:
+        shutil.rmtree(spill_dir)
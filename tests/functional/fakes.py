@@ -0,0 +1,256 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+"""
+In-memory stand-ins for the AWS clients used by the functional tests
+"""
+import io
+import json
+import threading
+from collections import OrderedDict
+import botocore
+from antenna.Storage import DynamoDBStorage
+
+def client_error(code, message, operation):
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': message}},
+                                           operation)
+
+class FakeAWSManager(object):
+    """
+    Hands out the given clients by service name, recording which thread
+    asked for each
+    """
+    def __init__(self, clients):
+        self.clients = clients
+        self.requested = []
+
+    def get_client(self, name):
+        self.requested.append((name, threading.current_thread().name))
+        return self.clients[name]
+
+class FakeDynamoDBClient(object):
+    """
+    Serves a single table, whatever its name, from rows held in memory in
+    insertion order and keyed by `key_attributes`.
+
+    BatchGetItem leaves every key past the first `max_get_keys` of a request
+    unprocessed, and BatchWriteItem every write past the first
+    `max_write_items`. Scans return `page_size` rows at a time, with row n
+    of the table in segment n % TotalSegments. Every call is recorded in
+    `calls` as (operation, number of keys or items).
+    """
+    def __init__(self, key_attributes, rows=None, page_size=100, max_get_keys=100,
+                 max_write_items=25):
+        self.key_attributes = key_attributes
+        self.page_size = page_size
+        self.max_get_keys = max_get_keys
+        self.max_write_items = max_write_items
+        self.rows = OrderedDict()
+        self.calls = []
+        self.lock = threading.Lock()
+        for row in rows or []:
+            self.put(DynamoDBStorage.dynamo_dict(row))
+
+    def key(self, row):
+        return json.dumps({k: row[k] for k in self.key_attributes if k in row}, sort_keys=True)
+
+    def put(self, row):
+        self.rows[self.key(row)] = row
+
+    def record(self, operation, n=1):
+        with self.lock:
+            self.calls.append((operation, n))
+
+    def count(self, operation):
+        return sum(1 for name, n in self.calls if name == operation)
+
+    def sizes(self, operation):
+        return [n for name, n in self.calls if name == operation]
+
+    def items(self):
+        """
+        The table's rows as ordinary dictionaries
+        """
+        return [DynamoDBStorage.from_dynamo_dict(row) for row in self.rows.values()]
+
+    @staticmethod
+    def project(row, projection, names):
+        if projection is None:
+            return dict(row)
+        attributes = [(names or {}).get(a.strip(), a.strip()) for a in projection.split(",")]
+        return {k: row[k] for k in attributes if k in row}
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        unprocessed = {}
+        for table, request in RequestItems.items():
+            keys = request['Keys']
+            self.record("batch_get_item", len(keys))
+            found = []
+            for key in keys[:self.max_get_keys]:
+                row = self.rows.get(self.key(key))
+                if row is not None:
+                    found.append(self.project(row, request.get('ProjectionExpression'),
+                                              request.get('ExpressionAttributeNames')))
+            responses[table] = found
+            if len(keys) > self.max_get_keys:
+                unprocessed[table] = dict(request, Keys=keys[self.max_get_keys:])
+        return {'Responses': responses, 'UnprocessedKeys': unprocessed}
+
+    def batch_write_item(self, RequestItems):
+        unprocessed = {}
+        for table, requests in RequestItems.items():
+            self.record("batch_write_item", len(requests))
+            for request in requests[:self.max_write_items]:
+                if 'PutRequest' in request:
+                    self.put(request['PutRequest']['Item'])
+                else:
+                    self.rows.pop(self.key(request['DeleteRequest']['Key']), None)
+            if len(requests) > self.max_write_items:
+                unprocessed[table] = requests[self.max_write_items:]
+        return {'UnprocessedItems': unprocessed}
+
+    def put_item(self, TableName, Item, **kwargs):
+        self.record("put_item")
+        self.put(Item)
+        return {}
+
+    def update_item(self, TableName, Key, ConditionExpression=None, **kwargs):
+        """
+        Applies SET updates, honouring attribute_not_exists conditions
+        """
+        self.record("update_item")
+        key = self.key(Key)
+        if ConditionExpression is not None and key in self.rows:
+            raise client_error('ConditionalCheckFailedException',
+                               'The conditional request failed', 'UpdateItem')
+        row = self.rows.setdefault(key, dict(Key))
+        names = kwargs.get("ExpressionAttributeNames", {})
+        values = kwargs.get("ExpressionAttributeValues", {})
+        for assignment in kwargs.get("UpdateExpression", "SET ")[4:].split(", "):
+            if assignment == "":
+                continue
+            name, value = assignment.split(" = ")
+            row[names[name]] = values[value]
+        return {}
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeNames=None,
+              ExpressionAttributeValues=None, **kwargs):
+        """
+        Supports a single equality condition on the partition key
+        """
+        self.record("query")
+        name, value = [s.strip() for s in KeyConditionExpression.split("=")]
+        name = (ExpressionAttributeNames or {}).get(name, name)
+        value = ExpressionAttributeValues[value]
+        return {'Items': [dict(row) for row in self.rows.values() if row.get(name) == value]}
+
+    def scan(self, TableName, TotalSegments=None, Segment=None, ExclusiveStartKey=None,
+             ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        self.record("scan")
+        rows = list(self.rows.values())
+        if TotalSegments is not None:
+            rows = [row for n, row in enumerate(rows) if n % TotalSegments == Segment]
+        start = 0 if ExclusiveStartKey is None else int(ExclusiveStartKey['offset']['N'])
+        res = {'Items': [self.project(row, ProjectionExpression, ExpressionAttributeNames)
+                         for row in rows[start:start + self.page_size]]}
+        if start + self.page_size < len(rows):
+            res['LastEvaluatedKey'] = {'offset': {'N': str(start + self.page_size)}}
+        return res
+
+class FakeS3Client(object):
+    """
+    Stores objects in memory. Puts honour IfMatch/IfNoneMatch conditions,
+    and `interfere` is written as a competing object just before the next
+    put. Part uploads fail for part number `fail_part`.
+    """
+    def __init__(self, fail_part=None):
+        self.objects = {}
+        self.etags = {}
+        self.uploads = {}
+        self.calls = []
+        self.versions = 0
+        self.interfere = None
+        self.fail_part = fail_part
+
+    def write(self, key, body):
+        self.versions += 1
+        self.objects[key] = body
+        self.etags[key] = str(self.versions)
+
+    def get_object(self, Bucket, Key):
+        self.calls.append("get_object")
+        if Key not in self.objects:
+            raise client_error('NoSuchKey', 'Not found', 'GetObject')
+        return {'Body': io.BytesIO(self.objects[Key]), 'ETag': self.etags[Key]}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, **kwargs):
+        self.calls.append("put_object")
+        if self.interfere is not None:
+            self.write(Key, self.interfere)
+            self.interfere = None
+        if (IfNoneMatch == '*' and Key in self.objects) or \
+           (IfMatch is not None and self.etags.get(Key) != IfMatch):
+            raise client_error('PreconditionFailed', 'Changed', 'PutObject')
+        self.write(Key, Body)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.calls.append("create_multipart_upload")
+        self.uploads[Key] = {}
+        return {'UploadId': Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls.append("upload_part")
+        if PartNumber == self.fail_part:
+            raise RuntimeError("Failed to upload part %d" % PartNumber)
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append("complete_multipart_upload")
+        parts = self.uploads.pop(UploadId)
+        self.write(Key, b"".join(parts[p['PartNumber']] for p in MultipartUpload['Parts']))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append("abort_multipart_upload")
+        del self.uploads[UploadId]
+
+class FakeLambdaClient(object):
+    """
+    Records invocations and deployments. GetFunction returns
+    `configuration`, or fails as if the function doesn't exist yet.
+    """
+    def __init__(self, configuration=None):
+        self.configuration = configuration
+        self.invocations = []
+        self.calls = []
+        self.layers = []
+        self.lock = threading.Lock()
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        with self.lock:
+            self.invocations.append(FunctionName)
+        return {}
+
+    def get_function(self, FunctionName):
+        if self.configuration is None:
+            raise Exception("An error occurred (ResourceNotFoundException) when calling "
+                            "the GetFunction operation: Function not found: %s" % FunctionName)
+        return {'Configuration': self.configuration}
+
+    def create_function(self, **kwargs):
+        self.calls.append("create_function")
+
+    def update_function_code(self, **kwargs):
+        self.calls.append("update_function_code")
+
+    def update_function_configuration(self, **kwargs):
+        self.calls.append("update_function_configuration")
+
+    def list_layer_versions(self, LayerName, **kwargs):
+        return {'LayerVersions': [{'Description': d, 'LayerVersionArn': arn}
+                                  for d, arn in self.layers]}
+
+    def publish_layer_version(self, **kwargs):
+        self.calls.append("publish_layer_version")
+        arn = "layer:%d" % (len(self.layers) + 1)
+        self.layers.append((kwargs['Description'], arn))
+        return {'LayerVersionArn': arn}
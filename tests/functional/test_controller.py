@@ -0,0 +1,197 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+
+import unittest
+import json
+import time
+import shutil
+import tempfile
+import threading
+from antenna.Controller import Controller, LAMBDA_ASYNC_PAYLOAD_BYTES
+from antenna.ResourceManager import ResourceManager
+from antenna.Transformers import Item
+from fakes import FakeAWSManager, FakeDynamoDBClient, FakeLambdaClient
+
+def rss_source(n):
+    return {"type": "RSSFeedSource", "rss_feed_url": "http://example.com/%d.rss" % n}
+
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def controller(self, sources, **config):
+        config.update({"project_name": "test", "sources": sources})
+        config.setdefault("transformers", [])
+        return Controller(config, self.directory, runtime_only=True)
+
+    def test_runtime_only_skips_cluster(self):
+        clusters = []
+        def create_resource_cluster(manager):
+            clusters.append(manager)
+            return "cluster"
+        original = ResourceManager.create_resource_cluster
+        ResourceManager.create_resource_cluster = create_resource_cluster
+        try:
+            config = {"project_name": "test", "sources": [], "transformers": []}
+            controller = Controller(dict(config), self.directory, runtime_only=True)
+            self.assertTrue(controller._resource_cluster is None)
+            self.assertEqual(clusters, [])
+
+            # Full controllers model the cluster up front
+            controller = Controller(dict(config), self.directory)
+            self.assertEqual(len(clusters), 1)
+            self.assertEqual(controller._resource_cluster, "cluster")
+            # ...and only once
+            self.assertEqual(controller._cluster, "cluster")
+            self.assertEqual(len(clusters), 1)
+        finally:
+            ResourceManager.create_resource_cluster = original
+
+    def test_get_source_states(self):
+        controller = self.controller([rss_source(n) for n in range(250)])
+        sources = [controller.instantiate_source(config, skip_loading_state=True)
+                   for config in controller.sources]
+        rows = {}
+        for source in sources[::2]:
+            rows[source.config_hash()] = {"source_config_hash": source.config_hash(),
+                                          "time_last_updated": 7}
+        client = FakeDynamoDBClient(["source_config_hash"], rows.values(), max_get_keys=60)
+        controller._aws_manager = FakeAWSManager({"dynamodb": client})
+
+        states = controller.get_source_states(sources)
+        self.assertEqual(set(states.keys()), set(rows.keys()))
+        self.assertEqual(states[sources[0].config_hash()]["time_last_updated"], 7)
+        # At most 100 keys per request, with unprocessed keys retried
+        self.assertEqual(client.sizes("batch_get_item"), [100, 40, 100, 40, 50])
+
+    def test_get_source_states_gives_up(self):
+        controller = self.controller([rss_source(0)])
+        source = controller.instantiate_source(controller.sources[0], skip_loading_state=True)
+        client = FakeDynamoDBClient(["source_config_hash"], max_get_keys=0)
+        controller._aws_manager = FakeAWSManager({"dynamodb": client})
+        self.assertEqual(controller.get_source_states([source], max_retries=2), {})
+        self.assertEqual(client.count("batch_get_item"), 3)
+
+    def test_create_source_jobs(self):
+        controller = self.controller([rss_source(n) for n in range(20)], source_workers=4)
+        recent = controller.instantiate_source(controller.sources[3], skip_loading_state=True)
+        rows = {recent.config_hash(): {"source_config_hash": recent.config_hash(),
+                                       "time_last_updated": time.time()}}
+        lambda_client = FakeLambdaClient()
+        manager = FakeAWSManager({"dynamodb": FakeDynamoDBClient(["source_config_hash"],
+                                                                 rows.values()),
+                                  "lambda": lambda_client})
+        controller._aws_manager = manager
+        controller.create_source_jobs()
+
+        # Only sources due to run are dispatched, each exactly once
+        self.assertEqual(len(lambda_client.invocations), 19)
+        # The lambda client was created before the workers started
+        lambda_requests = [thread for name, thread in manager.requested if name == 'lambda']
+        self.assertEqual(lambda_requests[0], threading.current_thread().name)
+
+    def test_run_transformer_batch_acks(self):
+        transformer_config = {"type": "IdentityTransformer",
+                              "input_item_types": ["A"], "output_item_types": ["B"]}
+        controller = self.controller([], queue_backend="memory",
+                                     transformers=[transformer_config])
+        def transform(item):
+            n = item.payload['n']
+            if n % 3 == 0:
+                raise RuntimeError("Failed to transform %d" % n)
+            if n % 3 == 1:
+                return None
+            return Item(item_type="B", payload={"n": n})
+        controller.get_transformer(transformer_config, self.directory).transform = transform
+
+        for n in range(9):
+            controller.enqueue_item(Item(item_type="A", payload={"n": n}))
+        controller.flush_queues()
+        queue = controller.get_queue("A")
+        items = [controller.item_from_message_payload("A", message, queue.name)
+                 for message in queue.receive(max_messages=10)]
+        outputs = controller.run_transformer_batch(transformer_config, items, self.directory)
+
+        self.assertEqual(sorted(item.payload['n'] for item in outputs), [2, 5, 8])
+        self.assertEqual(len(controller.get_queue("B")), 3)
+        # Only the failed items are left in flight, for redelivery
+        self.assertEqual(len(queue), 3)
+        controller.close()
+
+    def test_transformer_batch_limits(self):
+        transformer_config = {"type": "IdentityTransformer",
+                              "input_item_types": ["A"], "output_item_types": ["B"]}
+        controller = self.controller([], transformer_batch_size=10)
+        max_items, max_bytes = controller.transformer_batch_limits(transformer_config)
+        self.assertEqual(max_items, 10)
+        self.assertTrue(max_bytes < LAMBDA_ASYNC_PAYLOAD_BYTES // 2)
+
+        # Slow transformers get batches small enough to finish within the lambda timeout
+        controller = self.controller([], transformer_batch_size=10, transformer_item_seconds=60)
+        self.assertEqual(controller.transformer_batch_limits(transformer_config)[0], 4)
+        controller = self.controller([], transformer_batch_size=10, transformer_item_seconds=1000)
+        self.assertEqual(controller.transformer_batch_limits(transformer_config)[0], 1)
+
+        # Larger configs leave less room for items
+        controller = self.controller([rss_source(n) for n in range(100)])
+        self.assertTrue(controller.transformer_batch_limits(transformer_config)[1] < max_bytes)
+
+    def transformer_job_batches(self, payloads, **config):
+        transformer_config = {"type": "IdentityTransformer",
+                              "input_item_types": ["A"], "output_item_types": ["B"]}
+        controller = self.controller([], queue_backend="memory", queue_wait_time=0,
+                                     queue_idle_timeout=1, **config)
+        for payload in payloads:
+            controller.enqueue_item(Item(item_type="A", payload=payload))
+        controller.flush_queues()
+        batches = []
+        def dispatch(config, items, source_path, run_locally=False):
+            if len(items) > 0:
+                self.assertTrue(run_locally)
+                batches.append(items)
+        controller.dispatch_transformer_batch = dispatch
+        controller.create_transformer_job(transformer_config, "A", self.directory)
+        limits = controller.transformer_batch_limits(transformer_config)
+        controller.close()
+        return batches, limits
+
+    def test_create_transformer_job_batch_size(self):
+        batches, limits = self.transformer_job_batches([{"n": n} for n in range(25)],
+                                                       transformer_batch_size=10)
+        # The final partial receive is dispatched without waiting for more messages
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual([item.payload["n"] for batch in batches for item in batch],
+                         list(range(25)))
+
+    def test_dispatch_extends_visibility(self):
+        transformer_config = {"type": "IdentityTransformer",
+                              "input_item_types": ["A"], "output_item_types": ["B"]}
+        controller = self.controller([], queue_backend="memory", local_queue_visibility_timeout=1)
+        lambda_client = FakeLambdaClient()
+        controller._aws_manager = FakeAWSManager({"lambda": lambda_client})
+        for n in range(4):
+            controller.enqueue_item(Item(item_type="A", payload={"n": n}))
+        controller.flush_queues()
+        queue = controller.get_queue("A")
+        items = [controller.item_from_message_payload("A", message, queue.name)
+                 for message in queue.receive(max_messages=10)]
+        controller.dispatch_transformer_batch(transformer_config, items, self.directory)
+        self.assertEqual(len(lambda_client.invocations), 1)
+
+        # The batch outlives the queue's visibility timeout without being redelivered
+        time.sleep(1.5)
+        self.assertEqual(list(queue.receive(max_messages=10)), [])
+        self.assertEqual(len(queue), 4)
+        controller.close()
+
+    def test_create_transformer_job_batch_bytes(self):
+        payloads = [{"n": n, "text": "x" * 30000} for n in range(10)]
+        batches, (max_items, max_bytes) = self.transformer_job_batches(payloads,
+                                                                       transformer_batch_size=10)
+        self.assertTrue(len(batches) > 1)
+        self.assertEqual(sorted(item.payload["n"] for batch in batches for item in batch),
+                         list(range(10)))
+        for batch in batches:
+            self.assertTrue(sum(len(json.dumps(item.payload)) for item in batch) <= max_bytes)
@@ -0,0 +1,167 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+
+import unittest
+import os
+import json
+import time
+import sqlite3
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import antenna.DataMapper
+from antenna.DataMapper import DataMapper
+from antenna.Controller import Controller
+from antenna.Transformers import Item
+from fakes import FakeAWSManager, FakeDynamoDBClient
+
+def scan_client(num_rows, page_size=4):
+    return FakeDynamoDBClient(["n"], [{"n": n} for n in range(num_rows)], page_size=page_size)
+
+class TrackingExecutor(ThreadPoolExecutor):
+    """
+    Records the most transform batches ever submitted but not yet finished
+    """
+    lock = threading.Lock()
+    pending = 0
+    max_pending = 0
+
+    def submit(self, fn, *args):
+        future = ThreadPoolExecutor.submit(self, fn, *args)
+        if fn.__name__ == "transform_batch":
+            with TrackingExecutor.lock:
+                TrackingExecutor.pending += 1
+                TrackingExecutor.max_pending = max(TrackingExecutor.max_pending,
+                                                   TrackingExecutor.pending)
+            future.add_done_callback(TrackingExecutor.done)
+        return future
+
+    @staticmethod
+    def done(future):
+        with TrackingExecutor.lock:
+            TrackingExecutor.pending -= 1
+
+class TestDataMapper(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sqlite_path = self.directory + "/rows.sqlite"
+        self.transformer_config = {"type": "IdentityTransformer",
+                                   "input_item_types": ["Row"],
+                                   "output_item_types": ["Row"],
+                                   "storage": [{"type": "SQLiteStorage",
+                                                "sqlite_path": self.sqlite_path,
+                                                "key_columns": ["n"]},
+                                               {"type": "JSONLStorage",
+                                                "directory": self.directory + "/rows"}]}
+        config = {"project_name": "test", "sources": [], "queue_backend": "memory",
+                  "transformer_batch_size": 3, "transformers": [self.transformer_config]}
+        self.controller = Controller(config, self.directory, runtime_only=True)
+        self.batches = []
+        self.flushes = [0]
+        self.lock = threading.Lock()
+
+        run_transformer_batch = self.controller.run_transformer_batch
+        def record_batch(config, items, source_path, **kwargs):
+            with self.lock:
+                self.batches.append([item.payload["n"] for item in items])
+            self.assertFalse(kwargs.get("flush", True))
+            return run_transformer_batch(config, items, source_path, **kwargs)
+        self.controller.run_transformer_batch = record_batch
+
+        flush_stages = self.controller.flush_stages
+        def record_flush():
+            with self.lock:
+                self.flushes[0] += 1
+            flush_stages()
+        self.controller.flush_stages = record_flush
+
+    def tearDown(self):
+        self.controller.close()
+        shutil.rmtree(self.directory)
+
+    def backfill(self, client, **kwargs):
+        self.controller._aws_manager = FakeAWSManager({"dynamodb": client})
+        return DataMapper(self.controller).local_backfill("table", "Row", "IdentityTransformer",
+                                                          verbose=False, **kwargs)
+
+    def rows(self):
+        return sorted(n for batch in self.batches for n in batch)
+
+    def test_segments_and_batches(self):
+        client = scan_client(23)
+        stats = self.backfill(client, segments=3, workers=2,
+                              checkpoint_path=self.directory + "/checkpoint.json")
+        self.assertEqual(self.rows(), list(range(23)))
+        for batch in self.batches:
+            self.assertTrue(len(batch) <= 3)
+            # Row n is in segment n % 3
+            self.assertEqual(len(set(n % 3 for n in batch)), 1)
+        # One flush per page, rather than per batch or row
+        self.assertEqual(self.flushes[0], client.count("scan"))
+        self.assertEqual(stats["rows_scanned"], 23)
+        self.assertEqual(stats["transformed"], 23)
+        self.assertTrue(stats["complete"])
+
+    def test_in_flight_bound(self):
+        original = antenna.DataMapper.ThreadPoolExecutor
+        antenna.DataMapper.ThreadPoolExecutor = TrackingExecutor
+        TrackingExecutor.max_pending = 0
+        run_transformer_batch = self.controller.run_transformer_batch
+        def slow_batch(*args, **kwargs):
+            time.sleep(0.01)
+            return run_transformer_batch(*args, **kwargs)
+        self.controller.run_transformer_batch = slow_batch
+        try:
+            self.backfill(scan_client(60, page_size=20), segments=3, workers=1,
+                          max_in_flight_per_worker=2,
+                          checkpoint_path=self.directory + "/checkpoint.json")
+        finally:
+            antenna.DataMapper.ThreadPoolExecutor = original
+        self.assertEqual(self.rows(), list(range(60)))
+        self.assertTrue(TrackingExecutor.max_pending <= 2)
+
+    def test_limit(self):
+        stats = self.backfill(scan_client(23), segments=1, limit=10,
+                              checkpoint_path=self.directory + "/checkpoint.json")
+        self.assertEqual(self.rows(), list(range(10)))
+        self.assertEqual(stats["rows_scanned"], 10)
+        self.assertFalse(stats["complete"])
+
+    def test_checkpoint_resume(self):
+        checkpoint_path = self.directory + "/checkpoint.json"
+        stats = self.backfill(scan_client(23), limit=10,
+                              checkpoint_path=checkpoint_path)
+        self.assertEqual(stats["rows_scanned"], 10)
+        self.assertEqual(stats["uncommitted_rows"], 2)
+        # The partial page the limit stopped in isn't checkpointed
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        self.assertEqual(checkpoint["segments"]["0"]["last_evaluated_key"],
+                         {"offset": {"N": "8"}})
+        self.assertEqual(checkpoint["stats"]["rows_scanned"], 8)
+
+        self.batches = []
+        stats = self.backfill(scan_client(23), resume=True,
+                              checkpoint_path=checkpoint_path)
+        self.assertEqual(self.rows(), list(range(8, 23)))
+        # Redone rows are only counted once across both runs
+        self.assertEqual(stats["rows_scanned"], 23)
+        self.assertEqual(stats["transformed"], 23)
+        self.assertEqual(stats["uncommitted_rows"], 0)
+        self.assertTrue(stats["complete"])
+
+    def test_stored_counts_writes(self):
+        def transform(item):
+            if item.payload["n"] % 2 == 1:
+                return None
+            return Item(item_type="Row", payload=item.payload)
+        # Backfills load transformers from the working directory
+        self.controller.get_transformer(self.transformer_config, os.getcwd()).transform = transform
+        stats = self.backfill(scan_client(10),
+                              checkpoint_path=self.directory + "/checkpoint.json")
+        self.assertEqual(stats["transformed"], 10)
+        self.assertEqual(stats["filtered"], 5)
+        # Five items, each written to two storage backends
+        self.assertEqual(stats["stored"], 10)
+        rows = sqlite3.connect(self.sqlite_path).execute("SELECT COUNT(*) FROM items").fetchone()
+        self.assertEqual(rows[0], 5)
@@ -2,9 +2,17 @@
 
 import unittest
 import json
+import struct
 import os.path
-from antenna.Filters import UniqueDynamoDBFilter
+import tempfile
+from antenna.Filters import UniqueDynamoDBFilter, BloomFilter
+from antenna.Transformers import Item
 from antenna.AWSManager import AWSManager
+from fakes import FakeAWSManager, FakeDynamoDBClient, FakeS3Client
+
+def table_client(urls, page_size=2):
+    return FakeDynamoDBClient(["my_hash_key"], [{"my_hash_key": url} for url in urls],
+                              page_size=page_size)
 
 class TestFilters(unittest.TestCase):
     def setUp(self):
@@ -28,3 +36,170 @@ class TestFilters(unittest.TestCase):
         ufilter = UniqueDynamoDBFilter(manager, config)
         formatted = ufilter.format_key(item)
         self.assertEqual(formatted, "%s-%s" % (item['category'], item['url']))
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add("key%d" % i)
+        for i in range(1000):
+            self.assertTrue("key%d" % i in bloom)
+        false_positives = sum(1 for i in range(10000) if "other%d" % i in bloom)
+        self.assertTrue(false_positives < 300)
+
+        restored = BloomFilter.from_bytes(bloom.to_bytes())
+        self.assertEqual(restored.count, bloom.count)
+        self.assertTrue("key42" in restored)
+
+        other = BloomFilter(capacity=1000, error_rate=0.01)
+        other.add("merged")
+        restored.union(other)
+        self.assertTrue("merged" in restored)
+
+    def test_bloom_filter_legacy_format(self):
+        legacy = struct.pack(">4sBBQQ", b"ANBF", 1, 3, 64, 0) + bytes(8)
+        bloom = BloomFilter.from_bytes(legacy)
+        self.assertFalse(bloom.seeded)
+        self.assertEqual(bloom.num_bits, 64)
+
+    def bloom_config(self, **params):
+        config = {
+            "dynamodb_table_name": "test_table",
+            "partition_key": "my_hash_key",
+            "partition_key_format_string": "{url}",
+            "bloom_filter": True
+        }
+        config.update(params)
+        return config
+
+    def key_id(self, ufilter, url):
+        return ufilter.row_key_id({"my_hash_key": {"S": url}})
+
+    def test_bloom_filter_persistence(self):
+        path = os.path.join(tempfile.mkdtemp(), "test.bloom")
+        ddb = table_client(["http://a.com", "http://b.com", "http://c.com"])
+        ufilter = UniqueDynamoDBFilter(FakeAWSManager({"dynamodb": ddb}),
+                                       self.bloom_config(bloom_filter_path=path))
+        bloom = ufilter.get_bloom_filter()
+        # New filters are seeded from a full scan, then persisted
+        self.assertTrue(bloom.seeded)
+        self.assertEqual(ddb.count("scan"), 2)
+        self.assertTrue(self.key_id(ufilter, "http://c.com") in bloom)
+        persisted = ufilter.read_bloom_filter()
+        self.assertTrue(persisted.seeded)
+        self.assertTrue(self.key_id(ufilter, "http://a.com") in persisted)
+
+        bloom.add("http://google.com")
+        ufilter.flush(force=True)
+        self.assertTrue("http://google.com" in ufilter.read_bloom_filter())
+
+    def test_bloom_filter_flush_interval(self):
+        path = os.path.join(tempfile.mkdtemp(), "test.bloom")
+        ddb = table_client([])
+        ufilter = UniqueDynamoDBFilter(FakeAWSManager({"dynamodb": ddb}),
+                                       self.bloom_config(bloom_filter_path=path,
+                                                         bloom_filter_flush_seconds=3600))
+        bloom = ufilter.get_bloom_filter()
+        bloom.add("http://google.com")
+        ufilter.flush()
+        self.assertFalse("http://google.com" in ufilter.read_bloom_filter())
+        ufilter.close()
+        self.assertTrue("http://google.com" in ufilter.read_bloom_filter())
+
+    def test_bloom_filter_conditional_write(self):
+        s3 = FakeS3Client()
+        ddb = table_client(["http://a.com"])
+        ufilter = UniqueDynamoDBFilter(FakeAWSManager({"dynamodb": ddb, "s3": s3}),
+                                       self.bloom_config(bloom_filter_s3_bucket="bucket",
+                                                         bloom_filter_s3_key="cond.bloom"))
+        bloom = ufilter.get_bloom_filter()
+        self.assertTrue(bloom.seeded)
+        bloom.add("http://mine.com")
+
+        # Another process persists its keys between our read and write
+        other = BloomFilter(capacity=ufilter.bloom_filter_capacity,
+                            error_rate=ufilter.bloom_filter_error_rate)
+        other.add("http://theirs.com")
+        s3.interfere = other.to_bytes()
+        puts = s3.calls.count("put_object")
+        ufilter.flush(force=True)
+        self.assertEqual(s3.calls.count("put_object") - puts, 2)
+
+        persisted = ufilter.read_bloom_filter()
+        self.assertTrue("http://mine.com" in persisted)
+        self.assertTrue("http://theirs.com" in persisted)
+        self.assertTrue(self.key_id(ufilter, "http://a.com") in persisted)
+        self.assertTrue(persisted.seeded)
+
+    def unique_filter(self, ddb, **params):
+        config = {
+            "dynamodb_table_name": "test_table",
+            "partition_key": "my_hash_key",
+            "partition_key_format_string": "{url}"
+        }
+        config.update(params)
+        return UniqueDynamoDBFilter(FakeAWSManager({"dynamodb": ddb}), config)
+
+    def articles(self, urls):
+        return [Item(item_type="Article", payload={"url": url, "time_published": 7})
+                for url in urls]
+
+    def test_filter_many_batches(self):
+        urls = ["http://example.com/%d" % n for n in range(250)]
+        ddb = table_client(urls[::3])
+        ufilter = self.unique_filter(ddb)
+        results = ufilter.filter_many(self.articles(urls))
+        self.assertEqual(results, [n % 3 != 0 for n in range(250)])
+        # At most 100 keys per BatchGetItem
+        self.assertEqual(ddb.sizes("batch_get_item"), [100, 100, 50])
+
+    def test_filter_many_unprocessed_keys(self):
+        urls = ["http://example.com/%d" % n for n in range(150)]
+        ddb = FakeDynamoDBClient(["my_hash_key"], [{"my_hash_key": url} for url in urls[100:]],
+                                 max_get_keys=60)
+        ufilter = self.unique_filter(ddb)
+        results = ufilter.filter_many(self.articles(urls))
+        self.assertEqual(results, [n < 100 for n in range(150)])
+        self.assertEqual(ddb.sizes("batch_get_item"), [100, 40, 50])
+
+        ddb.max_get_keys = 0
+        keys = [ufilter.ddb_key(item) for item in self.articles(urls[:3])]
+        self.assertRaises(RuntimeError, ufilter.existing_keys, keys, max_retries=2)
+
+    def test_filter_many_duplicates(self):
+        ddb = table_client(["http://old.com"])
+        ufilter = self.unique_filter(ddb)
+        results = ufilter.filter_many(self.articles(["http://a.com", "http://b.com",
+                                                     "http://a.com", "http://old.com",
+                                                     "http://old.com"]))
+        # Only the first of several items sharing a key passes
+        self.assertEqual(results, [True, True, False, False, False])
+        self.assertEqual(ddb.sizes("batch_get_item"), [3])
+
+    def test_filter_many_query_fallback(self):
+        ddb = FakeDynamoDBClient(["my_hash_key", "time_published"],
+                                 [{"my_hash_key": "http://old.com", "time_published": 1}])
+        # Without a range_key_format_string the full key is unknown, so
+        # each item is queried by its partition key instead
+        ufilter = self.unique_filter(ddb, range_key="time_published")
+        self.assertFalse(ufilter.can_batch_get())
+        results = ufilter.filter_many(self.articles(["http://a.com", "http://old.com",
+                                                     "http://a.com"]))
+        self.assertEqual(results, [True, False, False])
+        self.assertEqual(ddb.count("query"), 2)
+        self.assertEqual(ddb.count("batch_get_item"), 0)
+
+    def test_bloom_filter_skips_reads(self):
+        path = os.path.join(tempfile.mkdtemp(), "skip.bloom")
+        ddb = table_client(["http://old.com"])
+        ufilter = self.unique_filter(ddb, bloom_filter=True, bloom_filter_path=path)
+        self.assertTrue(ufilter.get_bloom_filter().seeded)
+
+        # Only the key the seeded filter has seen is looked up
+        results = ufilter.filter_many(self.articles(["http://new.com", "http://old.com"]))
+        self.assertEqual(results, [True, False])
+        self.assertEqual(ddb.sizes("batch_get_item"), [1])
+
+        # Keys seen since seeding may not have been stored, so they're still checked
+        results = ufilter.filter_many(self.articles(["http://new.com", "http://other.com"]))
+        self.assertEqual(results, [True, True])
+        self.assertEqual(ddb.sizes("batch_get_item"), [1, 1])
@@ -0,0 +1,38 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+
+import unittest
+import shutil
+import tempfile
+import antenna.lambda_handlers as lambda_handlers
+
+class TestLambdaHandlers(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        lambda_handlers._controllers.clear()
+
+    def tearDown(self):
+        for controller in lambda_handlers._controllers.values():
+            controller.close()
+        lambda_handlers._controllers.clear()
+        shutil.rmtree(self.directory)
+
+    def config(self, project_name="test"):
+        return {"project_name": project_name, "sources": [], "transformers": []}
+
+    def test_get_controller_reuse(self):
+        controller = lambda_handlers.get_controller(self.config(), self.directory)
+        self.assertTrue(controller._resource_cluster is None)
+        # Equal configs, even freshly decoded ones, share a warm controller
+        self.assertTrue(lambda_handlers.get_controller(self.config(), self.directory)
+                        is controller)
+        self.assertEqual(len(lambda_handlers._controllers), 1)
+
+    def test_get_controller_keys(self):
+        controller = lambda_handlers.get_controller(self.config(), self.directory)
+        other_config = lambda_handlers.get_controller(self.config("other"), self.directory)
+        other_path = lambda_handlers.get_controller(self.config(), self.directory + "/other")
+        self.assertFalse(other_config is controller)
+        self.assertFalse(other_path is controller)
+        self.assertFalse(other_path is other_config)
+        self.assertEqual(other_config.config["project_name"], "other")
+        self.assertEqual(len(lambda_handlers._controllers), 3)
@@ -0,0 +1,101 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+
+import unittest
+import threading
+from antenna.Transformers import Item
+from antenna.LocalPipeline import LocalPipeline
+
+class FakeTransformer(object):
+    def __init__(self, config):
+        self.params = config
+        self.input_item_types = config['input_item_types']
+        self.output_item_types = config['output_item_types']
+
+class FakeController(object):
+    """
+    Stands in for a Controller: sources yield numbered items and each
+    transformer tags the payload with its name and emits its output type
+    """
+    def __init__(self, sources, transformers):
+        self.config = {"sources": sources, "transformers": transformers}
+        self.local_pipeline_workers = 3
+        self.local_pipeline_queue_size = 2
+        self.transformer_batch_size = 4
+        self.source_workers = 2
+        self.seen = []
+        self.lock = threading.Lock()
+
+    def get_transformer(self, config, source_path):
+        return FakeTransformer(config)
+
+    def run_source_job(self, config, use_queues=True):
+        return [Item(item_type=config['item_type'], payload={"n": i, "path": []})
+                for i in range(config['count'])]
+
+    def run_transformer_batch(self, config, items, source_path, use_queues=True):
+        outputs = []
+        for item in items:
+            with self.lock:
+                self.seen.append((config['type'], item.payload['n']))
+            if len(config['output_item_types']) > 0:
+                outputs.append(Item(item_type=config['output_item_types'][0],
+                                    payload={"n": item.payload['n'],
+                                             "path": item.payload['path'] + [config['type']]}))
+        return outputs
+
+    def flush_stages(self):
+        pass
+
+class MutatingController(FakeController):
+    """
+    Transformers which tag the payload in place and pass it through,
+    like NewspaperLibScraper and IdentityTransformer do
+    """
+    def run_transformer_batch(self, config, items, source_path, use_queues=True):
+        outputs = []
+        for item in items:
+            item.payload[config['type']] = True
+            item.payload['path'].append(config['type'])
+            with self.lock:
+                self.seen.append((config['type'], sorted(item.payload.keys()),
+                                  list(item.payload['path'])))
+        return outputs
+
+def transformer(name, inputs, outputs):
+    return {"type": name, "input_item_types": inputs, "output_item_types": outputs}
+
+class TestLocalPipeline(unittest.TestCase):
+    def test_fan_out_and_chain(self):
+        controller = FakeController(
+            [{"type": "A", "item_type": "Link", "count": 20},
+             {"type": "B", "item_type": "Link", "count": 5}],
+            [transformer("Scraper", ["Link"], ["Article"]),
+             transformer("Archiver", ["Link"], []),
+             transformer("Tagger", ["Article"], ["TaggedArticle"])])
+        stats = LocalPipeline(controller, ".", verbose=False).run()
+
+        self.assertEqual(stats["source_items"], 25)
+        by_type = dict((s["type"], s) for s in stats["stages"])
+        # Every link reaches both subscribed transformers
+        self.assertEqual(by_type["Scraper"]["processed"], 25)
+        self.assertEqual(by_type["Archiver"]["processed"], 25)
+        self.assertEqual(by_type["Tagger"]["processed"], 25)
+        self.assertEqual(stats["unsubscribed_items"], 25)
+        self.assertEqual(len(controller.seen), 75)
+
+    def test_fan_out_copies_payloads(self):
+        controller = MutatingController(
+            [{"type": "A", "item_type": "Link", "count": 20}],
+            [transformer("Scraper", ["Link"], []),
+             transformer("Archiver", ["Link"], [])])
+        LocalPipeline(controller, ".", verbose=False).run()
+        self.assertEqual(len(controller.seen), 40)
+        # Neither stage sees the other's changes
+        for name, keys, path in controller.seen:
+            self.assertEqual(keys, sorted([name, "n", "path"]))
+            self.assertEqual(path, [name])
+
+    def test_rejects_cycles(self):
+        controller = FakeController([], [transformer("X", ["A"], ["B"]),
+                                         transformer("Y", ["B"], ["A"])])
+        self.assertRaises(Exception, LocalPipeline, controller, ".")
@@ -0,0 +1,50 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+
+import unittest
+import json
+from antenna.MessageCodec import MessageCodec, ENCODING_ATTRIBUTE, VERSION_ATTRIBUTE
+from antenna.MessageCodec import zstd_available
+
+class TestMessageCodec(unittest.TestCase):
+    def setUp(self):
+        self.payload = {"url": "http://example.com/a", "title": "Title",
+                        "text": "Lorem ipsum dolor sit amet. " * 200}
+
+    def test_compact_json(self):
+        body, attributes = MessageCodec().encode(self.payload)
+        self.assertEqual(body, json.dumps(self.payload, separators=(',', ':')))
+        self.assertFalse(ENCODING_ATTRIBUTE in attributes)
+        self.assertEqual(MessageCodec.decode(body, attributes), self.payload)
+
+    def test_zlib(self):
+        codec = MessageCodec(compression="zlib")
+        body, attributes = codec.encode(self.payload)
+        self.assertEqual(attributes[ENCODING_ATTRIBUTE], "zlib")
+        self.assertTrue(len(body) < len(json.dumps(self.payload)) / 4)
+        self.assertEqual(MessageCodec.decode(body, attributes), self.payload)
+
+        # Small payloads aren't worth compressing
+        body, attributes = codec.encode({"url": "http://example.com/a"})
+        self.assertFalse(ENCODING_ATTRIBUTE in attributes)
+
+    def test_sqs_attributes(self):
+        body, attributes = MessageCodec(compression="zlib").encode(self.payload)
+        sqs_attributes = {name: {'DataType': 'String', 'StringValue': value}
+                          for name, value in attributes.items()}
+        self.assertEqual(MessageCodec.decode(body, sqs_attributes), self.payload)
+
+    @unittest.skipIf(not zstd_available(), "zstandard is not installed")
+    def test_zstd(self):
+        body, attributes = MessageCodec(compression="zstd").encode(self.payload)
+        self.assertEqual(attributes[ENCODING_ATTRIBUTE], "zstd")
+        self.assertEqual(MessageCodec.decode(body, attributes), self.payload)
+
+    def test_legacy_bodies(self):
+        # Bodies sent before the codec existed carry no attributes
+        self.assertEqual(MessageCodec.decode(json.dumps(self.payload, indent=4)), self.payload)
+        self.assertEqual(MessageCodec.decode(json.dumps(self.payload), None), self.payload)
+
+    def test_newer_version_rejected(self):
+        body, attributes = MessageCodec().encode(self.payload)
+        attributes[VERSION_ATTRIBUTE] = "99"
+        self.assertRaises(Exception, MessageCodec.decode, body, attributes)
@@ -0,0 +1,123 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+
+import unittest
+import os
+import time
+import shutil
+import tempfile
+from zipfile import ZipFile
+import antenna.Controller as Controller
+from fakes import FakeLambdaClient
+
+class TestPackaging(unittest.TestCase):
+    def setUp(self):
+        self.source_path = tempfile.mkdtemp()
+        with open(os.path.join(self.source_path, "transformers.py"), 'w') as f:
+            f.write("# project code\n")
+        with open(os.path.join(self.source_path, ".hidden"), 'w') as f:
+            f.write("secret\n")
+
+        self.env_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.env_path, "somelib"))
+        with open(os.path.join(self.env_path, "somelib", "__init__.py"), 'w') as f:
+            f.write("# dependency\n" + "x = %r\n" % os.urandom(64 * 1024))
+        fd, self.requirements_path = tempfile.mkstemp(suffix=".txt")
+        os.close(fd)
+        with open(self.requirements_path, 'w') as f:
+            f.write("somelib==1.0\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.source_path)
+        shutil.rmtree(self.env_path)
+        os.remove(self.requirements_path)
+
+    def read_package(self):
+        path = Controller.create_lambda_package(self.source_path)
+        with open(path, 'rb') as f:
+            return path, f.read()
+
+    def test_package_is_reproducible(self):
+        path, first = self.read_package()
+        Controller.cleanup_lambda_package(self.source_path)
+        # A rebuild from scratch, with new mtimes, gives the same bytes
+        time.sleep(0.01)
+        os.utime(os.path.join(self.source_path, "transformers.py"))
+        path, second = self.read_package()
+        self.assertEqual(first, second)
+
+        names = ZipFile(path).namelist()
+        self.assertEqual(names, sorted(names))
+        self.assertTrue("transformers.py" in names)
+        self.assertTrue("antenna/Controller.py" in names)
+        self.assertFalse(any(Controller.LAMBDA_BUILD_DIR in n for n in names))
+        self.assertFalse(".hidden" in names)
+
+    def test_package_rebuilt_on_change(self):
+        path, first = self.read_package()
+        with open(os.path.join(self.source_path, "transformers.py"), 'a') as f:
+            f.write("# changed\n")
+        path, second = self.read_package()
+        self.assertNotEqual(first, second)
+
+    def test_unchanged_function_skipped(self):
+        path = Controller.create_lambda_package(self.source_path)
+        configuration = {
+            "Runtime": "python3.6",
+            "Handler": "antenna.lambda_handlers.transformer_handler",
+            "Timeout": Controller.LAMBDA_TIMEOUT,
+            "Role": "role",
+            "MemorySize": 128,
+            "CodeSha256": Controller.file_sha256(path)
+        }
+        client = FakeLambdaClient(dict(configuration))
+        Controller.create_lambda_function("f", "role", client, path,
+                                          "lambda_handlers.transformer_handler")
+        self.assertEqual(client.calls, [])
+
+        client = FakeLambdaClient(dict(configuration, CodeSha256="old"))
+        Controller.create_lambda_function("f", "role", client, path,
+                                          "lambda_handlers.transformer_handler", memory_size=256)
+        self.assertEqual(client.calls, ["update_function_code", "update_function_configuration"])
+
+        client = FakeLambdaClient()
+        Controller.create_lambda_function("f", "role", client, path,
+                                          "lambda_handlers.transformer_handler")
+        self.assertEqual(client.calls, ["create_function"])
+
+    def build_layer(self):
+        return Controller.create_lambda_layer(self.source_path, env_path=self.env_path,
+                                              requirements_path=self.requirements_path)
+
+    def test_dependency_layer(self):
+        layer_path, key = self.build_layer()
+        self.assertTrue(key in os.path.basename(layer_path))
+        names = ZipFile(layer_path).namelist()
+        self.assertEqual(names, ["python/somelib/__init__.py"])
+
+        # Unchanged dependencies give the same artifact
+        sha = Controller.file_sha256(layer_path)
+        self.assertEqual(self.build_layer(), (layer_path, key))
+        self.assertEqual(Controller.file_sha256(layer_path), sha)
+
+        # Changed requirements give a new one
+        with open(self.requirements_path, 'a') as f:
+            f.write("otherlib==2.0\n")
+        new_layer_path, new_key = self.build_layer()
+        self.assertNotEqual(new_key, key)
+        self.assertNotEqual(new_layer_path, layer_path)
+
+        client = FakeLambdaClient()
+        arn = Controller.publish_lambda_layer(client, "Deps", layer_path, key)
+        self.assertEqual(Controller.publish_lambda_layer(client, "Deps", layer_path, key), arn)
+        self.assertEqual(client.calls, ["publish_layer_version"])
+
+    def test_slim_function_bundle(self):
+        layer_path, key = self.build_layer()
+        fat = Controller.create_lambda_package(self.source_path, env_path=self.env_path)
+        slim = Controller.create_lambda_package(self.source_path, include_dependencies=False,
+                                                env_path=self.env_path)
+        names = ZipFile(slim).namelist()
+        self.assertTrue("somelib/__init__.py" in ZipFile(fat).namelist())
+        self.assertFalse(any("somelib" in n for n in names))
+        self.assertTrue("transformers.py" in names)
+        self.assertTrue(os.path.getsize(slim) + 64 * 1024 < os.path.getsize(fat))
@@ -0,0 +1,242 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+
+import unittest
+import os
+import json
+import time
+import queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+from antenna.Queues import SQSBatchSender, LocalQueue, SQS_MAX_BATCH_BYTES
+from antenna.Queues import MemoryQueueBackend, FileQueueBackend, QueueBatcher, QueuePoller
+from antenna.Queues import SQSQueueBackend
+
+class FakeSQSClient(object):
+    def __init__(self, fail_ids=None, receive_batches=None):
+        self.batches = []
+        self.fail_ids = set(fail_ids or [])
+        self.receive_batches = list(receive_batches or [])
+        self.receive_calls = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.batches.append(list(Entries))
+        failed = [e for e in Entries if e['Id'] in self.fail_ids]
+        self.fail_ids = set()
+        return {
+            'Successful': [{'Id': e['Id']} for e in Entries if e not in failed],
+            'Failed': [{'Id': e['Id'], 'Code': 'InternalError', 'SenderFault': False}
+                       for e in failed]
+        }
+
+    def receive_message(self, **kwargs):
+        self.receive_calls.append(kwargs)
+        if len(self.receive_batches) == 0:
+            return {}
+        return {'Messages': [{'Body': body, 'ReceiptHandle': "r-" + body, 'MessageId': body}
+                             for body in self.receive_batches.pop(0)]}
+
+class TestQueues(unittest.TestCase):
+    def test_batches_by_count(self):
+        client = FakeSQSClient()
+        sender = SQSBatchSender(client, "queue")
+        for i in range(25):
+            sender.add(json.dumps({"i": i}))
+        sender.flush()
+        self.assertEqual([len(b) for b in client.batches], [10, 10, 5])
+        self.assertEqual(sender.sent, 25)
+
+    def test_batches_by_size(self):
+        client = FakeSQSClient()
+        sender = SQSBatchSender(client, "queue")
+        body = "x" * (SQS_MAX_BATCH_BYTES // 3)
+        for i in range(4):
+            sender.add(body)
+        sender.flush()
+        self.assertEqual([len(b) for b in client.batches], [3, 1])
+
+    def test_retries_only_failed_entries(self):
+        client = FakeSQSClient(fail_ids=["1"])
+        sender = SQSBatchSender(client, "queue")
+        for i in range(3):
+            sender.add(json.dumps({"i": i}))
+        sender.flush()
+        self.assertEqual(len(client.batches), 2)
+        self.assertEqual([e['Id'] for e in client.batches[1]], ["1"])
+        self.assertEqual(sender.sent, 3)
+
+    def test_poller_stops_when_idle(self):
+        client = FakeSQSClient(receive_batches=[["a", "b"], ["c"]])
+        poller = QueuePoller(SQSQueueBackend(client, "queue"), runtime=60, idle_timeout=1)
+        start = time.time()
+        batches = [[m.body for m in messages] for messages in poller.poll()]
+        self.assertEqual(batches, [["a", "b"], ["c"]])
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(all(c['MaxNumberOfMessages'] == 10 for c in client.receive_calls))
+        self.assertTrue(all(c['WaitTimeSeconds'] <= 1 for c in client.receive_calls))
+        self.assertTrue(all(c['MessageAttributeNames'] == ['All'] for c in client.receive_calls))
+
+class TestLocalQueue(unittest.TestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def drain(self, q):
+        bodies = []
+        while True:
+            messages = q.receive(max_messages=3)
+            if len(messages) == 0:
+                return bodies
+            for receipt, body, attributes in messages:
+                self.assertTrue(q.ack(receipt))
+                bodies.append(body)
+
+    def test_fifo_across_spill(self):
+        q = LocalQueue("Article", memory_items=4, spill_dir=self.spill_dir)
+        for i in range(10):
+            q.put(str(i))
+        self.assertEqual(len(q), 10)
+        first = [body for _, body, _ in q.receive(max_messages=2)]
+        # Puts after a spill must queue behind the spilled bodies
+        for i in range(10, 15):
+            q.put(str(i))
+        self.assertEqual(first + self.drain(q), [str(i) for i in range(15)])
+        self.assertEqual(len(q), 2)
+
+    def test_spilled_items_survive_restart(self):
+        q = LocalQueue("Article", memory_items=2, spill_dir=self.spill_dir)
+        for i in range(6):
+            q.put(str(i))
+        q.close()
+        q = LocalQueue("Article", memory_items=2, spill_dir=self.spill_dir)
+        self.assertEqual(self.drain(q), ["2", "3", "4", "5"])
+
+    def test_attributes_survive_spill(self):
+        q = LocalQueue("Article", memory_items=2, spill_dir=self.spill_dir)
+        q.put_many(["a", "[b]", "c"], attributes=[{"x": "1"}, None, {"y": "2"}])
+        q.close()
+        q = LocalQueue("Article", memory_items=2, spill_dir=self.spill_dir)
+        self.assertEqual([(body, attributes) for _, body, attributes in q.receive(max_messages=3)],
+                         [("c", {"y": "2"})])
+
+        q = LocalQueue("Other", memory_items=1, spill_dir=self.spill_dir)
+        q.put_many(["a", "[b]", "c"], attributes=[{"x": "1"}, None, {"y": "2"}])
+        self.assertEqual([(body, attributes) for _, body, attributes in q.receive(max_messages=3)],
+                         [("a", {"x": "1"}), ("[b]", None), ("c", {"y": "2"})])
+
+    def test_legacy_spill_file(self):
+        db = sqlite3.connect(os.path.join(self.spill_dir, "Article.sqlite"))
+        db.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT)")
+        db.execute("INSERT INTO messages (body) VALUES ('old')")
+        db.commit()
+        db.close()
+        q = LocalQueue("Article", memory_items=2, spill_dir=self.spill_dir)
+        q.put_many(["new", "newer", "newest"], attributes=[{"x": "1"}, None, None])
+        self.assertEqual([(body, attributes) for _, body, attributes in q.receive(max_messages=2)],
+                         [("old", None), ("new", {"x": "1"})])
+
+    def test_visibility_timeout(self):
+        q = LocalQueue("Article", visibility_timeout=0.1)
+        q.put("a")
+        q.put("b")
+        receipt, body, attributes = q.receive()[0]
+        self.assertEqual(body, "a")
+        time.sleep(0.2)
+        # Unacked messages come back at the head of the queue
+        self.assertFalse(q.ack(receipt))
+        self.assertEqual(self.drain(q), ["a", "b"])
+
+    def test_bounded(self):
+        q = LocalQueue("Article", max_items=2)
+        q.put("a")
+        q.put("b")
+        self.assertRaises(queue.Full, q.put, "c", block=False)
+        receipt, body, attributes = q.receive()[0]
+
+        t = threading.Timer(0.1, q.ack, [receipt])
+        t.start()
+        q.put("c", timeout=5)
+        self.assertEqual(self.drain(q), ["b", "c"])
+
+    def test_concurrent_producers(self):
+        q = LocalQueue("Article", memory_items=50, spill_dir=self.spill_dir)
+        def produce(n):
+            for i in range(200):
+                q.put("%d-%d" % (n, i))
+        threads = [threading.Thread(target=produce, args=[n]) for n in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        bodies = self.drain(q)
+        self.assertEqual(len(set(bodies)), 800)
+        for n in range(4):
+            mine = [b for b in bodies if b.startswith("%d-" % n)]
+            self.assertEqual(mine, ["%d-%d" % (n, i) for i in range(200)])
+
+class TestQueueBackends(unittest.TestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def backends(self):
+        return [MemoryQueueBackend("Article", visibility_timeout=0.2),
+                FileQueueBackend("Article", self.spill_dir, memory_items=3,
+                                 visibility_timeout=0.2)]
+
+    def test_send_receive_ack(self):
+        for backend in self.backends():
+            batcher = QueueBatcher(backend)
+            for i in range(25):
+                batcher.add(str(i))
+            self.assertEqual(len(backend), 20)
+            batcher.flush()
+            self.assertEqual(batcher.sent, 25)
+
+            received = []
+            for messages in QueuePoller(backend, runtime=10, idle_timeout=0.5).poll():
+                self.assertTrue(len(messages) <= 10)
+                backend.ack([m.receipt_handle for m in messages])
+                received += [m.body for m in messages]
+            self.assertEqual(received, [str(i) for i in range(25)])
+            self.assertEqual(len(backend), 0)
+            backend.close()
+
+    def test_extend(self):
+        for backend in self.backends():
+            backend.send_batch(["a", "b"])
+            messages = backend.receive(max_messages=2)
+            backend.extend([messages[0].receipt_handle], 10)
+            time.sleep(0.3)
+            # Only the message that wasn't extended is delivered again
+            self.assertEqual([m.body for m in backend.receive(max_messages=2)], ["b"])
+            backend.close()
+
+    def test_message_attributes(self):
+        for backend in self.backends():
+            batcher = QueueBatcher(backend)
+            batcher.add("plain")
+            batcher.add("packed", {"antenna-encoding": "zlib"})
+            batcher.flush()
+            messages = backend.receive(max_messages=2)
+            self.assertEqual([(m.body, m.message_attributes) for m in messages],
+                             [("plain", {}), ("packed", {"antenna-encoding": "zlib"})])
+            backend.close()
+
+    def test_local_messages_are_not_size_limited(self):
+        for backend in self.backends():
+            batcher = QueueBatcher(backend)
+            body = "x" * (SQS_MAX_BATCH_BYTES + 1)
+            for i in range(3):
+                batcher.add(body)
+            # Batches are only split by message count
+            self.assertEqual(len(backend), 0)
+            batcher.flush()
+            self.assertEqual([m.body for m in backend.receive(max_messages=3)], [body] * 3)
+            backend.close()
+
+        sqs = QueueBatcher(SQSQueueBackend(FakeSQSClient(), "queue"))
+        self.assertRaises(RuntimeError, sqs.add, body)
@@ -1,7 +1,9 @@
 # Copyright 2016 Morgan McDermott & Blake Allen
 
 import unittest
+import sys
 import json
+import time
 import os.path
 from antenna.Sources import StaticFileSource, RSSFeedSource, NewspaperLibSource
 from antenna.AWSManager import AWSManager
@@ -42,3 +44,142 @@ class TestSources(unittest.TestCase):
         source = NewspaperLibSource(manager, config)
         for item in source.yield_items():
             print(item.payload['url'])
+
+class TestIncrementalSources(unittest.TestCase):
+    def source(self, state=None, **params):
+        params["rss_feed_url"] = "http://example.com/feed.rss"
+        source = RSSFeedSource(None, params)
+        source.set_state(state)
+        return source
+
+    def emit(self, source, urls, timestamps=None):
+        timestamps = timestamps or [None] * len(urls)
+        return [url for url, t in zip(urls, timestamps) if source.is_new_entry(url, t)]
+
+    def test_recent_entry_ids(self):
+        urls = ["http://example.com/%d" % i for i in range(1500)]
+        source = self.source()
+        self.assertEqual(len(self.emit(source, urls)), 1500)
+        # Repeats within a run are caught too
+        self.assertEqual(self.emit(source, urls[:10]), [])
+
+        # Every id emitted by the last run is kept, even past max_recent_entries
+        source = self.source(json.loads(json.dumps(source.get_state())))
+        self.assertEqual(self.emit(source, urls), [])
+
+    def test_recent_entry_eviction(self):
+        source = self.source(max_recent_entries=100)
+        self.emit(source, ["http://example.com/old/%d" % i for i in range(100)])
+        source = self.source(source.get_state(), max_recent_entries=100)
+        self.emit(source, ["http://example.com/new/%d" % i for i in range(30)])
+
+        source = self.source(source.get_state(), max_recent_entries=100)
+        self.assertEqual(len(source.state['recent_entry_ids'].split()), 100)
+        # The oldest ids are evicted first
+        self.assertEqual(self.emit(source, ["http://example.com/old/0",
+                                            "http://example.com/old/99",
+                                            "http://example.com/new/0"]),
+                         ["http://example.com/old/0"])
+
+    def test_high_water_mark_slack(self):
+        source = self.source(high_water_mark_slack=60)
+        self.assertEqual(self.emit(source, ["a", "b"], [1000, 2000]), ["a", "b"])
+        source = self.source(source.get_state(), high_water_mark_slack=60)
+        self.assertEqual(float(source.state['high_water_mark']), 2000)
+        # Unseen entries are only new if published within the slack
+        self.assertEqual(self.emit(source, ["c", "d", "e"], [1900, 1950, 2100]), ["d", "e"])
+
+    def test_high_water_mark_newest_first(self):
+        day = 60 * 60 * 24
+        timestamps = [100 * day - n * day for n in range(10)]
+        urls = ["http://example.com/%d" % n for n in range(10)]
+        # Feeds list newest first; a first run emits every entry
+        source = self.source()
+        self.assertEqual(self.emit(source, urls, timestamps), urls)
+        source = self.source(json.loads(json.dumps(source.get_state())))
+        self.assertEqual(float(source.state['high_water_mark']), 100 * day)
+
+        # The next run compares against the persisted mark, not its own newest entry
+        new_urls = ["http://example.com/new/%d" % n for n in range(3)]
+        self.assertEqual(self.emit(source, new_urls, [102 * day, 101 * day, 99.5 * day]),
+                         new_urls)
+        self.assertEqual(self.emit(source, ["http://example.com/old"], [98 * day]), [])
+        self.assertEqual(float(source.get_state()['high_water_mark']), 102 * day)
+
+
+class FakeFeedparser(object):
+    """
+    Stands in for the feedparser module, answering requests which carry
+    the feed's current validators with a 304
+    """
+    def __init__(self, entries, etag=None, modified=None):
+        self.entries = entries
+        self.etag = etag
+        self.modified = modified
+        self.requests = []
+
+    def parse(self, url, etag=None, modified=None):
+        self.requests.append({"etag": etag, "modified": modified})
+        if (self.etag is not None and etag == self.etag) or \
+           (self.modified is not None and modified == self.modified):
+            return {"status": 304, "entries": []}
+        feed = {"status": 200, "entries": self.entries}
+        if self.etag is not None:
+            feed["etag"] = self.etag
+        if self.modified is not None:
+            feed["modified"] = self.modified
+        return feed
+
+def rss_entry(n):
+    return {"link": "http://example.com/%d" % n, "title": "Article %d" % n,
+            "summary": "Summary %d" % n, "published_parsed": time.gmtime(time.time() - n)}
+
+class TestRSSValidators(unittest.TestCase):
+    def setUp(self):
+        self.feedparser = sys.modules.get("feedparser")
+
+    def tearDown(self):
+        if self.feedparser is None:
+            del sys.modules["feedparser"]
+        else:
+            sys.modules["feedparser"] = self.feedparser
+
+    def scrape(self, feed, state=None):
+        sys.modules["feedparser"] = feed
+        source = RSSFeedSource(None, {"rss_feed_url": "http://example.com/feed.rss"})
+        source.set_state(state)
+        items = list(source.yield_items())
+        # States round trip through DynamoDB between runs
+        return items, json.loads(json.dumps(source.get_state()))
+
+    def test_not_modified(self):
+        feed = FakeFeedparser([rss_entry(n) for n in range(3)], etag='"v1"',
+                              modified="Tue, 17 Oct 2017 10:00:00 GMT")
+        items, state = self.scrape(feed)
+        self.assertEqual(len(items), 3)
+        self.assertEqual(state["etag"], '"v1"')
+        self.assertEqual(state["modified"], "Tue, 17 Oct 2017 10:00:00 GMT")
+
+        # The saved validators make the next request conditional
+        items, state = self.scrape(feed, state)
+        self.assertEqual(items, [])
+        self.assertEqual(feed.requests[-1], {"etag": '"v1"',
+                                             "modified": "Tue, 17 Oct 2017 10:00:00 GMT"})
+        # A 304 keeps the validators and still counts as a scrape
+        self.assertEqual(state["etag"], '"v1"')
+        self.assertTrue(time.time() - state["time_last_updated"] < 60)
+
+    def test_changed_validators(self):
+        feed = FakeFeedparser([rss_entry(n) for n in range(3)], etag='"v1"')
+        items, state = self.scrape(feed)
+        self.assertFalse("modified" in state)
+
+        feed.entries = [rss_entry(n) for n in range(5)]
+        feed.etag = None
+        feed.modified = "Wed, 18 Oct 2017 10:00:00 GMT"
+        items, state = self.scrape(feed, state)
+        # Only the new entries are produced, and the stale etag is dropped
+        self.assertEqual(sorted(item.payload["url"] for item in items),
+                         ["http://example.com/3", "http://example.com/4"])
+        self.assertFalse("etag" in state)
+        self.assertEqual(state["modified"], "Wed, 18 Oct 2017 10:00:00 GMT")
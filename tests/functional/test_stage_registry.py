@@ -0,0 +1,36 @@
+# Copyright 2016 Morgan McDermott & Blake Allen
+
+import unittest
+from antenna.StageRegistry import StageRegistry
+
+class RecordingStage(object):
+    def __init__(self, conf):
+        self.conf = conf
+        self.events = []
+
+    def open(self):
+        self.events.append("open")
+
+    def flush(self):
+        self.events.append("flush")
+
+    def close(self):
+        self.events.append("close")
+
+class TestStageRegistry(unittest.TestCase):
+    def test_stages_built_once_per_config(self):
+        registry = StageRegistry()
+        a = registry.get("storage", {"type": "A", "x": 1}, RecordingStage)
+        b = registry.get("storage", {"x": 1, "type": "A"}, RecordingStage)
+        c = registry.get("filter", {"type": "A", "x": 1}, RecordingStage)
+        self.assertTrue(a is b)
+        self.assertFalse(a is c)
+        self.assertEqual(len(registry.stages()), 2)
+
+    def test_lifecycle(self):
+        registry = StageRegistry()
+        stage = registry.get("storage", {"type": "A"}, RecordingStage)
+        registry.flush()
+        registry.close()
+        self.assertEqual(stage.events, ["open", "flush", "flush", "close"])
+        self.assertEqual(len(registry.stages()), 0)
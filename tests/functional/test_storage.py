@@ -2,9 +2,23 @@
 
 import unittest
 import json
+import time
+import gzip
 import os.path
-from antenna.Storage import DynamoDBStorage
+import shutil
+import sqlite3
+import tempfile
+import binascii
+from antenna.Storage import DynamoDBStorage, SQLiteStorage, JSONLStorage, ParquetStorage
+from antenna.Storage import S3ArchiveStorage
+from antenna.Transformers import Item
 from antenna.AWSManager import AWSManager
+from fakes import FakeAWSManager, FakeDynamoDBClient, FakeS3Client
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 class TestStorage(unittest.TestCase):
     def setUp(self):
@@ -41,3 +55,330 @@ class TestStorage(unittest.TestCase):
         dynamostorage = DynamoDBStorage(manager, self.config)
         resources = dynamostorage.external_resources()
         self.assertEqual(len(resources), 1)
+
+
+class TestLocalStorage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def items(self, n):
+        return [Item(item_type="Article",
+                     payload={"category": "news", "url": "http://a.com/%d" % (i % 5),
+                              "n": i, "tags": ["x"], "sqs_receipt_handle": "r"})
+                for i in range(n)]
+
+    def test_sqlite_storage(self):
+        path = os.path.join(self.directory, "items.sqlite")
+        storage = SQLiteStorage(None, {
+            "type": "SQLiteStorage",
+            "sqlite_path": path,
+            "partition_key": "key",
+            "partition_key_format_string": "{category}-{url}",
+            "commit_max_items": 4
+        })
+        storage.open()
+        for item in self.items(12):
+            storage.store_item(item)
+        storage.flush()
+        storage.close()
+
+        rows = sqlite3.connect(path).execute("SELECT key, payload FROM items ORDER BY key").fetchall()
+        # Later items replace earlier ones with the same key
+        self.assertEqual([r[0] for r in rows], ["news-http://a.com/%d" % i for i in range(5)])
+        payload = json.loads(rows[0][1])
+        self.assertEqual(payload["n"], 10)
+        self.assertFalse("sqs_receipt_handle" in payload)
+
+    def test_sqlite_key_columns(self):
+        path = os.path.join(self.directory, "items.sqlite")
+        storage = SQLiteStorage(None, {"type": "SQLiteStorage", "sqlite_path": path,
+                                       "table_name": "articles", "key_columns": ["url", "n"]})
+        storage.open()
+        for item in self.items(12):
+            storage.store_item(item)
+        # Nothing is committed until the buffer fills or is flushed
+        self.assertEqual(sqlite3.connect(path).execute("SELECT COUNT(*) FROM articles").fetchone()[0], 0)
+        storage.flush()
+        storage.close()
+        self.assertEqual(sqlite3.connect(path).execute("SELECT COUNT(*) FROM articles").fetchone()[0], 12)
+
+    def test_jsonl_storage_rotation(self):
+        storage = JSONLStorage(None, {
+            "type": "JSONLStorage",
+            "directory": self.directory,
+            "partition_key": "key",
+            "partition_key_format_string": "{category}-{url}",
+            "buffer_max_items": 3,
+            "rotate_max_items": 5
+        })
+        for item in self.items(12):
+            storage.store_item(item)
+        storage.flush()
+        storage.close()
+
+        files = sorted(os.listdir(self.directory))
+        self.assertEqual(len(files), 3)
+        self.assertTrue(all(f.endswith(".jsonl.gz") for f in files))
+        records = []
+        for f in files:
+            with gzip.open(os.path.join(self.directory, f), 'rt') as fp:
+                records += [json.loads(line) for line in fp]
+        self.assertEqual([r["n"] for r in records], list(range(12)))
+        self.assertEqual(records[6]["key"], "news-http://a.com/1")
+        self.assertFalse("sqs_receipt_handle" in records[0])
+
+    def test_jsonl_storage_shared_directory(self):
+        storages = [JSONLStorage(None, {"type": "JSONLStorage", "directory": self.directory,
+                                        "compress": False}) for _ in range(2)]
+        for storage in storages:
+            for item in self.items(3):
+                storage.store_item(item)
+            storage.flush()
+            storage.close()
+        # Instances sharing a directory never write to the same file
+        files = os.listdir(self.directory)
+        self.assertEqual(len(files), 2)
+        for f in files:
+            with open(os.path.join(self.directory, f)) as fp:
+                self.assertEqual(len(fp.readlines()), 3)
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet_storage(self):
+        storage = ParquetStorage(None, {"type": "ParquetStorage", "directory": self.directory,
+                                        "buffer_max_items": 5})
+        for item in self.items(12):
+            storage.store_item(item)
+        storage.flush()
+        files = sorted(os.listdir(self.directory))
+        self.assertEqual(len(files), 3)
+        rows = []
+        for f in files:
+            rows += pyarrow.parquet.read_table(os.path.join(self.directory, f)).to_pylist()
+        self.assertEqual([r["n"] for r in rows], list(range(12)))
+        self.assertEqual(json.loads(rows[0]["tags"]), ["x"])
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_parquet_storage_mixed_records(self):
+        storage = ParquetStorage(None, {"type": "ParquetStorage", "directory": self.directory})
+        payloads = [{"n": 0, "score": 1},
+                    {"n": 1, "score": 2.5, "week_published": "2017_3"},
+                    {"n": 2, "score": None, "extra": {"a": 1}},
+                    {"n": 3, "score": 4, "extra": "text", "flag": True}]
+        for payload in payloads:
+            storage.store_item(Item(item_type="Row", payload=payload))
+        storage.flush()
+        files = os.listdir(self.directory)
+        self.assertEqual(len(files), 1)
+        rows = pyarrow.parquet.read_table(os.path.join(self.directory, files[0])).to_pylist()
+        # Properties missing from the first record are kept
+        self.assertEqual([r["week_published"] for r in rows], [None, "2017_3", None, None])
+        self.assertEqual([r["score"] for r in rows], [1.0, 2.5, None, 4.0])
+        self.assertEqual([r["flag"] for r in rows], [None, None, None, True])
+        # Mixed types are stored as JSON strings
+        self.assertEqual([r["extra"] for r in rows], [None, None, '{"a": 1}', "text"])
+
+    def test_parquet_storage_rejects_rotate_max_seconds(self):
+        self.assertRaises(Exception, ParquetStorage, None,
+                          {"type": "ParquetStorage", "directory": self.directory,
+                           "rotate_max_seconds": 60})
+
+
+class TestS3ArchiveStorage(unittest.TestCase):
+    def records(self, client):
+        records = {}
+        for key, body in client.objects.items():
+            lines = gzip.decompress(body).decode('utf-8').splitlines()
+            records[key] = [json.loads(line) for line in lines]
+        return records
+
+    def test_partitions_and_flush(self):
+        client = FakeS3Client()
+        storage = S3ArchiveStorage(FakeAWSManager({"s3": client}), {"type": "S3ArchiveStorage",
+                                                            "s3_bucket": "archive"})
+        for i in range(100):
+            storage.store_item(Item(item_type="Article",
+                                    payload={"n": i, "week_published": "2017_%d" % (i % 2),
+                                             "sqs_receipt_handle": "r"}))
+        self.assertEqual(client.objects, {})
+        storage.flush()
+
+        records = self.records(client)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(client.calls, ["put_object", "put_object"])
+        for key, rows in records.items():
+            self.assertTrue(key.startswith("archive/Article/week_published=2017_"))
+            self.assertTrue(key.endswith(".jsonl.gz"))
+            self.assertEqual(len(rows), 50)
+            self.assertFalse("sqs_receipt_handle" in rows[0])
+
+    def test_concurrent_instances(self):
+        client = FakeS3Client()
+        # Like two lambda containers flushing the same partition in the same second
+        for _ in range(2):
+            storage = S3ArchiveStorage(FakeAWSManager({"s3": client}), {"type": "S3ArchiveStorage",
+                                                                "s3_bucket": "archive"})
+            storage.store_item(Item(item_type="Article", payload={"week_published": "2017_1"}))
+            storage.flush()
+        self.assertEqual(len(client.objects), 2)
+
+    def test_multipart_rollover(self):
+        client = FakeS3Client()
+        storage = S3ArchiveStorage(FakeAWSManager({"s3": client}), {
+            "type": "S3ArchiveStorage", "s3_bucket": "archive", "partition_by": [],
+            "object_max_bytes": 12 * 1024 * 1024, "part_size": 5 * 1024 * 1024,
+            "complete_on_flush": False})
+        # Random hex compresses to about half its size
+        for i in range(30):
+            storage.store_item(Item(item_type="Article",
+                                    payload={"n": i,
+                                             "text": binascii.hexlify(os.urandom(512 * 1024)).decode()}))
+        storage.flush()
+        self.assertEqual(len(client.objects), 1)
+        storage.close()
+
+        records = self.records(client)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(sorted(r["n"] for rows in records.values() for r in rows), list(range(30)))
+        # The full object was uploaded in parts, the small remainder in one request
+        self.assertEqual(client.calls.count("complete_multipart_upload"), 1)
+        self.assertEqual(client.calls.count("upload_part"), 3)
+        self.assertEqual(client.calls.count("put_object"), 1)
+        self.assertEqual(client.uploads, {})
+
+    def test_failed_part_aborts_upload(self):
+        client = FakeS3Client(fail_part=2)
+        storage = S3ArchiveStorage(FakeAWSManager({"s3": client}), {
+            "type": "S3ArchiveStorage", "s3_bucket": "archive", "partition_by": [],
+            "part_size": 5 * 1024 * 1024})
+        def store(i):
+            storage.store_item(Item(item_type="Article",
+                                    payload={"n": i,
+                                             "text": binascii.hexlify(os.urandom(512 * 1024)).decode()}))
+        with self.assertRaises(RuntimeError):
+            for i in range(30):
+                store(i)
+        self.assertEqual(client.calls[-1], "abort_multipart_upload")
+        self.assertEqual(client.uploads, {})
+
+        # The next item starts a fresh object
+        client.fail_part = None
+        store(30)
+        storage.close()
+        records = self.records(client)
+        self.assertEqual(len(records), 1)
+        self.assertEqual([r["n"] for rows in records.values() for r in rows], [30])
+
+
+class TestDynamoDBStorage(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            "type": "DynamoDBStorage",
+            "dynamodb_table_name": "test_table",
+            "partition_key": "my_hash_key",
+            "partition_key_format_string": "{category}-{url}"
+        }
+        self.item = Item(item_type="Article",
+                         payload={"category": "news", "url": "http://a.com", "num": 4})
+
+    def test_update_item_args(self):
+        storage = DynamoDBStorage(FakeAWSManager({"dynamodb": FakeDynamoDBClient(["my_hash_key"])}), self.config)
+        args = storage.update_item_args(self.item)
+        self.assertEqual(args["Key"], {"my_hash_key": {"S": "news-http://a.com"}})
+        self.assertEqual(args["UpdateExpression"], "SET #A0 = :v0, #A1 = :v1, #A2 = :v2")
+        self.assertEqual(args["ExpressionAttributeNames"],
+                         {"#A0": "category", "#A1": "num", "#A2": "url"})
+        self.assertEqual(args["ExpressionAttributeValues"][":v1"], {"N": "4"})
+
+    def test_insert_or_update_item(self):
+        client = FakeDynamoDBClient(["my_hash_key"])
+        storage = DynamoDBStorage(FakeAWSManager({"dynamodb": client}), self.config)
+        storage.store_item(self.item)
+        storage.store_item(Item(item_type="Article",
+                                payload={"category": "news", "url": "http://a.com",
+                                         "title": "Updated"}))
+        row = list(client.rows.values())[0]
+        # Attributes the second item didn't have are kept
+        self.assertEqual(row["num"], {"N": "4"})
+        self.assertEqual(row["title"], {"S": "Updated"})
+
+    def test_insert_fresh_item(self):
+        client = FakeDynamoDBClient(["my_hash_key"])
+        config = dict(self.config, update_if_exists=False)
+        storage = DynamoDBStorage(FakeAWSManager({"dynamodb": client}), config)
+        self.assertNotEqual(storage.store_item(self.item), False)
+        duplicate = Item(item_type="Article",
+                         payload={"category": "news", "url": "http://a.com", "num": 5})
+        self.assertEqual(storage.store_item(duplicate), False)
+        self.assertEqual(list(client.rows.values())[0]["num"], {"N": "4"})
+
+    def test_fresh_items_are_not_buffered(self):
+        client = FakeDynamoDBClient(["my_hash_key"])
+        config = dict(self.config, update_if_exists=False, buffer_writes=True)
+        storage = DynamoDBStorage(FakeAWSManager({"dynamodb": client}), config)
+        storage.store_item(self.item)
+        self.assertEqual(storage.store_item(self.item), False)
+        storage.flush()
+        self.assertEqual(client.calls, [("update_item", 1), ("update_item", 1)])
+
+    def buffered_storage(self, client, **params):
+        config = dict(self.config, buffer_writes=True, buffer_max_seconds=3600)
+        config.update(params)
+        return DynamoDBStorage(FakeAWSManager({"dynamodb": client}), config)
+
+    def article(self, n, **payload):
+        payload.update({"category": "news", "url": "http://a.com/%d" % n})
+        return Item(item_type="Article", payload=payload)
+
+    def test_buffered_writes_chunked(self):
+        client = FakeDynamoDBClient(["my_hash_key"])
+        storage = self.buffered_storage(client, buffer_max_items=60)
+        for n in range(59):
+            storage.store_item(self.article(n))
+        self.assertEqual(client.calls, [])
+        # Reaching buffer_max_items flushes, 25 items per BatchWriteItem
+        storage.store_item(self.article(59))
+        self.assertEqual(client.sizes("batch_write_item"), [25, 25, 10])
+        self.assertEqual(len(client.rows), 60)
+        storage.flush()
+        self.assertEqual(client.count("batch_write_item"), 3)
+
+    def test_buffered_writes_age(self):
+        client = FakeDynamoDBClient(["my_hash_key"])
+        storage = self.buffered_storage(client, buffer_max_seconds=0.2)
+        storage.store_item(self.article(0))
+        self.assertEqual(client.calls, [])
+        time.sleep(0.3)
+        # The oldest buffered item is due, so the next store flushes both
+        storage.store_item(self.article(1))
+        self.assertEqual(client.sizes("batch_write_item"), [2])
+
+    def test_buffered_writes_latest_wins(self):
+        client = FakeDynamoDBClient(["my_hash_key"])
+        storage = self.buffered_storage(client)
+        storage.store_item(self.article(0, title="First"))
+        storage.store_item(self.article(1))
+        storage.store_item(self.article(0, title="Second"))
+        storage.flush()
+        # BatchWriteItem rejects duplicate keys, so only the latest write is sent
+        self.assertEqual(client.sizes("batch_write_item"), [2])
+        titles = [row.get("title") for row in client.items()]
+        self.assertEqual(sorted(t for t in titles if t is not None), ["Second"])
+
+    def test_buffered_writes_retry_unprocessed(self):
+        client = FakeDynamoDBClient(["my_hash_key"], max_write_items=10)
+        storage = self.buffered_storage(client)
+        for n in range(25):
+            storage.store_item(self.article(n))
+        storage.flush()
+        self.assertEqual(client.sizes("batch_write_item"), [25, 15, 5])
+        self.assertEqual(len(client.rows), 25)
+
+    def test_buffered_writes_give_up(self):
+        client = FakeDynamoDBClient(["my_hash_key"], max_write_items=0)
+        storage = self.buffered_storage(client)
+        ditems = [storage.dynamo_item(self.article(n)) for n in range(3)]
+        self.assertRaises(RuntimeError, storage.batch_write, ditems, max_retries=2)
+        self.assertEqual(client.sizes("batch_write_item"), [3, 3, 3])